@@ -0,0 +1,140 @@
+"""ベンチマーク用の音声・動画をffmpegで生成する。
+
+同じ引数からは常に同じ内容のファイルができるよう、乱数のシードと
+bitexactフラグを固定している。生成済みのファイルは再利用する。
+
+    python -m bench.fixtures --output bench_fixtures
+"""
+
+import argparse
+import subprocess
+from pathlib import Path
+
+AUDIO_KINDS = ("tone", "noise")
+AUDIO_DURATIONS = (10, 30, 120)
+VIDEO_DURATIONS = (10, 30)
+VIDEO_RESOLUTIONS = ("640x360", "1280x720", "1920x1080")
+
+NOISE_SEED = 42
+BITEXACT_FLAGS = [
+    "-fflags",
+    "+bitexact",
+    "-flags:v",
+    "+bitexact",
+    "-flags:a",
+    "+bitexact",
+    "-map_metadata",
+    "-1",
+]
+
+
+def _audio_source(kind: str, seconds: int) -> str:
+    if kind == "tone":
+        # 和音にしておくと、分離モデルが空の出力ばかりにならない
+        return (
+            f"sine=frequency=220:duration={seconds}[a];"
+            f"sine=frequency=330:duration={seconds}[b];"
+            f"sine=frequency=440:duration={seconds}[c];"
+            "[a][b][c]amix=inputs=3"
+        )
+    if kind == "noise":
+        return f"anoisesrc=duration={seconds}:color=pink:seed={NOISE_SEED}:amplitude=0.3"
+    raise ValueError(f"未知の音声の種類です: {kind}")
+
+
+def _run(command: list[str], output_path: Path):
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp{output_path.suffix}")
+    try:
+        subprocess.run(
+            [*command, *BITEXACT_FLAGS, "-y", str(tmp_path)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    except FileNotFoundError:
+        raise RuntimeError("FFmpegがインストールされていないか、PATHが通っていません。")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"テスト用ファイルの生成に失敗しました: {e.stderr}")
+    tmp_path.replace(output_path)
+
+
+def audio_fixture(output_dir: Path, kind: str, seconds: int) -> Path:
+    """44.1kHz・ステレオのWAV"""
+    path = output_dir / f"{kind}_{seconds}s.wav"
+    if not path.exists():
+        _run(
+            [
+                "ffmpeg",
+                "-f",
+                "lavfi",
+                "-i",
+                _audio_source(kind, seconds),
+                "-ac",
+                "2",
+                "-ar",
+                "44100",
+                "-c:a",
+                "pcm_s16le",
+            ],
+            path,
+        )
+    return path
+
+
+def video_fixture(output_dir: Path, seconds: int, resolution: str) -> Path:
+    """テストパターンの映像とトーンの音声を持つH.264/AACのMP4"""
+    path = output_dir / f"video_{resolution}_{seconds}s.mp4"
+    if not path.exists():
+        _run(
+            [
+                "ffmpeg",
+                "-f",
+                "lavfi",
+                "-i",
+                f"testsrc2=size={resolution}:rate=30:duration={seconds}",
+                "-f",
+                "lavfi",
+                "-i",
+                f"sine=frequency=440:duration={seconds}",
+                "-c:v",
+                "libx264",
+                "-preset",
+                "ultrafast",
+                "-pix_fmt",
+                "yuv420p",
+                "-threads",
+                "1",
+                "-c:a",
+                "aac",
+                "-shortest",
+            ],
+            path,
+        )
+    return path
+
+
+def generate_all(output_dir: Path) -> list[Path]:
+    paths = [
+        audio_fixture(output_dir, kind, seconds)
+        for kind in AUDIO_KINDS
+        for seconds in AUDIO_DURATIONS
+    ]
+    paths += [
+        video_fixture(output_dir, seconds, resolution)
+        for seconds in VIDEO_DURATIONS
+        for resolution in VIDEO_RESOLUTIONS
+    ]
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用のテストファイルを生成する")
+    parser.add_argument("--output", type=Path, default=Path("bench_fixtures"))
+    args = parser.parse_args()
+    for path in generate_all(args.output):
+        print(f"{path} ({path.stat().st_size} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""google.generativeai の代わりに使う、ネットワークに出ないGeminiのスタンドイン。
+
+GEMINI_LIBRARY=bench.gemini_standin を指定してAPIを起動すると、helper.gemini から
+このモジュールが読み込まれる。応答までの時間は環境変数で調整できる。
+"""
+
+import os
+import time
+from pathlib import Path
+
+from helper.ffmpeg_runner import probe_duration
+
+UPLOAD_SECONDS = float(os.getenv("GEMINI_STANDIN_UPLOAD_SECONDS", "0.5"))
+GENERATION_SECONDS = float(os.getenv("GEMINI_STANDIN_GENERATION_SECONDS", "2.0"))
+# 文字起こしの応答で、1つの字幕が受け持つ秒数
+SEGMENT_SECONDS = 3.0
+
+_files: dict[str, "File"] = {}
+
+
+class _State:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class File:
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.state = _State("ACTIVE")
+
+
+class _Response:
+    def __init__(self, text: str):
+        self.text = text
+
+
+def configure(api_key: str = None, **kwargs):
+    pass
+
+
+def upload_file(path: str, **kwargs) -> File:
+    time.sleep(UPLOAD_SECONDS)
+    uploaded = File(f"files/standin-{len(_files)}", str(path))
+    _files[uploaded.name] = uploaded
+    return uploaded
+
+
+def get_file(name: str) -> File:
+    return _files[name]
+
+
+def _timestamp(seconds: float) -> str:
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def _transcript(path: str) -> str:
+    total = probe_duration(Path(path)) or SEGMENT_SECONDS
+    segments = []
+    start = 0.0
+    while start < total:
+        end = min(start + SEGMENT_SECONDS, total)
+        segments.append(
+            f'{{"start": "{_timestamp(start)}", "end": "{_timestamp(end)}", '
+            f'"text": "ベンチマーク用の字幕 {len(segments) + 1}"}}'
+        )
+        start = end
+    return "[" + ", ".join(segments) + "]"
+
+
+class GenerativeModel:
+    def __init__(self, model_name: str, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, contents: list) -> _Response:
+        time.sleep(GENERATION_SECONDS)
+        files = [item for item in contents if isinstance(item, File)]
+        prompt = " ".join(item for item in contents if isinstance(item, str))
+        if files and "JSON" in prompt:
+            return _Response(_transcript(files[0].path))
+        return _Response(f"[{self.model_name}] ベンチマーク用の分析結果です。")
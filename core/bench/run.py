@@ -0,0 +1,646 @@
+"""主要なエンドポイントを指定した並列数で呼び出し、処理時間と資源の使用量を計測する。
+
+    # Geminiをスタンドインに差し替えたAPIを起動して計測する
+    python -m bench.run --start-server --concurrency 1,2,4 --output bench_results/HEAD.json
+
+    # 2つの結果を比べる
+    python -m bench.run --compare bench_results/base.json bench_results/HEAD.json
+
+非同期のジョブ (/analyze, /add-subtitle) は、ジョブが終了するまでを1件の処理時間とする。
+ステージごとの処理時間は、計測の前後で取得した /metrics の差分から求める。
+ジョブを実行するエンドポイントでは、ステージやffmpegなどのスパンごとのCPU時間と常駐メモリを
+ジョブのトレース (/api/jobs/{job_id}/trace) から集計する。
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+from bench.fixtures import audio_fixture, video_fixture
+
+ENDPOINTS = ("element_divide", "analyze", "add_subtitle", "mp4_to_mp3", "history")
+DEFAULT_ENDPOINTS = ("mp4_to_mp3", "add_subtitle", "history")
+
+JOB_WAIT_SECONDS = 30
+# トレースはジョブの終了直後に保存されるため、見つからなければ少し待って取り直す
+TRACE_FETCH_ATTEMPTS = 10
+TRACE_FETCH_INTERVAL_SECONDS = 0.5
+# スパンに記録される資源の使用量 (helper.tracing.span を参照)
+SPAN_RESOURCE_FIELDS = ("cpu_ms", "process_cpu_ms", "child_cpu_ms", "rss_mb", "rss_delta_mb")
+SAMPLE_INTERVAL_SECONDS = 0.5
+SERVER_START_TIMEOUT_SECONDS = 300
+REQUEST_TIMEOUT_SECONDS = 3600
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+# --- 統計 ---
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """線形補間によるパーセンタイル (q は 0-100)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else None,
+        "max": max(values) if values else None,
+    }
+
+
+def histogram_quantile(q: float, buckets: list[tuple[float, float]]) -> Optional[float]:
+    """Prometheusの histogram_quantile と同じく、累積バケットの中で線形補間する"""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    target = buckets[-1][1] * q / 100
+    previous_upper, previous_count = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= target:
+            if math.isinf(upper):
+                return previous_upper
+            if count == previous_count:
+                return upper
+            return previous_upper + (upper - previous_upper) * (
+                (target - previous_count) / (count - previous_count)
+            )
+        previous_upper, previous_count = upper, count
+    return previous_upper
+
+
+# --- /metrics ---
+
+
+def _parse_labels(text: str) -> dict:
+    labels = {}
+    for pair in text.split('",'):
+        name, _, value = pair.partition('="')
+        labels[name] = value.rstrip('"')
+    return labels
+
+
+def parse_stage_histograms(exposition: str) -> dict:
+    """{(operation_type, stage): {"buckets": {le: count}, "sum": s, "count": n}}"""
+    stages: dict = {}
+    prefix = "audily_stage_duration_seconds_"
+    for line in exposition.splitlines():
+        if not line.startswith(prefix) or "{" not in line:
+            continue
+        name, rest = line[len(prefix) :].split("{", 1)
+        label_text, _, value = rest.rpartition("} ")
+        labels = _parse_labels(label_text)
+        key = (labels["operation_type"], labels["stage"])
+        series = stages.setdefault(key, {"buckets": {}, "sum": 0.0, "count": 0.0})
+        if name == "bucket":
+            series["buckets"][float(labels["le"])] = float(value)
+        elif name in ("sum", "count"):
+            series[name] = float(value)
+    return stages
+
+
+def diff_stage_histograms(before: dict, after: dict) -> dict:
+    results = {}
+    for key, series in after.items():
+        previous = before.get(key, {"buckets": {}, "sum": 0.0, "count": 0.0})
+        count = series["count"] - previous["count"]
+        if count <= 0:
+            continue
+        buckets = sorted(
+            (upper, cumulative - previous["buckets"].get(upper, 0.0))
+            for upper, cumulative in series["buckets"].items()
+        )
+        results["/".join(key)] = {
+            "count": int(count),
+            "mean_seconds": (series["sum"] - previous["sum"]) / count,
+            "p50": histogram_quantile(50, buckets),
+            "p95": histogram_quantile(95, buckets),
+            "p99": histogram_quantile(99, buckets),
+        }
+    return results
+
+
+# --- トレース ---
+
+
+def fetch_trace(client: "Client", job_id: str) -> Optional[dict]:
+    for _ in range(TRACE_FETCH_ATTEMPTS):
+        status, payload = client.get_json(f"/api/jobs/{job_id}/trace")
+        if status == 200:
+            return payload
+        if status != 404:
+            return None
+        time.sleep(TRACE_FETCH_INTERVAL_SECONDS)
+    return None
+
+
+def summarize_trace_spans(traces: list[dict]) -> dict:
+    """スパン名ごとに、所要時間とスパンに記録されたCPU時間・常駐メモリを集計する"""
+    series_by_name: dict = {}
+    for trace in traces:
+        for event in trace.get("traceEvents", []):
+            if event.get("ph") != "X" or event.get("cat") != "span":
+                continue
+            series = series_by_name.setdefault(event["name"], {"duration_ms": []})
+            series["duration_ms"].append(event["dur"] / 1000)
+            for field in SPAN_RESOURCE_FIELDS:
+                if field in event["args"]:
+                    series.setdefault(field, []).append(event["args"][field])
+    return {
+        name: {
+            "count": len(series["duration_ms"]),
+            **{field: summarize(values) for field, values in series.items()},
+        }
+        for name, series in sorted(series_by_name.items())
+    }
+
+
+# --- サーバーの資源使用量 ---
+
+
+def _read_stat(pid: int) -> Optional[list[str]]:
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # プロセス名に空白が含まれることがあるため、最後の ")" 以降を分割する
+            return f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+
+
+def _descendants(root_pid: int) -> list[int]:
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        fields = _read_stat(int(entry))
+        if fields is not None:
+            children.setdefault(int(fields[1]), []).append(int(entry))
+    found, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        found.append(pid)
+        pending.extend(children.get(pid, []))
+    return found
+
+
+def sample_server(root_pid: int) -> tuple[float, int]:
+    """(APIとその子孫プロセスのCPU秒, 合計RSSバイト)。
+    終了して回収済みの子プロセスの分は、親の cutime/cstime に含まれる"""
+    cpu_ticks = 0
+    rss_pages = 0
+    for pid in _descendants(root_pid):
+        fields = _read_stat(pid)
+        if fields is None:
+            continue
+        # ")"以降の並び: state(0) ppid(1) ... utime(11) stime(12) cutime(13) cstime(14) ... rss(21)
+        cpu_ticks += int(fields[11]) + int(fields[12])
+        if pid == root_pid:
+            cpu_ticks += int(fields[13]) + int(fields[14])
+        rss_pages += int(fields[21])
+    return cpu_ticks / _CLOCK_TICKS, rss_pages * _PAGE_SIZE
+
+
+class ResourceSampler:
+    def __init__(self, root_pid: Optional[int]):
+        self.root_pid = root_pid
+        self.peak_rss_bytes = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cpu_start = 0.0
+        self._started_at = 0.0
+
+    def __enter__(self):
+        if self.root_pid is None:
+            return self
+        self._cpu_start, self.peak_rss_bytes = sample_server(self.root_pid)
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL_SECONDS):
+            _, rss = sample_server(self.root_pid)
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+
+    def __exit__(self, *exc):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        cpu_end, rss = sample_server(self.root_pid)
+        self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+        elapsed = time.monotonic() - self._started_at
+        self.cpu_seconds = cpu_end - self._cpu_start
+        # 1.0 で全コアを使い切った状態
+        self.cpu_utilisation = self.cpu_seconds / elapsed / (os.cpu_count() or 1)
+
+    def result(self) -> Optional[dict]:
+        if self._thread is None:
+            return None
+        return {
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "cpu_seconds": round(self.cpu_seconds, 2),
+            "cpu_utilisation": round(self.cpu_utilisation, 3),
+        }
+
+
+# --- HTTP ---
+
+
+class Client:
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        fields: Optional[dict] = None,
+        file_path: Optional[Path] = None,
+        query: Optional[dict] = None,
+    ) -> tuple[int, dict, bytes]:
+        url = self.base_url + path
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        data, headers = None, {}
+        if fields is not None or file_path is not None:
+            data, content_type = _encode_multipart(fields or {}, file_path)
+            headers["Content-Type"] = content_type
+        request = urllib.request.Request(url, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+                return response.status, dict(response.headers), response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), e.read()
+
+    def get_json(self, path: str, query: Optional[dict] = None) -> tuple[int, dict]:
+        status, _, body = self.request("GET", path, query=query)
+        try:
+            return status, json.loads(body)
+        except json.JSONDecodeError:
+            return status, {}
+
+    def wait_for_job(self, job_id: str) -> Optional[dict]:
+        status, payload = self.get_json(f"/api/jobs/{job_id}")
+        while status == 200 and payload.get("status") == "processing":
+            status, payload = self.get_json(
+                f"/api/jobs/{job_id}",
+                {"since": payload["updated_at"], "wait": JOB_WAIT_SECONDS},
+            )
+        return payload if status == 200 else None
+
+
+def _encode_multipart(fields: dict, file_path: Optional[Path]) -> tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n".encode("utf-8")
+        )
+    if file_path is not None:
+        parts.append(
+            (
+                f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; "
+                f'filename="{file_path.name}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode("utf-8")
+            + file_path.read_bytes()
+            + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# --- シナリオ ---
+
+
+class Outcome:
+    def __init__(
+        self, ok: bool, status: int, detail: str = "", job_id: Optional[str] = None
+    ):
+        self.ok = ok
+        self.status = status
+        self.detail = detail
+        # トレースを集計するためのジョブID。ジョブを実行しないエンドポイントではNone
+        self.job_id = job_id
+
+
+def _response_outcome(status: int, body: bytes, has_job: bool = False) -> Outcome:
+    if status == 200:
+        job_id = json.loads(body).get("job_id") if has_job else None
+        return Outcome(True, status, job_id=job_id)
+    return Outcome(False, status, body[:200].decode("utf-8", "replace"))
+
+
+def _job_outcome(client: Client, status: int, body: bytes) -> Outcome:
+    if status != 200:
+        return _response_outcome(status, body)
+    job_id = json.loads(body)["job_id"]
+    job = client.wait_for_job(job_id)
+    if job is None or job.get("status") != "complete":
+        return Outcome(False, status, (job or {}).get("detail", "job not found"))
+    return Outcome(True, status, job_id=job_id)
+
+
+def build_scenarios(args) -> dict[str, Callable[[Client, str], Outcome]]:
+    audio = audio_fixture(args.fixtures, args.audio_kind, args.audio_seconds)
+    video = video_fixture(args.fixtures, args.video_seconds, args.resolution)
+
+    def element_divide(client: Client, user_id: str) -> Outcome:
+        status, _, body = client.request(
+            "POST", "/api/element_divide", {"user_id": user_id}, audio
+        )
+        return _response_outcome(status, body, has_job=True)
+
+    def analyze(client: Client, user_id: str) -> Outcome:
+        status, _, body = client.request(
+            "POST", "/api/analyze", {"user_id": user_id}, audio
+        )
+        return _job_outcome(client, status, body)
+
+    def add_subtitle(client: Client, user_id: str) -> Outcome:
+        status, _, body = client.request(
+            "POST", "/api/add-subtitle", {"user_id": user_id}, video
+        )
+        return _job_outcome(client, status, body)
+
+    def mp4_to_mp3(client: Client, user_id: str) -> Outcome:
+        status, _, body = client.request(
+            "POST", "/api/mp4-to-mp3", {"user_id": user_id}, video
+        )
+        return _response_outcome(status, body)
+
+    def history(client: Client, user_id: str) -> Outcome:
+        status, _, body = client.request("GET", f"/api/history/{user_id}")
+        return _response_outcome(status, body)
+
+    return {
+        "element_divide": element_divide,
+        "analyze": analyze,
+        "add_subtitle": add_subtitle,
+        "mp4_to_mp3": mp4_to_mp3,
+        "history": history,
+    }
+
+
+def run_scenario(
+    client: Client,
+    endpoint: str,
+    scenario: Callable[[Client, str], Outcome],
+    concurrency: int,
+    requests: int,
+    server_pid: Optional[int],
+) -> dict:
+    run_id = uuid.uuid4().hex[:6]
+
+    def one(index: int) -> tuple[float, Outcome]:
+        # ユーザーごとの待ち行列の上限に掛からないよう、並列の数だけユーザーを分ける
+        user_id = f"bench-{run_id}-{index % concurrency}"
+        started = time.perf_counter()
+        try:
+            outcome = scenario(client, user_id)
+        except Exception as e:
+            outcome = Outcome(False, 0, str(e))
+        return time.perf_counter() - started, outcome
+
+    metrics_before = client.request("GET", "/metrics")[2]
+    with ResourceSampler(server_pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(requests)))
+        wall_seconds = time.perf_counter() - started
+    metrics_after = client.request("GET", "/metrics")[2]
+    traces = [
+        trace
+        for trace in (
+            fetch_trace(client, outcome.job_id)
+            for _, outcome in results
+            if outcome.job_id is not None
+        )
+        if trace is not None
+    ]
+
+    latencies = [seconds for seconds, outcome in results if outcome.ok]
+    rejected = sum(1 for _, outcome in results if outcome.status == 429)
+    errors = sorted({outcome.detail for _, outcome in results if not outcome.ok})
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": requests,
+        "succeeded": len(latencies),
+        "rejected": rejected,
+        "failed": requests - len(latencies) - rejected,
+        "errors": errors[:5],
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_second": round(len(latencies) / wall_seconds, 4),
+        "latency_seconds": summarize(latencies),
+        "server": sampler.result(),
+        "stages": diff_stage_histograms(
+            parse_stage_histograms(metrics_before.decode("utf-8", "replace")),
+            parse_stage_histograms(metrics_after.decode("utf-8", "replace")),
+        ),
+        "traced_jobs": len(traces),
+        "spans": summarize_trace_spans(traces),
+    }
+
+
+# --- サーバーの起動 ---
+
+
+def start_server(port: int, workdir: Path) -> subprocess.Popen:
+    """Geminiをスタンドインに差し替え、一時ディレクトリを共有ストレージとしてAPIを起動する"""
+    env = dict(
+        os.environ,
+        GEMINI_LIBRARY="bench.gemini_standin",
+        GOOGLE_API_KEY=os.getenv("GOOGLE_API_KEY", "bench"),
+        SHARED_STORAGE_DIR=str(workdir),
+        AUDILY_DB_PATH=str(workdir / "bench.db"),
+    )
+    core_dir = Path(__file__).resolve().parent.parent
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=core_dir,
+        env=env,
+        stdout=open(workdir / "server.log", "w"),
+        stderr=subprocess.STDOUT,
+    )
+    client = Client(f"http://127.0.0.1:{port}")
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"APIが起動しませんでした。ログ: {workdir / 'server.log'}")
+        try:
+            # モデルのウォームアップが終わるまで待つ
+            if client.request("GET", "/ready")[0] == 200:
+                return process
+        except urllib.error.URLError:
+            pass
+        time.sleep(1.0)
+    print("警告: 準備完了を待たずに計測を始めます。")
+    return process
+
+
+# --- 比較 ---
+
+
+def compare(base_path: Path, head_path: Path):
+    with open(base_path, "r", encoding="utf-8") as f:
+        base = {(r["endpoint"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(head_path, "r", encoding="utf-8") as f:
+        head = json.load(f)["results"]
+
+    print(f"{'endpoint':<16}{'conc':>5}{'p50':>18}{'p95':>18}{'throughput/s':>22}")
+    for result in head:
+        previous = base.get((result["endpoint"], result["concurrency"]))
+        if previous is None:
+            continue
+        cells = []
+        for new, old in (
+            (result["latency_seconds"]["p50"], previous["latency_seconds"]["p50"]),
+            (result["latency_seconds"]["p95"], previous["latency_seconds"]["p95"]),
+            (result["throughput_per_second"], previous["throughput_per_second"]),
+        ):
+            if new is None or not old:
+                cells.append("-")
+            else:
+                cells.append(f"{new:.3f} ({(new - old) / old * 100:+.1f}%)")
+        print(
+            f"{result['endpoint']:<16}{result['concurrency']:>5}"
+            f"{cells[0]:>18}{cells[1]:>18}{cells[2]:>22}"
+        )
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audilyのベンチマーク")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument(
+        "--start-server",
+        action="store_true",
+        help="スタンドインのGeminiを使うAPIを起動して計測する",
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--server-pid", type=int, help="既に起動しているAPIのPID (資源の計測用)"
+    )
+    parser.add_argument("--endpoints", default=",".join(DEFAULT_ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument(
+        "--requests", type=int, default=0, help="並列数ごとの件数 (既定は並列数の2倍)"
+    )
+    parser.add_argument("--fixtures", type=Path, default=Path("bench_fixtures"))
+    parser.add_argument("--audio-kind", choices=("tone", "noise"), default="tone")
+    parser.add_argument("--audio-seconds", type=int, default=30)
+    parser.add_argument("--video-seconds", type=int, default=10)
+    parser.add_argument("--resolution", default="640x360")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", nargs=2, type=Path, metavar=("BASE", "HEAD"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    endpoints = [name for name in args.endpoints.split(",") if name]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"未知のエンドポイントです: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",") if level]
+
+    server = None
+    server_pid = args.server_pid
+    base_url = args.base_url
+    if args.start_server:
+        workdir = Path(tempfile.mkdtemp(prefix="audily-bench-"))
+        print(f"APIを起動しています (作業ディレクトリ: {workdir})...")
+        server = start_server(args.port, workdir)
+        server_pid = server.pid
+        base_url = f"http://127.0.0.1:{args.port}"
+
+    client = Client(base_url)
+    scenarios = build_scenarios(args)
+    results = []
+    try:
+        for endpoint in endpoints:
+            for concurrency in levels:
+                requests = args.requests or concurrency * 2
+                print(f"計測中: {endpoint} (並列数 {concurrency}, {requests}件)...")
+                result = run_scenario(
+                    client,
+                    endpoint,
+                    scenarios[endpoint],
+                    concurrency,
+                    requests,
+                    server_pid,
+                )
+                latency = result["latency_seconds"]
+                print(
+                    f"  成功 {result['succeeded']}/{requests}, "
+                    f"p50 {latency['p50']}, p95 {latency['p95']}, "
+                    f"{result['throughput_per_second']}件/秒"
+                )
+                results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(30)
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": time.time(),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "settings": {
+            "audio": f"{args.audio_kind}_{args.audio_seconds}s",
+            "video": f"{args.resolution}_{args.video_seconds}s",
+            "gemini": "standin" if args.start_server else "server",
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(output, encoding="utf-8")
+        print(f"結果を保存しました: {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
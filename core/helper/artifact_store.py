@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+from helper.metrics import record_bytes
+from helper.shared_storage import shared_path
+
+ARTIFACT_STORE_DIR = Path(os.getenv("ARTIFACT_STORE_DIR", str(shared_path("artifacts"))))
+ARTIFACT_TTL_SECONDS = int(os.getenv("ARTIFACT_TTL_SECONDS", str(24 * 60 * 60)))
+ARTIFACT_QUOTA_BYTES = int(os.getenv("ARTIFACT_QUOTA_BYTES", str(5 * 1024**3)))
+ORPHAN_MAX_AGE_SECONDS = int(os.getenv("ORPHAN_MAX_AGE_SECONDS", str(6 * 60 * 60)))
+JANITOR_INTERVAL_SECONDS = int(os.getenv("JANITOR_INTERVAL_SECONDS", "600"))
+
+META_SUFFIX = ".meta.json"
+
+
+def _is_safe_name(name: str) -> bool:
+    return bool(name) and ".." not in name and "/" not in name and "\\" not in name
+
+
+def _meta_path(artifact_path: Path) -> Path:
+    return artifact_path.with_name(artifact_path.name + META_SUFFIX)
+
+
+def _read_meta(artifact_path: Path) -> Optional[dict]:
+    try:
+        with open(_meta_path(artifact_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _write_meta(artifact_path: Path, meta: dict):
+    meta_path = _meta_path(artifact_path)
+    tmp_path = meta_path.with_name(f".{meta_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+
+def store_artifact(
+    source_path: Path,
+    namespace: str,
+    name: str,
+    media_type: str = "application/octet-stream",
+    ttl_seconds: Optional[int] = None,
+) -> Path:
+    """成果物をストアへ移動し、容量上限を超えていれば古いものから削除する"""
+    if not _is_safe_name(namespace) or not _is_safe_name(name):
+        raise ValueError(f"無効な成果物名です: {namespace}/{name}")
+
+    namespace_dir = ARTIFACT_STORE_DIR / namespace
+    namespace_dir.mkdir(parents=True, exist_ok=True)
+    artifact_path = namespace_dir / name
+    shutil.move(str(source_path), artifact_path)
+    record_bytes("out", artifact_path.stat().st_size)
+    _register(artifact_path, media_type, ttl_seconds)
+    return artifact_path
+
+
+def retain_file(
+    source_path: Path,
+    namespace: str,
+    name: str,
+    media_type: str = "application/octet-stream",
+    move: bool = False,
+) -> Path:
+    """入力ファイルを成果物と同じ容量上限・有効期限で保持する。出力としては計上しない。
+    既定では元のファイルを残してハードリンクで保存し、別のファイルシステム上ならOSErrorを送出する
+    (大きな動画を同期でコピーしないため)。move=Trueでは元のファイルを移動する"""
+    if not _is_safe_name(namespace) or not _is_safe_name(name):
+        raise ValueError(f"無効な成果物名です: {namespace}/{name}")
+
+    namespace_dir = ARTIFACT_STORE_DIR / namespace
+    namespace_dir.mkdir(parents=True, exist_ok=True)
+    artifact_path = namespace_dir / name
+    if move:
+        shutil.move(str(source_path), artifact_path)
+    else:
+        try:
+            os.link(source_path, artifact_path)
+        except FileExistsError:
+            pass
+    _register(artifact_path, media_type, None)
+    return artifact_path
+
+
+def _register(artifact_path: Path, media_type: str, ttl_seconds: Optional[int]):
+    now = time.time()
+    size = artifact_path.stat().st_size
+    _write_meta(
+        artifact_path,
+        {
+            "media_type": media_type,
+            "size": size,
+            "created_at": now,
+            "last_access": now,
+            "expires_at": now + (ttl_seconds or ARTIFACT_TTL_SECONDS),
+        },
+    )
+    print(f"成果物を保存しました: {artifact_path}")
+
+    # 保存したばかりの成果物は、それ単体で容量を超えていても削除しない
+    enforce_quota(keep=artifact_path)
+
+
+def get_artifact(namespace: str, name: str) -> Optional[tuple[Path, dict]]:
+    if not _is_safe_name(namespace) or not _is_safe_name(name):
+        return None
+    artifact_path = ARTIFACT_STORE_DIR / namespace / name
+    meta = _read_meta(artifact_path)
+    if meta is None or not artifact_path.exists():
+        return None
+    if meta["expires_at"] < time.time():
+        delete_artifact(artifact_path)
+        return None
+
+    meta["last_access"] = time.time()
+    try:
+        _write_meta(artifact_path, meta)
+    except OSError as e:
+        print(f"警告: 成果物のアクセス時刻を更新できませんでした: {e}")
+    return artifact_path, meta
+
+
+def delete_artifact(artifact_path: Path):
+    for path in (artifact_path, _meta_path(artifact_path)):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+    print(f"クリーンアップ: 成果物 {artifact_path} を削除しました。")
+
+
+def _iter_artifacts():
+    if not ARTIFACT_STORE_DIR.exists():
+        return
+    for meta_path in ARTIFACT_STORE_DIR.glob(f"*/*{META_SUFFIX}"):
+        artifact_path = meta_path.with_name(meta_path.name[: -len(META_SUFFIX)])
+        meta = _read_meta(artifact_path)
+        if meta is not None:
+            yield artifact_path, meta
+
+
+def sweep_expired_artifacts() -> int:
+    now = time.time()
+    removed = 0
+    for artifact_path, meta in list(_iter_artifacts()):
+        if meta["expires_at"] < now or not artifact_path.exists():
+            delete_artifact(artifact_path)
+            removed += 1
+    return removed
+
+
+def enforce_quota(keep: Optional[Path] = None) -> int:
+    artifacts = list(_iter_artifacts())
+    total_size = sum(meta["size"] for _, meta in artifacts)
+    removed = 0
+    # 最終アクセスが古いものから順に削除する (LRU)
+    for artifact_path, meta in sorted(artifacts, key=lambda a: a[1]["last_access"]):
+        if total_size <= ARTIFACT_QUOTA_BYTES:
+            break
+        if artifact_path == keep:
+            continue
+        delete_artifact(artifact_path)
+        total_size -= meta["size"]
+        removed += 1
+    return removed
+
+
+def sweep_orphaned_paths(directories: list[Path], max_age_seconds: int = None) -> int:
+    """作業ディレクトリに残った、一定時間更新されていないファイルやディレクトリを削除する"""
+    max_age_seconds = max_age_seconds or ORPHAN_MAX_AGE_SECONDS
+    threshold = time.time() - max_age_seconds
+    removed = 0
+    for directory in directories:
+        if not directory.exists():
+            continue
+        for entry in directory.iterdir():
+            try:
+                if entry.stat().st_mtime > threshold:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry)
+                else:
+                    entry.unlink()
+                removed += 1
+                print(f"クリーンアップ: 放置された作業ファイル {entry} を削除しました。")
+            except OSError as e:
+                print(f"クリーンアップエラー: {entry} の削除に失敗しました - {e}")
+    return removed
+
+
+def run_janitor_once(orphan_dirs: list[Path], retained_dirs: list[Path]):
+    expired = sweep_expired_artifacts()
+    evicted = enforce_quota()
+    orphans = sweep_orphaned_paths(orphan_dirs)
+    retained = sweep_orphaned_paths(retained_dirs, ARTIFACT_TTL_SECONDS)
+    if expired or evicted or orphans or retained:
+        print(
+            f"INFO: クリーンアップ完了 (期限切れ: {expired}, 容量超過: {evicted}, "
+            f"放置ファイル: {orphans + retained})"
+        )
+
+
+async def run_janitor(orphan_dirs: list[Path], retained_dirs: list[Path]):
+    """期限切れの成果物と放置された作業ディレクトリを定期的に削除する"""
+    while True:
+        try:
+            await asyncio.to_thread(run_janitor_once, orphan_dirs, retained_dirs)
+        except Exception as e:
+            print(f"ERROR: 定期クリーンアップ中にエラーが発生しました: {e}")
+        await asyncio.sleep(JANITOR_INTERVAL_SECONDS)
@@ -1,11 +1,20 @@
 import subprocess
 from pathlib import Path
+from typing import Callable, Optional
+
+from helper.ffmpeg_runner import probe_duration, run_ffmpeg_with_progress
+from helper.metrics import track_stage
+from helper.thread_budget import ffmpeg_thread_args
 
 
 class AudioExtractor:
 
     @staticmethod
-    def extract_audio(input_path: Path, output_path: Path):
+    def extract_audio(
+        input_path: Path,
+        output_path: Path,
+        progress_callback: Optional[Callable[[float], None]] = None,
+    ):
 
         command = [
             "ffmpeg",
@@ -18,11 +27,14 @@ class AudioExtractor:
             "16000",
             "-ac",
             "1",
+            *ffmpeg_thread_args(),
             str(output_path),
         ]
         print(f"FFmpegで音声を抽出しています: {' '.join(command)}")
+        total_seconds = probe_duration(input_path) if progress_callback else None
         try:
-            subprocess.run(command, check=True, capture_output=True, text=True)
+            with track_stage("ffmpeg_extract"):
+                run_ffmpeg_with_progress(command, total_seconds, progress_callback)
             print("音声の抽出が完了しました。")
         except FileNotFoundError:
             raise RuntimeError(
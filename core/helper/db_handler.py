@@ -1,12 +1,46 @@
+import base64
+import json
+import os
 import sqlite3
+import threading
+import weakref
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from typing import Optional
+
+from helper.history_writer import history_writer
 
 JST = timezone(timedelta(hours=9), "JST")
 
 this_file_path = Path(__file__).resolve()
 project_root_dir = this_file_path.parent.parent.parent
-DB_PATH = project_root_dir / "client" / "audily.db"
+DB_PATH = Path(os.getenv("AUDILY_DB_PATH", str(project_root_dir / "client" / "audily.db")))
+
+# Next.jsの認証テーブルと同じDBを共有するため、ロック待ちはタイムアウトまで待機させる
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 16 * 1024
+# WALはDBファイル自体の設定として残り、Next.js側の接続にも影響して -wal/-shm ファイルも
+# 作られるため、クライアント側と合意した環境でだけ有効にする
+SQLITE_WAL_ENABLED = os.getenv("AUDILY_DB_WAL", "0") == "1"
+STATEMENT_CACHE_SIZE = 256
+
+INSERT_OPERATION_SQL = """
+INSERT INTO operation_history (user_id, operation_type, source_filename, status, created_at)
+VALUES (?, ?, ?, ?, ?);
+"""
+
+SELECT_HISTORY_SUMMARY_SQL = """
+SELECT operation_type, status_group, count
+FROM operation_history_counts
+WHERE user_id = ?;
+"""
+
+HISTORY_PAGE_MAX_LIMIT = 200
+
+# PRAGMA user_versionに記録する、このモジュールが適用したスキーマの版。
+# Next.js側はuser_versionを使わないため、移行処理の実行済みの判定に使う
+# 1: created_atをTEXTに統一  2: 集計を削除・更新にも追従させ、作り直す
+SCHEMA_VERSION = 2
 
 
 def adapt_datetime_to_iso(dt: datetime):
@@ -14,34 +48,99 @@ def adapt_datetime_to_iso(dt: datetime):
         return None
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=JST)
-    return dt.isoformat().encode("utf8")
+    return dt.isoformat()
 
 
 sqlite3.register_adapter(datetime, adapt_datetime_to_iso)
 
+_local = threading.local()
+_connections_lock = threading.Lock()
+_connections: dict[int, sqlite3.Connection] = {}
+_db_path_checked = False
+
+
+class _ConnectionHolder:
+    """スレッドごとの接続。スレッドが終了して破棄されると、接続も閉じる"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.pid = os.getpid()
+        weakref.finalize(self, _close_connection, id(conn), self.pid)
+
+
+def _close_connection(key: int, pid: int):
+    # fork前の接続は親プロセスのものなので、子プロセスでは閉じない
+    if pid != os.getpid():
+        return
+    with _connections_lock:
+        conn = _connections.pop(key, None)
+    if conn is not None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
 
 def create_connection():
-    print(f"DEBUG: データベースに接続しようとしています: {DB_PATH}")
-    if not DB_PATH.exists():
-        print(
-            f"ERROR: データベースファイルが見つかりません。パスを確認してください: {DB_PATH}"
-        )
-        if not DB_PATH.parent.exists():
+    global _db_path_checked
+    if not _db_path_checked:
+        if not DB_PATH.exists():
             print(
-                f"ERROR: データベースファイルの親ディレクトリが存在しません: {DB_PATH.parent}"
+                f"ERROR: データベースファイルが見つかりません。パスを確認してください: {DB_PATH}"
             )
-        return None
+            if not DB_PATH.parent.exists():
+                print(
+                    f"ERROR: データベースファイルの親ディレクトリが存在しません: {DB_PATH.parent}"
+                )
+            return None
+        _db_path_checked = True
     try:
-        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn = sqlite3.connect(
+            DB_PATH,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS};")
+        if SQLITE_WAL_ENABLED:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            # WALではNORMALでもクラッシュ時の整合性は保たれ、コミット毎のfsyncを省ける
+            conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB};")
+        conn.execute("PRAGMA temp_store=MEMORY;")
         return conn
     except sqlite3.Error as e:
         print(f"ERROR: データベース接続エラー: {e}")
         return None
 
 
-def setup_database():
+def get_connection():
+    """スレッド(プロセス)ごとに接続を使い回す。fork後の子プロセスでは新しく接続し直す"""
+    holder = getattr(_local, "holder", None)
+    if holder is not None and holder.pid == os.getpid():
+        return holder.conn
 
     conn = create_connection()
+    if conn:
+        with _connections_lock:
+            _connections[id(conn)] = conn
+        _local.holder = _ConnectionHolder(conn)
+    return conn
+
+
+def close_all_connections():
+    with _connections_lock:
+        for conn in _connections.values():
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+
+
+def setup_database():
+
+    conn = get_connection()
     if conn:
         try:
             cursor = conn.cursor()
@@ -59,65 +158,252 @@ def setup_database():
             );
             """
             )
+            schema_version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+            if schema_version < 1:
+                # 以前はcreated_atがBLOBで保存されていたため、範囲比較できるようTEXTに揃える。
+                # 全件を走査するため、起動のたびには行わない
+                cursor.execute(
+                    """
+                UPDATE operation_history SET created_at = CAST(created_at AS TEXT)
+                WHERE typeof(created_at) = 'blob';
+                """
+                )
+            cursor.execute(
+                """
+            CREATE INDEX IF NOT EXISTS idx_operation_history_user_created
+            ON operation_history (user_id, created_at);
+            """
+            )
+
+            # ユーザーごとの集計はトリガーで維持し、参照時に履歴を走査しない
+            cursor.execute(
+                """
+            CREATE TABLE IF NOT EXISTS operation_history_counts (
+                user_id TEXT NOT NULL,
+                operation_type TEXT NOT NULL,
+                status_group TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, operation_type, status_group)
+            ) WITHOUT ROWID;
+            """
+            )
+            cursor.execute(
+                """
+            CREATE TRIGGER IF NOT EXISTS trg_operation_history_counts
+            AFTER INSERT ON operation_history
+            BEGIN
+                INSERT INTO operation_history_counts (user_id, operation_type, status_group, count)
+                VALUES (
+                    NEW.user_id,
+                    NEW.operation_type,
+                    CASE WHEN NEW.status LIKE 'failed%' THEN 'failed' ELSE NEW.status END,
+                    1
+                )
+                ON CONFLICT (user_id, operation_type, status_group)
+                DO UPDATE SET count = count + 1;
+            END;
+            """
+            )
+            # 履歴の削除・更新 (Next.js側からの操作を含む) でも集計がずれないようにする
+            cursor.execute(
+                """
+            CREATE TRIGGER IF NOT EXISTS trg_operation_history_counts_delete
+            AFTER DELETE ON operation_history
+            BEGIN
+                UPDATE operation_history_counts SET count = count - 1
+                WHERE user_id = OLD.user_id
+                    AND operation_type = OLD.operation_type
+                    AND status_group = CASE WHEN OLD.status LIKE 'failed%' THEN 'failed' ELSE OLD.status END;
+                DELETE FROM operation_history_counts WHERE user_id = OLD.user_id AND count <= 0;
+            END;
+            """
+            )
+            cursor.execute(
+                """
+            CREATE TRIGGER IF NOT EXISTS trg_operation_history_counts_update
+            AFTER UPDATE OF user_id, operation_type, status ON operation_history
+            BEGIN
+                UPDATE operation_history_counts SET count = count - 1
+                WHERE user_id = OLD.user_id
+                    AND operation_type = OLD.operation_type
+                    AND status_group = CASE WHEN OLD.status LIKE 'failed%' THEN 'failed' ELSE OLD.status END;
+                DELETE FROM operation_history_counts WHERE user_id = OLD.user_id AND count <= 0;
+                INSERT INTO operation_history_counts (user_id, operation_type, status_group, count)
+                VALUES (
+                    NEW.user_id,
+                    NEW.operation_type,
+                    CASE WHEN NEW.status LIKE 'failed%' THEN 'failed' ELSE NEW.status END,
+                    1
+                )
+                ON CONFLICT (user_id, operation_type, status_group)
+                DO UPDATE SET count = count + 1;
+            END;
+            """
+            )
+            if schema_version < 2:
+                # 削除・更新のトリガーが無かった間にずれた集計を、履歴から作り直す
+                cursor.execute("DELETE FROM operation_history_counts;")
+                cursor.execute(
+                    """
+                INSERT INTO operation_history_counts (user_id, operation_type, status_group, count)
+                SELECT
+                    user_id,
+                    operation_type,
+                    CASE WHEN status LIKE 'failed%' THEN 'failed' ELSE status END AS status_group,
+                    COUNT(*)
+                FROM operation_history
+                GROUP BY user_id, operation_type, status_group;
+                """
+                )
+            if schema_version < SCHEMA_VERSION:
+                cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
             conn.commit()
             print("INFO: 'operation_history' テーブルの準備が完了しました。")
         except sqlite3.Error as e:
+            conn.rollback()
             print(f"ERROR: テーブル作成エラー: {e}")
-        finally:
-            conn.close()
-
 
-def log_operation(user_id: str, operation_type: str, source_filename: str, status: str):
 
-    conn = create_connection()
+def write_operation_rows(rows: list[tuple]):
+    """(user_id, operation_type, source_filename, status, created_at) を1トランザクションで書き込む"""
+    conn = get_connection()
     if conn:
         try:
-            current_time_jst = datetime.now(JST)
-
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-            INSERT INTO operation_history (user_id, operation_type, source_filename, status, created_at)
-            VALUES (?, ?, ?, ?, ?);
-            """,
-                (user_id, operation_type, source_filename, status, current_time_jst),
-            )
-            conn.commit()
-            print(
-                f"INFO: 履歴を記録しました: User({user_id}), Op({operation_type}), File({source_filename}), Time({current_time_jst.isoformat()})"
-            )
+            with conn:
+                conn.executemany(INSERT_OPERATION_SQL, rows)
+            print(f"INFO: 履歴を{len(rows)}件記録しました。")
         except sqlite3.Error as e:
             print(f"ERROR: 履歴の記録に失敗しました: {e}")
-        finally:
-            conn.close()
 
 
-def get_history_by_user_id(user_id: str) -> list:
+def log_operation(user_id: str, operation_type: str, source_filename: str, status: str):
+    # 書き込みスレッドが動いていればキューに積むだけで、ディスク同期を待たない
+    current_time_jst = datetime.now(JST)
+    rows = [(user_id, operation_type, source_filename, status, current_time_jst)]
+    if history_writer.is_running:
+        history_writer.submit(rows)
+    else:
+        write_operation_rows(rows)
+    print(
+        f"INFO: 履歴を記録しました: User({user_id}), Op({operation_type}), File({source_filename}), Time({current_time_jst.isoformat()})"
+    )
 
-    conn = create_connection()
+
+def encode_history_cursor(created_at: str, record_id: int) -> str:
+    raw = json.dumps([created_at, record_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_history_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        created_at, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(created_at), int(record_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"無効なカーソルです: {cursor}") from e
+
+
+def _to_jst_iso(value: datetime) -> str:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=JST)
+    return value.astimezone(JST).isoformat()
+
+
+def get_history_page(
+    user_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    operation_type: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> tuple[list, Optional[str]]:
+    """(user_id, created_at) インデックスを使ったキーセットページングで履歴を取得する。
+    limitを指定しなければ、従来通り条件に合う全件を返す"""
+    if limit is not None:
+        limit = max(1, min(limit, HISTORY_PAGE_MAX_LIMIT))
+    conditions = ["user_id = ?"]
+    params: list = [user_id]
+
+    if cursor:
+        cursor_created_at, cursor_id = decode_history_cursor(cursor)
+        conditions.append("(created_at < ? OR (created_at = ? AND id < ?))")
+        params.extend([cursor_created_at, cursor_created_at, cursor_id])
+    if operation_type:
+        conditions.append("operation_type = ?")
+        params.append(operation_type)
+    if status:
+        # "failed" は "failed: RuntimeError" なども含める
+        conditions.append("(status = ? OR status LIKE ?)")
+        params.extend([status, f"{status}:%"])
+    if since:
+        conditions.append("created_at >= ?")
+        params.append(_to_jst_iso(since))
+    if until:
+        conditions.append("created_at < ?")
+        params.append(_to_jst_iso(until))
+
+    query = f"""
+    SELECT id, operation_type, source_filename, status, created_at
+    FROM operation_history
+    WHERE {" AND ".join(conditions)}
+    ORDER BY created_at DESC, id DESC
+    LIMIT ?;
+    """
+    # SQLiteではLIMIT -1で件数を制限しない
+    params.append(-1 if limit is None else limit + 1)
+
+    conn = get_connection()
     if not conn:
-        return []
+        return [], None
 
-    conn.row_factory = sqlite3.Row
     history_records = []
-
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-        SELECT id, operation_type, source_filename, status, created_at
-        FROM operation_history
-        WHERE user_id = ?
-        ORDER BY created_at DESC;
-        """,
-            (user_id,),
-        )
-        rows = cursor.fetchall()
-        history_records = [dict(row) for row in rows]
+        db_cursor = conn.cursor()
+        db_cursor.row_factory = sqlite3.Row
+        db_cursor.execute(query, params)
+        history_records = [dict(row) for row in db_cursor.fetchall()]
     except sqlite3.Error as e:
         print(f"ERROR: 履歴の取得に失敗しました: {e}")
-    finally:
-        if conn:
-            conn.close()
+        return [], None
+
+    next_cursor = None
+    if limit is not None and len(history_records) > limit:
+        history_records = history_records[:limit]
+        last = history_records[-1]
+        next_cursor = encode_history_cursor(last["created_at"], last["id"])
+    return history_records, next_cursor
+
+
+def get_history_summary(user_id: str) -> dict:
+
+    conn = get_connection()
+    if not conn:
+        return {}
+
+    summary: dict = {"total": 0, "by_operation": {}}
+    try:
+        for operation_type, status_group, count in conn.execute(
+            SELECT_HISTORY_SUMMARY_SQL, (user_id,)
+        ):
+            operation_summary = summary["by_operation"].setdefault(
+                operation_type, {"total": 0}
+            )
+            operation_summary[status_group] = count
+            operation_summary["total"] += count
+            summary["total"] += count
+    except sqlite3.Error as e:
+        print(f"ERROR: 履歴の集計に失敗しました: {e}")
+    return summary
+
+
+def log_operations(records: list[tuple[str, str, str, str]]):
+    """(user_id, operation_type, source_filename, status) のリストを1トランザクションで記録する"""
+    if not records:
+        return
 
-    return history_records
+    current_time_jst = datetime.now(JST)
+    rows = [(*record, current_time_jst) for record in records]
+    if history_writer.is_running:
+        history_writer.submit(rows)
+    else:
+        write_operation_rows(rows)
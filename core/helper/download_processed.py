@@ -1,7 +1,9 @@
 from pathlib import Path
+from typing import Optional
+from urllib.parse import quote
 
-from fastapi import HTTPException
-from fastapi.responses import FileResponse
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 
 
 def create_download_response(
@@ -19,3 +21,69 @@ def create_download_response(
     return FileResponse(
         path=file_path, media_type="application/octet-stream", filename=filename
     )
+
+
+RANGE_CHUNK_SIZE = 1024 * 1024
+
+
+def _parse_range_header(range_header: str, file_size: int) -> Optional[tuple[int, int]]:
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+    start_text, _, end_text = ranges.strip().partition("-")
+    if start_text:
+        start = int(start_text)
+        end = int(end_text) if end_text else file_size - 1
+    else:
+        # "bytes=-500" は末尾500バイト
+        start = max(file_size - int(end_text), 0)
+        end = file_size - 1
+    if start > end or start >= file_size:
+        raise ValueError("範囲外のRangeです。")
+    return start, min(end, file_size - 1)
+
+
+def _iter_file_range(file_path: Path, start: int, end: int):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def create_ranged_file_response(
+    request: Request, file_path: Path, media_type: str, filename: str
+) -> Response:
+    """Rangeヘッダーに対応したダウンロードレスポンスを返す (中断したダウンロードの再開用)"""
+    file_size = file_path.stat().st_size
+    range_header = request.headers.get("range")
+
+    try:
+        byte_range = _parse_range_header(range_header, file_size) if range_header else None
+    except ValueError:
+        return Response(
+            status_code=416, headers={"Content-Range": f"bytes */{file_size}"}
+        )
+
+    if byte_range is None:
+        response = FileResponse(path=file_path, media_type=media_type, filename=filename)
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
+
+    start, end = byte_range
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Range": f"bytes {start}-{end}/{file_size}",
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": f"attachment; filename*=utf-8''{quote(filename)}",
+    }
+    return StreamingResponse(
+        _iter_file_range(file_path, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers=headers,
+    )
@@ -0,0 +1,153 @@
+import os
+import re
+import subprocess
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+
+from helper.tracing import span
+
+
+# フィルター引数の中のパス (subtitles='/…/x.ass' や FontFile=/…/font.ttf)
+_EMBEDDED_PATH_PATTERN = re.compile(r"(?<=[='])(?:[A-Za-z]:)?[\\/][^':,]*")
+
+# (デバイス, inode, サイズ, 更新時刻) -> 長さ。1つのジョブで同じファイルを何度もffprobeしないようにする。
+# 常駐するプロセスでは件数が増え続けるため、最近使ったものだけを残す (LRU)
+DURATION_CACHE_MAX_ENTRIES = int(os.getenv("DURATION_CACHE_MAX_ENTRIES", "1024"))
+_duration_cache: OrderedDict[tuple, float] = OrderedDict()
+_duration_cache_lock = threading.Lock()
+
+
+def _file_key(input_path: Path) -> Optional[tuple]:
+    try:
+        stat = os.stat(input_path)
+    except OSError:
+        return None
+    # inodeで見るので、ハードリンクで渡されたファイルも同じものとして扱える
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _get_cached_duration(key: Optional[tuple]) -> Optional[float]:
+    if key is None:
+        return None
+    with _duration_cache_lock:
+        seconds = _duration_cache.get(key)
+        if seconds is not None:
+            _duration_cache.move_to_end(key)
+        return seconds
+
+
+def _cache_duration(key: Optional[tuple], seconds: float):
+    if key is None:
+        return
+    with _duration_cache_lock:
+        _duration_cache[key] = seconds
+        _duration_cache.move_to_end(key)
+        while len(_duration_cache) > DURATION_CACHE_MAX_ENTRIES:
+            _duration_cache.popitem(last=False)
+
+
+def remember_duration(input_path: Path, seconds: float):
+    """別のプロセスで調べ済みの長さを登録し、このプロセスでのffprobeを省く"""
+    _cache_duration(_file_key(input_path), seconds)
+
+
+def probe_duration(input_path: Path) -> Optional[float]:
+    key = _file_key(input_path)
+    cached = _get_cached_duration(key)
+    if cached is not None:
+        return cached
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        str(input_path),
+    ]
+    try:
+        with span("ffprobe", input=Path(input_path).name):
+            result = subprocess.run(
+                command, check=True, capture_output=True, text=True
+            )
+        seconds = float(result.stdout.strip())
+    except (FileNotFoundError, subprocess.CalledProcessError, ValueError):
+        return None
+    _cache_duration(key, seconds)
+    return seconds
+
+
+def run_ffmpeg_with_progress(
+    command: list[str],
+    total_seconds: Optional[float] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> subprocess.CompletedProcess:
+    """ffmpegを実行し、-progress出力から進捗率(0-100)をコールバックに通知する"""
+    with span("ffmpeg", argv=_redact_paths(command)):
+        return _run_ffmpeg(command, total_seconds, on_progress)
+
+
+def _redact_paths(command: list[str]) -> list[str]:
+    """トレースはAPIから取得できるため、サーバー上のパスを除いた引数だけを記録する"""
+    redacted = []
+    for index, arg in enumerate(command):
+        is_input = index > 0 and command[index - 1] == "-i"
+        is_output = index > 0 and index == len(command) - 1
+        if is_input or is_output or os.path.isabs(arg):
+            redacted.append("<path>")
+        else:
+            redacted.append(_EMBEDDED_PATH_PATTERN.sub("<path>", arg))
+    return redacted
+
+
+def _run_ffmpeg(
+    command: list[str],
+    total_seconds: Optional[float],
+    on_progress: Optional[Callable[[float], None]],
+) -> subprocess.CompletedProcess:
+    if not on_progress or not total_seconds:
+        return subprocess.run(
+            command, check=True, capture_output=True, text=True, encoding="utf-8"
+        )
+
+    progress_command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    process = subprocess.Popen(
+        progress_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+    )
+
+    # stderrを別スレッドで読み捨てないとパイプが詰まってffmpegが停止する
+    stderr_chunks: list[str] = []
+    stderr_reader = threading.Thread(
+        target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True
+    )
+    stderr_reader.start()
+
+    stdout_lines: list[str] = []
+    for line in process.stdout:
+        stdout_lines.append(line)
+        key, _, value = line.strip().partition("=")
+        if key in ("out_time_us", "out_time_ms") and value.isdigit():
+            # ffmpegはout_time_msもマイクロ秒で出力する
+            percent = int(value) / 1_000_000 / total_seconds * 100
+            on_progress(min(percent, 100.0))
+        elif key == "progress" and value == "end":
+            on_progress(100.0)
+
+    returncode = process.wait()
+    stderr_reader.join()
+    stdout = "".join(stdout_lines)
+    stderr = "".join(stderr_chunks)
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(
+            returncode, progress_command, output=stdout, stderr=stderr
+        )
+    return subprocess.CompletedProcess(progress_command, returncode, stdout, stderr)
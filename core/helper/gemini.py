@@ -1,11 +1,27 @@
+import importlib
 import os
 import time
 from pathlib import Path
 from typing import List, Optional, Union
 
-import google.generativeai as genai
 from dotenv import load_dotenv
 
+from helper.metrics import track_stage
+from helper.readiness import register_resource
+from helper.tracing import span
+
+
+# ベンチマークでは bench.gemini_standin に差し替え、APIを呼ばずに計測する
+GEMINI_LIBRARY = os.getenv("GEMINI_LIBRARY", "google.generativeai")
+
+
+def _import_genai():
+    return importlib.import_module(GEMINI_LIBRARY)
+
+
+# google.generativeaiの読み込みは重いため、初回利用時かウォームアップ時に行う
+gemini_library = register_resource("gemini", _import_genai)
+
 
 class GeminiProcessor:
 
@@ -16,6 +32,7 @@ class GeminiProcessor:
             raise ValueError(
                 "GOOGLE_API_KEYが見つかりません。.envファイルを確認してください。"
             )
+        genai = gemini_library.get()
         genai.configure(api_key=self.api_key)
         self.model_name = model_name
         try:
@@ -30,9 +47,14 @@ class GeminiProcessor:
     def generate_response(
         self, user_prompt: str, file_path: Optional[str] = None
     ) -> str:
+        with span("gemini.generate_response", model=self.model_name):
+            return self._generate_response(user_prompt, file_path)
+
+    def _generate_response(self, user_prompt: str, file_path: Optional[str]) -> str:
         if not user_prompt or not isinstance(user_prompt, str):
             raise TypeError("プロンプトは空でない文字列である必要があります。")
 
+        genai = gemini_library.get()
         uploaded_file = None
         if file_path:
             path = Path(file_path)
@@ -43,16 +65,18 @@ class GeminiProcessor:
 
             print(f"ファイルをアップロードしています: {file_path}...")
             try:
-                uploaded_file_response = genai.upload_file(path=file_path)
+                with track_stage("gemini_upload"):
+                    uploaded_file_response = genai.upload_file(path=file_path)
                 print(f"アップロード開始。ファイルID: {uploaded_file_response.name}")
 
                 print("サーバー側でのファイル処理を待機しています...")
-                while uploaded_file_response.state.name == "PROCESSING":
-                    time.sleep(5)  # 5秒待機
-                    uploaded_file_response = genai.get_file(
-                        name=uploaded_file_response.name
-                    )
-                    print(f"  - 現在の状態: {uploaded_file_response.state.name}")
+                with track_stage("gemini_processing_wait"):
+                    while uploaded_file_response.state.name == "PROCESSING":
+                        time.sleep(5)  # 5秒待機
+                        uploaded_file_response = genai.get_file(
+                            name=uploaded_file_response.name
+                        )
+                        print(f"  - 現在の状態: {uploaded_file_response.state.name}")
 
                 if uploaded_file_response.state.name == "FAILED":
                     raise ValueError(
@@ -73,7 +97,8 @@ class GeminiProcessor:
             else:
                 contents: List[Union[str, object]] = [user_prompt]
 
-            response = self.model.generate_content(contents)
+            with track_stage("gemini_generation"):
+                response = self.model.generate_content(contents)
             return response.text
 
         except Exception as e:
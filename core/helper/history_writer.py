@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+# 件数か経過時間のどちらかに達した時点でまとめて書き込む
+FLUSH_BATCH_SIZE = int(os.getenv("HISTORY_FLUSH_BATCH_SIZE", "50"))
+FLUSH_INTERVAL_SECONDS = float(os.getenv("HISTORY_FLUSH_INTERVAL_SECONDS", "1.0"))
+
+_STOP = "__stop__"
+
+
+class HistoryWriter:
+    """履歴イベントをプロセス間共有のキューから受け取り、バッチでDBへ書き込む"""
+
+    def __init__(self):
+        # forkで生成されるワーカープロセスはこのキューを引き継いでそのまま書き込める
+        self.queue = multiprocessing.Queue()
+        self.owner_pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.owner_pid is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.owner_pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name="history-writer", daemon=True
+        )
+        self._thread.start()
+        print("INFO: 履歴書き込みスレッドを開始しました。")
+
+    def submit(self, rows: list[tuple]):
+        """同じ呼び出しで渡された行は必ず同じトランザクションで書き込まれる"""
+        self.queue.put(rows)
+
+    def stop(self, timeout: float = 10.0):
+        if self._thread is None or self.owner_pid != os.getpid():
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self.owner_pid = None
+        print("INFO: 履歴書き込みスレッドを停止しました。")
+
+    def _run(self):
+        from helper.db_handler import write_operation_rows
+
+        batch = []
+        deadline = None
+        stopping = False
+        while not stopping:
+            if deadline is None:
+                timeout = FLUSH_INTERVAL_SECONDS
+            else:
+                timeout = max(deadline - time.monotonic(), 0.0)
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item == _STOP:
+                    stopping = True
+                else:
+                    if not batch:
+                        deadline = time.monotonic() + FLUSH_INTERVAL_SECONDS
+                    batch.extend(item)
+            except queue.Empty:
+                pass
+
+            if batch and (
+                stopping
+                or len(batch) >= FLUSH_BATCH_SIZE
+                or time.monotonic() >= deadline
+            ):
+                write_operation_rows(batch)
+                batch = []
+                deadline = None
+
+        # 停止要求より後に届いたイベントも書き残す
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item != _STOP:
+                batch.extend(item)
+        if batch:
+            write_operation_rows(batch)
+
+
+history_writer = HistoryWriter()
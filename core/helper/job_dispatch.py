@@ -0,0 +1,60 @@
+import math
+from typing import Optional
+
+from helper.job_progress import load_stage_durations
+from helper.job_queue import JOB_EXECUTION_MODE, job_queue
+from helper.job_registry import job_registry
+from helper.job_scheduler import (
+    DEFAULT_HOLD_SECONDS,
+    MAX_QUEUED_PER_POOL,
+    MAX_QUEUED_PER_USER,
+    MAX_RETRY_AFTER_SECONDS,
+    SchedulerBusy,
+    job_scheduler,
+)
+
+
+def is_queue_mode() -> bool:
+    return JOB_EXECUTION_MODE == "queue"
+
+
+def check_admission(user_id: str, kind: str, pool: str):
+    """待ち行列が一杯ならSchedulerBusy(429)を送出する"""
+    if not is_queue_mode():
+        job_scheduler.check_admission(user_id, pool)
+        return
+
+    pending = job_queue.count_pending(kind)
+    if pending < MAX_QUEUED_PER_POOL and (
+        job_queue.count_pending(kind, user_id) < MAX_QUEUED_PER_USER
+    ):
+        return
+    # ワーカー数はAPIから分からないため、1件分の過去の処理時間を目安にする
+    job_seconds = sum(load_stage_durations().get(kind, {}).values())
+    retry_after = math.ceil(job_seconds or DEFAULT_HOLD_SECONDS)
+    raise SchedulerBusy(pool, max(1, min(retry_after, MAX_RETRY_AFTER_SECONDS)))
+
+
+def dispatch_job(
+    job_id: str, user_id: Optional[str], kind: str, pool: str, target, args: tuple
+):
+    """local: このプロセスからワーカーを起動する / queue: ジョブキューに積み、worker.pyに実行させる。
+    queueモードではtargetとargsはJSONで保存されるため、Path・文字列・数値・リスト・辞書に限る"""
+    if not is_queue_mode():
+        job_scheduler.start_process(job_id, user_id, pool, target, args)
+        return
+
+    if not job_queue.enqueue(job_id, kind, user_id, pool, target, args):
+        job_registry.update(
+            job_id, state="failed", error="ジョブキューへの登録に失敗しました。"
+        )
+        return
+    job_registry.update(job_id, detail="ワーカーの空きを待っています。")
+    job_registry.watch(job_id)
+
+
+def cancel_dispatched_job(job_id: str) -> bool:
+    if not job_registry.cancel(job_id):
+        return False
+    job_queue.cancel(job_id)
+    return True
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+from typing import Iterable, Optional
+
+from helper.job_progress import build_status_payload, get_job_status
+from helper.job_registry import job_registry
+
+MAX_LONG_POLL_SECONDS = 30.0
+
+
+class JobSubscription:
+    """購読中のジョブの最新状態だけを保持する。受信側が遅れても古い更新は溜めない"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.job_ids: set[str] = set()
+        self._pending: dict[str, dict] = {}
+        self._event = asyncio.Event()
+
+    def push(self, payload: dict):
+        self.loop.call_soon_threadsafe(self._put, payload)
+
+    def _put(self, payload: dict):
+        self._pending[payload["job_id"]] = payload
+        self._event.set()
+
+    async def next_updates(self, timeout: Optional[float] = None) -> list[dict]:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self._event.clear()
+        updates = list(self._pending.values())
+        self._pending.clear()
+        return updates
+
+
+class JobEventHub:
+    def __init__(self):
+        self._subscribers: dict[str, set[JobSubscription]] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        job_registry.add_listener(self._on_update)
+
+    def stop(self):
+        job_registry.remove_listener(self._on_update)
+
+    def subscribe(self, job_ids: Iterable[str]) -> JobSubscription:
+        subscription = JobSubscription(asyncio.get_running_loop())
+        self.add_jobs(subscription, job_ids)
+        return subscription
+
+    def add_jobs(self, subscription: JobSubscription, job_ids: Iterable[str]):
+        with self._lock:
+            for job_id in job_ids:
+                subscription.job_ids.add(job_id)
+                self._subscribers.setdefault(job_id, set()).add(subscription)
+
+    def remove_jobs(self, subscription: JobSubscription, job_ids: Iterable[str]):
+        with self._lock:
+            for job_id in list(job_ids):
+                subscription.job_ids.discard(job_id)
+                subscribers = self._subscribers.get(job_id)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[job_id]
+
+    def unsubscribe(self, subscription: JobSubscription):
+        self.remove_jobs(subscription, list(subscription.job_ids))
+
+    def _on_update(self, record: dict):
+        # ジョブ管理スレッドから呼ばれるため、イベントループへの受け渡しはpush経由で行う
+        with self._lock:
+            subscribers = list(self._subscribers.get(record["job_id"], ()))
+        if not subscribers:
+            return
+        payload = build_status_payload(record)
+        for subscription in subscribers:
+            subscription.push(payload)
+
+
+job_event_hub = JobEventHub()
+
+
+async def wait_for_job_status(
+    job_id: str, since: Optional[float] = None, wait: float = 0.0
+) -> Optional[dict]:
+    """ロングポーリング: since以降の更新があるか、wait秒経過するまで応答を保留する"""
+    status = get_job_status(job_id)
+    if (
+        status is None
+        or since is None
+        or wait <= 0
+        or status["status"] != "processing"
+        or status["updated_at"] > since
+    ):
+        return status
+
+    subscription = job_event_hub.subscribe([job_id])
+    try:
+        # 購読開始までの間に届いた更新を取りこぼさないよう再確認する
+        status = get_job_status(job_id)
+        if status["updated_at"] > since:
+            return status
+        updates = await subscription.next_updates(min(wait, MAX_LONG_POLL_SECONDS))
+    finally:
+        job_event_hub.unsubscribe(subscription)
+    return updates[-1] if updates else get_job_status(job_id)
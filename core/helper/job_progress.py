@@ -0,0 +1,295 @@
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from helper.job_registry import job_registry
+from helper.shared_storage import shared_path
+from helper.tracing import add_event
+
+STATS_DIR = shared_path("job_stats")
+STAGE_DURATIONS_FILE = STATS_DIR / "stage_durations.json"
+# 複数のワーカーが同時に読み書きしても更新を失わないよう、この間はロックを取る
+STAGE_DURATIONS_LOCK_FILE = STATS_DIR / ".stage_durations.lock"
+
+# 過去の処理時間は指数移動平均で保持する
+DURATION_SMOOTHING = 0.3
+# 進捗の書き込みはこの間隔(秒)より細かくは行わない
+WRITE_INTERVAL_SECONDS = 0.5
+# 進捗が取れないステージで、履歴から推定する進捗率の上限
+ESTIMATED_PERCENT_CAP = 95.0
+
+# 既存クライアント向けの status 値
+STATUS_BY_STATE = {
+    "queued": "processing",
+    "running": "processing",
+    "succeeded": "complete",
+    "failed": "error",
+    "cancelled": "cancelled",
+}
+
+DEFAULT_POLL_SECONDS = 2.0
+MIN_POLL_SECONDS = 1.0
+MAX_POLL_SECONDS = 15.0
+
+
+def _write_json_atomic(path: Path, data: dict):
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_stage_durations() -> dict:
+    if not STAGE_DURATIONS_FILE.exists():
+        return {}
+    try:
+        with open(STAGE_DURATIONS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def record_stage_durations(job_kind: str, durations: dict):
+    try:
+        STATS_DIR.mkdir(parents=True, exist_ok=True)
+        with open(STAGE_DURATIONS_LOCK_FILE, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                all_durations = load_stage_durations()
+                kind_durations = all_durations.setdefault(job_kind, {})
+                for stage, seconds in durations.items():
+                    previous = kind_durations.get(stage)
+                    if previous is None:
+                        kind_durations[stage] = seconds
+                    else:
+                        kind_durations[stage] = (
+                            DURATION_SMOOTHING * seconds
+                            + (1 - DURATION_SMOOTHING) * previous
+                        )
+                _write_json_atomic(STAGE_DURATIONS_FILE, all_durations)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    except OSError as e:
+        print(f"警告: ステージ処理時間の記録に失敗しました: {e}")
+
+
+class JobProgress:
+    """ワーカー側の進捗報告。ステージの開始・進捗率・終了をジョブ管理に送る。
+    キャンセルはここでは確認せず、ワーカープロセスへのSIGTERMで伝わる"""
+
+    def __init__(self, job_id: str, job_kind: str, stages: list[tuple[str, str]]):
+        self.job_id = job_id
+        self.job_kind = job_kind
+        self.started_at = time.time()
+        self.current_stage: Optional[str] = None
+        self.state = "running"
+        self.detail = ""
+        self._last_write = 0.0
+
+        historical = load_stage_durations().get(job_kind, {})
+        self.stages = [
+            {
+                "name": name,
+                "label": label,
+                "state": "pending",
+                "percent": 0.0,
+                "started_at": None,
+                "finished_at": None,
+                "expected_seconds": historical.get(name),
+            }
+            for name, label in stages
+        ]
+        self._write()
+
+    def _find_stage(self, name: str) -> dict:
+        for stage in self.stages:
+            if stage["name"] == name:
+                return stage
+        raise KeyError(f"未定義のステージです: {name}")
+
+    def _finish_current_stage(self, now: float):
+        if self.current_stage is None:
+            return
+        stage = self._find_stage(self.current_stage)
+        if stage["state"] == "running":
+            stage["state"] = "done"
+            stage["percent"] = 100.0
+            stage["finished_at"] = now
+            add_event(f"stage:{stage['name']}", stage["started_at"], now)
+
+    def start_stage(self, name: str, detail: Optional[str] = None):
+        now = time.time()
+        self._finish_current_stage(now)
+        stage = self._find_stage(name)
+        stage["state"] = "running"
+        stage["started_at"] = now
+        self.current_stage = name
+        self.detail = detail or f"{stage['label']}を実行しています..."
+        print(f"[{self.job_id}] {self.detail}")
+        self._write()
+
+    def skip_stage(self, name: str, detail: Optional[str] = None):
+        now = time.time()
+        self._finish_current_stage(now)
+        stage = self._find_stage(name)
+        stage["state"] = "skipped"
+        stage["percent"] = 100.0
+        self.current_stage = name
+        self.detail = detail or f"{stage['label']}をスキップしました。"
+        print(f"[{self.job_id}] {self.detail}")
+        self._write()
+
+    def update(self, percent: float):
+        if self.current_stage is None:
+            return
+        self._find_stage(self.current_stage)["percent"] = max(0.0, min(percent, 100.0))
+        if time.time() - self._last_write >= WRITE_INTERVAL_SECONDS:
+            self._write(persist=False)
+
+    def complete(self, result_location: Optional[str] = None, detail: str = ""):
+        now = time.time()
+        self._finish_current_stage(now)
+        self.state = "succeeded"
+        self.detail = detail
+        self._write(result_location=result_location)
+        record_stage_durations(
+            self.job_kind,
+            {
+                stage["name"]: stage["finished_at"] - stage["started_at"]
+                for stage in self.stages
+                if stage["started_at"] and stage["finished_at"]
+            },
+        )
+
+    def fail(self, message: str):
+        if self.current_stage is not None:
+            stage = self._find_stage(self.current_stage)
+            if stage["state"] == "running":
+                stage["state"] = "failed"
+                stage["finished_at"] = time.time()
+                add_event(
+                    f"stage:{stage['name']}",
+                    stage["started_at"],
+                    stage["finished_at"],
+                    error=message,
+                )
+        self.state = "failed"
+        self.detail = message
+        self._write(error=message)
+
+    def _write(self, persist: bool = True, **fields):
+        self._last_write = time.time()
+        job_registry.update(
+            self.job_id,
+            persist=persist,
+            state=self.state,
+            stage=self.current_stage,
+            detail=self.detail,
+            progress={"started_at": self.started_at, "stages": self.stages},
+            **fields,
+        )
+
+
+def _stage_percent(stage: dict, now: float) -> float:
+    if stage["state"] in ("done", "skipped"):
+        return 100.0
+    if stage["state"] != "running":
+        return stage["percent"]
+    if stage["percent"] > 0 or not stage["expected_seconds"]:
+        return stage["percent"]
+    # 進捗を報告しないステージは過去の処理時間から推定する
+    elapsed = now - stage["started_at"]
+    return min(elapsed / stage["expected_seconds"] * 100, ESTIMATED_PERCENT_CAP)
+
+
+def _stage_remaining_seconds(stage: dict, now: float) -> Optional[float]:
+    if stage["state"] in ("done", "skipped", "failed"):
+        return 0.0
+    expected = stage["expected_seconds"]
+    if stage["state"] == "pending":
+        return expected
+    elapsed = now - stage["started_at"]
+    if stage["percent"] > 0:
+        return elapsed / (stage["percent"] / 100) - elapsed
+    if expected is None:
+        return None
+    return max(expected - elapsed, 0.0)
+
+
+def build_status_payload(record: dict) -> dict:
+    now = time.time()
+    progress = record.get("progress") or {
+        "started_at": record["created_at"],
+        "stages": [],
+    }
+    stages = progress["stages"]
+    weights = [stage["expected_seconds"] or 1.0 for stage in stages]
+
+    stage_payloads = []
+    weighted_percent = 0.0
+    eta_seconds: Optional[float] = 0.0 if stages else None
+    for stage, weight in zip(stages, weights):
+        percent = _stage_percent(stage, now)
+        weighted_percent += percent * weight
+        if stage["started_at"] is None:
+            elapsed = 0.0
+        else:
+            elapsed = (stage["finished_at"] or now) - stage["started_at"]
+
+        remaining = _stage_remaining_seconds(stage, now)
+        if eta_seconds is not None:
+            eta_seconds = None if remaining is None else eta_seconds + remaining
+
+        stage_payloads.append(
+            {
+                "name": stage["name"],
+                "label": stage["label"],
+                "state": stage["state"],
+                "percent": round(percent, 1),
+                "elapsed_seconds": round(elapsed, 1),
+            }
+        )
+
+    state = record["state"]
+    status = STATUS_BY_STATE[state]
+    if state == "succeeded":
+        percent = 100.0
+        eta_seconds = 0.0
+    else:
+        percent = weighted_percent / sum(weights) if weights else 0.0
+    if state in ("failed", "cancelled"):
+        eta_seconds = None
+
+    if status != "processing":
+        poll_after = None
+    elif eta_seconds is None:
+        poll_after = DEFAULT_POLL_SECONDS
+    else:
+        poll_after = min(max(eta_seconds / 10, MIN_POLL_SECONDS), MAX_POLL_SECONDS)
+
+    finished_at = record.get("finished_at") or now
+    return {
+        "job_id": record["job_id"],
+        "kind": record["kind"],
+        "state": state,
+        "status": status,
+        "detail": record["error"] if state == "failed" else record["detail"] or "",
+        "stage": record["stage"],
+        "percent": round(percent, 1),
+        "elapsed_seconds": round(finished_at - progress["started_at"], 1),
+        "eta_seconds": None if eta_seconds is None else round(eta_seconds, 1),
+        "poll_after_seconds": poll_after,
+        "stages": stage_payloads,
+        "result_location": record["result_location"],
+        "updated_at": record["updated_at"],
+    }
+
+
+def get_job_status(job_id: str) -> Optional[dict]:
+    record = job_registry.get(job_id)
+    if record is None:
+        return None
+    return build_status_payload(record)
@@ -0,0 +1,354 @@
+import importlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Optional, Protocol
+
+from helper.metrics import gauge_lines, metrics_hub
+
+# local: APIプロセスがワーカープロセスをforkする / queue: worker.pyが取り出して実行する
+JOB_EXECUTION_MODE = os.getenv("JOB_EXECUTION_MODE", "local")
+# queueモードのキューの実装。"sqlite" (既定・単一ホスト専用) か、"モジュール名:クラス名"
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "sqlite")
+
+# SQLiteのロックとWALはネットワークファイルシステム越しには正しく働かないため、
+# DBがこれらの上にある場合はqueueモードで起動しない
+NETWORK_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "9p",
+    "afs",
+    "ceph",
+    "glusterfs",
+    "lustre",
+    "fuse.sshfs",
+    "fuse.cephfs",
+    "fuse.glusterfs",
+    "fuse.s3fs",
+    "fuse.gcsfuse",
+}
+
+# ワーカーが応答しなくなってから、ジョブを他のワーカーに再割り当てするまでの時間
+LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("JOB_HEARTBEAT_INTERVAL_SECONDS", "10"))
+MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# 実行中のジョブが少ないユーザーを優先し、同数なら古いものから取り出す
+LEASE_JOB_SQL = """
+UPDATE job_queue
+SET state = 'leased', worker_id = ?, attempts = attempts + 1, lease_expires_at = ?
+WHERE job_id = (
+    SELECT q.job_id FROM job_queue AS q
+    WHERE q.state = 'pending' AND q.kind IN ({kinds})
+    ORDER BY (
+        SELECT COUNT(*) FROM job_queue AS l
+        WHERE l.state = 'leased' AND l.user_id = q.user_id
+    ), q.enqueued_at
+    LIMIT 1
+)
+RETURNING job_id, kind, user_id, payload, attempts;
+"""
+
+
+def _encode_arg(value):
+    if isinstance(value, Path):
+        return {"__path__": str(value)}
+    return value
+
+
+def _decode_arg(value):
+    if isinstance(value, dict) and set(value) == {"__path__"}:
+        return Path(value["__path__"])
+    return value
+
+
+def encode_payload(pool: str, target, args: tuple) -> str:
+    """ワーカー側でimportできるよう、関数はモジュール名と関数名で保存する"""
+    return json.dumps(
+        {
+            "pool": pool,
+            "target": f"{target.__module__}:{target.__qualname__}",
+            "args": [_encode_arg(arg) for arg in args],
+        },
+        ensure_ascii=False,
+    )
+
+
+def decode_payload(payload: str) -> tuple[str, str, tuple]:
+    data = json.loads(payload)
+    return data["pool"], data["target"], tuple(_decode_arg(arg) for arg in data["args"])
+
+
+def filesystem_type(path: Path) -> Optional[str]:
+    """pathを含むマウントのファイルシステムの種類。/proc/mountsが読めなければNone"""
+    try:
+        mounts = Path("/proc/mounts").read_text().splitlines()
+    except OSError:
+        return None
+    resolved = str(path.resolve())
+    best_mount, best_type = "", None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # マウントポイントの空白などは8進数でエスケープされている
+        mount_point = fields[1].encode().decode("unicode_escape")
+        inside = resolved == mount_point or resolved.startswith(
+            mount_point.rstrip("/") + "/"
+        )
+        if inside and len(mount_point) >= len(best_mount):
+            best_mount, best_type = mount_point, fields[2]
+    return best_type
+
+
+class JobQueue(Protocol):
+    """APIとworker.pyが共有する永続キューの実装が満たすメソッド。
+    ジョブは期限付きで貸し出され (lease)、ハートビートが途絶えると requeue_expired で
+    再びpendingに戻る。JOB_QUEUE_BACKENDで "モジュール名:クラス名" を指定すると、
+    引数なしで生成したそのクラスを使う"""
+
+    def validate(self):
+        """今の構成で使えるかを確かめ、使えなければRuntimeErrorを送出する。
+        queueモードのAPIとworker.pyが起動時に呼ぶ"""
+
+    def setup(self): ...
+
+    def enqueue(
+        self,
+        job_id: str,
+        kind: str,
+        user_id: Optional[str],
+        pool: str,
+        target,
+        args: tuple,
+    ) -> bool: ...
+
+    def count_pending(self, kind: str, user_id: Optional[str] = None) -> int: ...
+
+    def lease(self, worker_id: str, kinds: list[str]) -> Optional[dict]:
+        """(job_id, kind, user_id, payload, attempts) の辞書。空なら None"""
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """貸出期限を延長する。Falseなら貸出が失効しているか、キャンセルされている"""
+
+    def get_state(self, job_id: str) -> Optional[str]: ...
+
+    def complete(self, job_id: str, worker_id: str): ...
+
+    def cancel(self, job_id: str): ...
+
+    def requeue_expired(self) -> tuple[list[str], list[str]]:
+        """期限切れの貸出を回収する。(再投入したjob_id, 試行回数を超えて諦めたjob_id) を返す"""
+
+    def purge_finished(self, older_than_seconds: float): ...
+
+    def collect_metrics(self) -> list[str]: ...
+
+
+class SQLiteJobQueue:
+    """履歴と同じSQLiteのDBに置くジョブキュー (既定の実装)。
+    SQLiteのロックはネットワークファイルシステム越しには働かないため単一ホスト専用で、
+    ワーカーはAPIと同じホストで、プロセス数を増やす形でだけ増やせる"""
+
+    def validate(self):
+        """DBがネットワークファイルシステム上にあれば、起動を中止する"""
+        from helper.db_handler import DB_PATH
+
+        fs_type = filesystem_type(DB_PATH)
+        if fs_type in NETWORK_FILESYSTEMS:
+            raise RuntimeError(
+                f"ジョブキューのDB ({DB_PATH}) がネットワークファイルシステム ({fs_type}) 上にあります。"
+                "SQLiteのジョブキューは単一ホスト専用のため、ローカルディスク上のDBを指定してください。"
+            )
+
+    def setup(self):
+        from helper.db_handler import get_connection
+
+        conn = get_connection()
+        if conn:
+            try:
+                with conn:
+                    conn.execute(
+                        """
+                    CREATE TABLE IF NOT EXISTS job_queue (
+                        job_id TEXT PRIMARY KEY,
+                        kind TEXT NOT NULL,
+                        user_id TEXT,
+                        payload TEXT NOT NULL,
+                        state TEXT NOT NULL,
+                        worker_id TEXT,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        lease_expires_at REAL,
+                        enqueued_at REAL NOT NULL
+                    );
+                    """
+                    )
+                    conn.execute(
+                        "CREATE INDEX IF NOT EXISTS idx_job_queue_state ON job_queue (state, enqueued_at);"
+                    )
+                print("INFO: 'job_queue' テーブルの準備が完了しました。")
+            except sqlite3.Error as e:
+                print(f"ERROR: テーブル作成エラー: {e}")
+
+    def _execute(self, sql: str, params: Iterable = ()) -> Optional[tuple[list, int]]:
+        """1トランザクションで実行し、(取得した行, 更新件数) を返す。失敗時はNone"""
+        from helper.db_handler import get_connection
+
+        conn = get_connection()
+        if not conn:
+            return None
+        try:
+            with conn:
+                cursor = conn.execute(sql, tuple(params))
+                # RETURNING句の結果はコミット前に読み切る必要がある
+                rows = cursor.fetchall()
+                return rows, cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"ERROR: ジョブキューの操作に失敗しました: {e}")
+            return None
+
+    def enqueue(
+        self,
+        job_id: str,
+        kind: str,
+        user_id: Optional[str],
+        pool: str,
+        target,
+        args: tuple,
+    ) -> bool:
+        result = self._execute(
+            """
+            INSERT INTO job_queue (job_id, kind, user_id, payload, state, enqueued_at)
+            VALUES (?, ?, ?, ?, 'pending', ?);
+            """,
+            (job_id, kind, user_id, encode_payload(pool, target, args), time.time()),
+        )
+        return result is not None
+
+    def count_pending(self, kind: str, user_id: Optional[str] = None) -> int:
+        sql = "SELECT COUNT(*) FROM job_queue WHERE state = 'pending' AND kind = ?"
+        params: list = [kind]
+        if user_id is not None:
+            sql += " AND user_id = ?"
+            params.append(user_id)
+        result = self._execute(sql + ";", params)
+        return result[0][0][0] if result else 0
+
+    def lease(self, worker_id: str, kinds: list[str]) -> Optional[dict]:
+        sql = LEASE_JOB_SQL.format(kinds=", ".join("?" for _ in kinds))
+        result = self._execute(sql, (worker_id, time.time() + LEASE_SECONDS, *kinds))
+        if not result or not result[0]:
+            return None
+        return dict(zip(("job_id", "kind", "user_id", "payload", "attempts"), result[0][0]))
+
+    def heartbeat(self, job_id: str, worker_id: str) -> bool:
+        """貸出期限を延長する。Falseなら貸出が失効しているか、キャンセルされている"""
+        result = self._execute(
+            """
+            UPDATE job_queue SET lease_expires_at = ?
+            WHERE job_id = ? AND worker_id = ? AND state = 'leased';
+            """,
+            (time.time() + LEASE_SECONDS, job_id, worker_id),
+        )
+        return result is not None and result[1] == 1
+
+    def get_state(self, job_id: str) -> Optional[str]:
+        result = self._execute("SELECT state FROM job_queue WHERE job_id = ?;", (job_id,))
+        return result[0][0][0] if result and result[0] else None
+
+    def complete(self, job_id: str, worker_id: str):
+        self._execute(
+            """
+            UPDATE job_queue SET state = 'done', lease_expires_at = NULL
+            WHERE job_id = ? AND worker_id = ? AND state = 'leased';
+            """,
+            (job_id, worker_id),
+        )
+
+    def cancel(self, job_id: str):
+        self._execute(
+            """
+            UPDATE job_queue SET state = 'cancelled', lease_expires_at = NULL
+            WHERE job_id = ? AND state IN ('pending', 'leased');
+            """,
+            (job_id,),
+        )
+
+    def requeue_expired(self) -> tuple[list[str], list[str]]:
+        """期限切れの貸出を回収する。(再投入したjob_id, 試行回数を超えて諦めたjob_id) を返す"""
+        now = time.time()
+        expired = self._execute(
+            """
+            SELECT job_id, attempts FROM job_queue
+            WHERE state = 'leased' AND lease_expires_at < ?;
+            """,
+            (now,),
+        )
+        if expired is None:
+            return [], []
+        requeued, failed = [], []
+        for job_id, attempts in expired[0]:
+            next_state = "pending" if attempts < MAX_ATTEMPTS else "failed"
+            # 他のワーカーが同時に回収した場合に二重に扱わないよう、条件付きで更新する
+            result = self._execute(
+                """
+                UPDATE job_queue SET state = ?, worker_id = NULL, lease_expires_at = NULL
+                WHERE job_id = ? AND state = 'leased' AND lease_expires_at < ?;
+                """,
+                (next_state, job_id, now),
+            )
+            if result is not None and result[1] == 1:
+                (requeued if next_state == "pending" else failed).append(job_id)
+        return requeued, failed
+
+    def collect_metrics(self) -> list[str]:
+        by_state = self._execute(
+            """
+            SELECT kind, state, COUNT(*) FROM job_queue
+            WHERE state IN ('pending', 'leased') GROUP BY kind, state;
+            """
+        )
+        workers = self._execute(
+            "SELECT COUNT(DISTINCT worker_id) FROM job_queue WHERE state = 'leased';"
+        )
+        return gauge_lines(
+            "audily_job_queue_depth",
+            "Jobs in the durable queue by kind and state.",
+            [
+                ({"kind": kind, "state": state}, count)
+                for kind, state, count in (by_state[0] if by_state else [])
+            ],
+        ) + gauge_lines(
+            "audily_job_queue_active_workers",
+            "Worker nodes currently holding a lease.",
+            [({}, workers[0][0][0])] if workers else [],
+        )
+
+    def purge_finished(self, older_than_seconds: float):
+        self._execute(
+            """
+            DELETE FROM job_queue
+            WHERE state IN ('done', 'failed', 'cancelled') AND enqueued_at < ?;
+            """,
+            (time.time() - older_than_seconds,),
+        )
+
+
+def create_job_queue(backend: str = JOB_QUEUE_BACKEND) -> JobQueue:
+    if backend == "sqlite":
+        return SQLiteJobQueue()
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(
+            f"JOB_QUEUE_BACKENDは \"sqlite\" か \"モジュール名:クラス名\" で指定してください: {backend}"
+        )
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+job_queue = create_job_queue()
+metrics_hub.add_collector(job_queue.collect_metrics)
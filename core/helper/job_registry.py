@@ -0,0 +1,494 @@
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from helper.metrics import gauge_lines, metrics_hub, read_rss_bytes
+from helper.readiness import wait_for_loading_resources
+
+JOB_STATES = ("queued", "running", "succeeded", "failed", "cancelled")
+TERMINAL_STATES = ("succeeded", "failed", "cancelled")
+
+# 終了したジョブをメモリ上に保持する時間
+FINISHED_JOB_RETENTION_SECONDS = 60 * 60
+# ワーカープロセスの生存確認の間隔
+REAP_INTERVAL_SECONDS = 1.0
+# SIGTERMを受けたジョブが自ら終了するまで待つ時間。過ぎた場合だけSIGKILLで止める。
+# 分離は30秒単位のTensorFlowの演算が終わるまで例外を受け取れないため、長めにとる
+CANCEL_GRACE_SECONDS = float(os.getenv("CANCEL_GRACE_SECONDS", "45"))
+
+JOB_COLUMNS = (
+    "job_id",
+    "kind",
+    "user_id",
+    "source_filename",
+    "state",
+    "stage",
+    "detail",
+    "progress",
+    "result_location",
+    "error",
+    "pid",
+    "created_at",
+    "started_at",
+    "finished_at",
+    "updated_at",
+)
+
+UPSERT_JOB_SQL = f"""
+INSERT INTO jobs ({", ".join(JOB_COLUMNS)})
+VALUES ({", ".join("?" for _ in JOB_COLUMNS)})
+ON CONFLICT (job_id) DO UPDATE SET
+{", ".join(f"{column} = excluded.{column}" for column in JOB_COLUMNS[1:])};
+"""
+
+SELECT_JOB_SQL = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id = ?;"
+SELECT_JOBS_SQL = f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE job_id IN ({{placeholders}});"
+
+_STOP = "__stop__"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def setup_jobs_table():
+    from helper.db_handler import get_connection
+
+    conn = get_connection()
+    if conn:
+        try:
+            with conn:
+                conn.execute(
+                    """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    user_id TEXT,
+                    source_filename TEXT,
+                    state TEXT NOT NULL,
+                    stage TEXT,
+                    detail TEXT,
+                    progress TEXT,
+                    result_location TEXT,
+                    error TEXT,
+                    pid INTEGER,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    updated_at REAL NOT NULL
+                );
+                """
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state);"
+                )
+            print("INFO: 'jobs' テーブルの準備が完了しました。")
+        except sqlite3.Error as e:
+            print(f"ERROR: テーブル作成エラー: {e}")
+
+
+def _persist(record: dict):
+    from helper.db_handler import get_connection
+
+    conn = get_connection()
+    if not conn:
+        return
+    row = dict(record)
+    if row.get("progress") is not None:
+        row["progress"] = json.dumps(row["progress"], ensure_ascii=False)
+    try:
+        with conn:
+            conn.execute(UPSERT_JOB_SQL, [row.get(column) for column in JOB_COLUMNS])
+    except sqlite3.Error as e:
+        print(f"ERROR: ジョブ状態の記録に失敗しました: {e}")
+
+
+def _row_to_record(row: tuple) -> dict:
+    record = dict(zip(JOB_COLUMNS, row))
+    if record["progress"]:
+        record["progress"] = json.loads(record["progress"])
+    return record
+
+
+def _load(job_id: str) -> Optional[dict]:
+    from helper.db_handler import get_connection
+
+    conn = get_connection()
+    if not conn:
+        return None
+    try:
+        row = conn.execute(SELECT_JOB_SQL, (job_id,)).fetchone()
+    except sqlite3.Error as e:
+        print(f"ERROR: ジョブ状態の取得に失敗しました: {e}")
+        return None
+    if row is None:
+        return None
+    return _row_to_record(row)
+
+
+def _load_many(job_ids: list[str]) -> list[dict]:
+    from helper.db_handler import get_connection
+
+    conn = get_connection()
+    if not conn or not job_ids:
+        return []
+    sql = SELECT_JOBS_SQL.format(placeholders=", ".join("?" for _ in job_ids))
+    try:
+        return [_row_to_record(row) for row in conn.execute(sql, job_ids)]
+    except sqlite3.Error as e:
+        print(f"ERROR: ジョブ状態の取得に失敗しました: {e}")
+        return []
+
+
+class JobRegistry:
+    """ジョブ状態の一元管理。APIプロセスがメモリ上の索引とjobsテーブルを保持し、
+    ワーカープロセスからの更新はプロセス間キュー経由で受け取る"""
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.owner_pid: Optional[int] = None
+        self._jobs: dict[str, dict] = {}
+        self._processes: dict[str, multiprocessing.Process] = {}
+        self._lock = threading.Lock()
+        self._listeners: list = []
+        self._thread: Optional[threading.Thread] = None
+        # 別ノードのワーカーが実行中で、jobsテーブルを定期的に読み直すジョブ
+        self._watched: set[str] = set()
+
+    @property
+    def is_running(self) -> bool:
+        return self.owner_pid is not None
+
+    @property
+    def is_owner(self) -> bool:
+        return self.owner_pid == os.getpid()
+
+    def start(self, recover_interrupted: bool = True):
+        """recover_interrupted: 他のプロセスが実行中のジョブを持たない場合だけTrueにする"""
+        if self._thread is not None:
+            return
+        setup_jobs_table()
+        if recover_interrupted:
+            self._recover_interrupted_jobs()
+        self.owner_pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name="job-registry", daemon=True
+        )
+        self._thread.start()
+        print("INFO: ジョブ管理スレッドを開始しました。")
+
+    def stop(self, timeout: float = 10.0):
+        if self._thread is None or not self.is_owner:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self.owner_pid = None
+
+    def _recover_interrupted_jobs(self):
+        from helper.db_handler import get_connection
+
+        # 前回の停止時に実行中だったジョブは再開できないため失敗として扱う。
+        # ジョブキュー経由のジョブはワーカー側で再投入されるため対象外とする
+        conn = get_connection()
+        if not conn:
+            return
+        try:
+            with conn:
+                conn.execute(
+                    """
+                UPDATE jobs
+                SET state = 'failed', error = ?, finished_at = ?, updated_at = ?
+                WHERE state IN ('queued', 'running')
+                AND job_id NOT IN (SELECT job_id FROM job_queue);
+                """,
+                    ("サーバーの再起動により中断されました。", time.time(), time.time()),
+                )
+        except sqlite3.Error as e:
+            print(f"ERROR: 中断されたジョブの更新に失敗しました: {e}")
+
+    # --- 書き込み ---
+
+    def create(
+        self,
+        job_id: str,
+        kind: str,
+        user_id: Optional[str] = None,
+        source_filename: Optional[str] = None,
+        state: str = "queued",
+    ) -> dict:
+        now = time.time()
+        record = {column: None for column in JOB_COLUMNS}
+        record.update(
+            job_id=job_id,
+            kind=kind,
+            user_id=user_id,
+            source_filename=source_filename,
+            state=state,
+            created_at=now,
+            updated_at=now,
+        )
+        self._dispatch(job_id, record, persist=True)
+        return record
+
+    def update(self, job_id: str, persist: bool = True, **fields):
+        """persist=Falseの更新(進捗率のみの変化など)はメモリ上の索引だけに反映する"""
+        fields["updated_at"] = time.time()
+        state = fields.get("state")
+        if state == "running" and "started_at" not in fields:
+            fields["started_at"] = fields["updated_at"]
+        if state in TERMINAL_STATES:
+            fields.setdefault("finished_at", fields["updated_at"])
+        self._dispatch(job_id, fields, persist)
+
+    def _dispatch(self, job_id: str, fields: dict, persist: bool):
+        if self.is_owner:
+            self._apply(job_id, fields, persist)
+        elif self.is_running:
+            # forkされたワーカープロセスからはキュー経由でAPIプロセスに送る
+            self.queue.put((job_id, fields, persist))
+        else:
+            record = _load(job_id) or {column: None for column in JOB_COLUMNS}
+            record.update(fields, job_id=job_id)
+            _persist(record)
+
+    def _apply(self, job_id: str, fields: dict, persist: bool):
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                record = _load(job_id) or {column: None for column in JOB_COLUMNS}
+                record["job_id"] = job_id
+                self._jobs[job_id] = record
+            # キャンセル済みのジョブに、停止前のワーカーから届いた更新は反映しない
+            if record["state"] == "cancelled" and fields.get("state") != "cancelled":
+                return
+            record.update(fields)
+            snapshot = dict(record)
+        if persist:
+            _persist(snapshot)
+        for listener in list(self._listeners):
+            try:
+                listener(snapshot)
+            except Exception as e:
+                print(f"ERROR: ジョブ更新の通知に失敗しました: {e}")
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    # --- 参照 ---
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is not None:
+                return dict(record)
+        record = _load(job_id)
+        if record is not None and self.is_owner:
+            with self._lock:
+                self._jobs.setdefault(job_id, record)
+                # メモリに無い実行中のジョブは他のプロセスが実行しているため、更新を読み直す
+                if record["state"] not in TERMINAL_STATES:
+                    self._watched.add(job_id)
+        return record
+
+    def watch(self, job_id: str):
+        """他のプロセスがjobsテーブルに直接書き込むジョブの更新を、定期的に読み込んで通知する"""
+        with self._lock:
+            self._watched.add(job_id)
+
+    def _poll_watched(self):
+        with self._lock:
+            watched = list(self._watched)
+        for record in _load_many(watched):
+            job_id = record["job_id"]
+            with self._lock:
+                current = self._jobs.get(job_id)
+                changed = current is None or (record["updated_at"] or 0) > (
+                    current["updated_at"] or 0
+                )
+                if record["state"] in TERMINAL_STATES:
+                    self._watched.discard(job_id)
+            if changed:
+                self._apply(job_id, record, persist=False)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        """メモリ上の索引を見るため、正しいのは管理側のプロセスだけ。
+        forkしたワーカーにはSIGTERM (JobCancelled) でキャンセルが伝わる"""
+        with self._lock:
+            record = self._jobs.get(job_id)
+        return record is not None and record["state"] == "cancelled"
+
+    # --- ワーカープロセス ---
+
+    def start_process(self, job_id: str, target, args: tuple) -> multiprocessing.Process:
+        wait_for_loading_resources()
+        process = multiprocessing.Process(
+            target=_run_in_process_group, args=(target, *args)
+        )
+        process.start()
+        # 子プロセス側でも同じ設定をするため、どちらが先に実行されてもkillpgの前にグループができている
+        _set_process_group(process.pid)
+        with self._lock:
+            self._processes[job_id] = process
+        self.update(job_id, pid=process.pid)
+        return process
+
+    def collect_metrics(self) -> list[str]:
+        with self._lock:
+            processes = [
+                (self._jobs.get(job_id, {}).get("kind") or "unknown", process.pid)
+                for job_id, process in self._processes.items()
+                if process.is_alive()
+            ]
+        counts: dict[str, int] = {}
+        rss: dict[str, int] = {}
+        for kind, pid in processes:
+            counts[kind] = counts.get(kind, 0) + 1
+            rss[kind] = rss.get(kind, 0) + (read_rss_bytes(pid) or 0)
+        return gauge_lines(
+            "audily_active_worker_processes",
+            "Job worker processes started by this process.",
+            [({"kind": kind}, count) for kind, count in sorted(counts.items())],
+        ) + gauge_lines(
+            "audily_worker_resident_memory_bytes",
+            "Total resident memory of running job worker processes.",
+            [({"kind": kind}, total) for kind, total in sorted(rss.items())],
+        )
+
+    def cancel(self, job_id: str) -> bool:
+        record = self.get(job_id)
+        if record is None or record["state"] in TERMINAL_STATES:
+            return False
+
+        self.update(job_id, state="cancelled", detail="キャンセルされました。")
+        self.terminate(job_id)
+        print(f"[{job_id}] ジョブをキャンセルしました。")
+        return True
+
+    def terminate(self, job_id: str):
+        """状態は更新せずにワーカープロセスを停止する (他のワーカーに再割り当てされた場合など)"""
+        with self._lock:
+            process = self._processes.pop(job_id, None)
+        if process is not None and process.is_alive():
+            threading.Thread(
+                target=_terminate_process_group, args=(process,), daemon=True
+            ).start()
+
+    def _reap_processes(self):
+        with self._lock:
+            finished = [
+                (job_id, process)
+                for job_id, process in self._processes.items()
+                if not process.is_alive()
+            ]
+            for job_id, _ in finished:
+                del self._processes[job_id]
+
+        for job_id, process in finished:
+            process.join()
+            record = self.get(job_id)
+            if record and record["state"] not in TERMINAL_STATES:
+                self.update(
+                    job_id,
+                    state="failed",
+                    error=f"ワーカープロセスが異常終了しました (終了コード: {process.exitcode})",
+                )
+
+    def _evict_finished(self):
+        threshold = time.time() - FINISHED_JOB_RETENTION_SECONDS
+        with self._lock:
+            expired = [
+                job_id
+                for job_id, record in self._jobs.items()
+                if record["state"] in TERMINAL_STATES
+                and (record["finished_at"] or 0) < threshold
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _run(self):
+        last_reap = 0.0
+        while True:
+            try:
+                item = self.queue.get(timeout=REAP_INTERVAL_SECONDS)
+                if item == _STOP:
+                    break
+                job_id, fields, persist = item
+                self._apply(job_id, fields, persist)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"ERROR: ジョブ更新の処理に失敗しました: {e}")
+
+            if time.monotonic() - last_reap >= REAP_INTERVAL_SECONDS:
+                last_reap = time.monotonic()
+                # 子プロセスの更新を取りこぼさないよう、キューが空の時だけ回収する
+                if self.queue.empty():
+                    self._reap_processes()
+                self._poll_watched()
+                self._evict_finished()
+
+
+def _set_process_group(pid: int):
+    if not hasattr(os, "setpgid"):
+        return
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        # 子プロセスが既に設定したか、既に終了している
+        pass
+
+
+def _raise_cancelled(signum, frame):
+    # 1度だけ送出し、後始末の最中に届いた2度目のSIGTERMでは中断しない
+    signal.signal(signal.SIGTERM, lambda *_: None)
+    raise JobCancelled("ジョブは停止を要求されました。")
+
+
+def _run_in_process_group(target, *args):
+    # キャンセル時にffmpegなどの子プロセスもまとめて停止できるよう、独立したプロセスグループにする
+    _set_process_group(0)
+    # 強制終了ではなく例外でジョブを止め、共有キューへの書き込みやfinallyの後始末を終えてから終了させる
+    signal.signal(signal.SIGTERM, _raise_cancelled)
+    target(*args)
+
+
+def _send_signal(process: multiprocessing.Process, signum: int):
+    try:
+        os.killpg(process.pid, signum)
+    except ProcessLookupError:
+        # グループが無ければプロセス本体にだけ送る
+        try:
+            os.kill(process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def _terminate_process_group(process: multiprocessing.Process):
+    if hasattr(os, "killpg"):
+        _send_signal(process, signal.SIGTERM)
+        process.join(CANCEL_GRACE_SECONDS)
+        if process.is_alive():
+            # キューの書き込み中に止めると他のプロセスが詰まる恐れがあるため、最後の手段にする
+            print(f"警告: ワーカープロセス {process.pid} が終了しないため、強制終了します。")
+            _send_signal(process, signal.SIGKILL)
+    else:
+        process.terminate()
+        process.join(CANCEL_GRACE_SECONDS)
+        if process.is_alive():
+            process.kill()
+    process.join()
+
+
+job_registry = JobRegistry()
+metrics_hub.add_collector(job_registry.collect_metrics)
@@ -0,0 +1,417 @@
+import asyncio
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+from helper.job_registry import TERMINAL_STATES, JobCancelled, job_registry
+from helper.metrics import gauge_lines, metrics_hub
+from helper.thread_budget import ALLOWED_CPUS, apply_budget, set_default_budgets
+from helper.tracing import span
+
+# コンテナのCPU上限やaffinityで制限されている場合は、その範囲のコア数を使う
+_CPU_COUNT = len(ALLOWED_CPUS)
+
+# 資源ごとの同時実行数。Spleeter(TensorFlow)は1件で全コアを使うため少なくする
+POOL_CAPACITIES = {
+    "separation": int(
+        os.getenv("SCHEDULER_SEPARATION_SLOTS", str(max(1, _CPU_COUNT // 8)))
+    ),
+    "ffmpeg": int(os.getenv("SCHEDULER_FFMPEG_SLOTS", str(max(1, _CPU_COUNT // 2)))),
+    "gemini": int(os.getenv("SCHEDULER_GEMINI_SLOTS", "4")),
+}
+# 資源ごとの待ち行列の上限と、そのうち1ユーザーが占有できる件数
+MAX_QUEUED_PER_POOL = int(os.getenv("SCHEDULER_MAX_QUEUED", "20"))
+MAX_QUEUED_PER_USER = int(os.getenv("SCHEDULER_MAX_QUEUED_PER_USER", "5"))
+
+# 実績が無い資源で、1件あたりの占有時間として仮定する秒数
+DEFAULT_HOLD_SECONDS = 60.0
+HOLD_SMOOTHING = 0.3
+MAX_RETRY_AFTER_SECONDS = 600
+
+_STOP = "__stop__"
+
+
+class SchedulerBusy(HTTPException):
+    def __init__(self, pool: str, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail="現在混み合っています。しばらくしてから再度お試しください。",
+            headers={"Retry-After": str(retry_after)},
+        )
+        self.pool = pool
+        self.retry_after = retry_after
+
+
+class _Request:
+    def __init__(
+        self,
+        job_id: str,
+        user_id: str,
+        on_grant: Callable[[], None],
+        on_drop: Optional[Callable[[], None]] = None,
+    ):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.on_grant = on_grant
+        self.on_drop = on_drop
+
+
+class _Pool:
+    """同時実行数の枠と、ユーザーごとのラウンドロビンで取り出す待ち行列"""
+
+    def __init__(self, name: str, capacity: int):
+        self.name = name
+        self.capacity = max(1, capacity)
+        self.holders: dict[str, float] = {}
+        # 枠を持つジョブの枠番号。ワーカーに割り当てるコアの位置に使う
+        self.slot_indices: dict[str, int] = {}
+        self.pending: OrderedDict[str, deque[_Request]] = OrderedDict()
+        self.avg_hold_seconds: Optional[float] = None
+
+    @property
+    def queued(self) -> int:
+        return sum(len(requests) for requests in self.pending.values())
+
+    def queued_for(self, user_id: str) -> int:
+        return len(self.pending.get(user_id, ()))
+
+    def enqueue(self, request: _Request):
+        self.pending.setdefault(request.user_id, deque()).append(request)
+
+    def pop_next(self) -> Optional[_Request]:
+        if not self.pending:
+            return None
+        user_id, requests = next(iter(self.pending.items()))
+        request = requests.popleft()
+        # 取り出したユーザーは末尾に回し、他のユーザーの要求を先に処理する
+        if requests:
+            self.pending.move_to_end(user_id)
+        else:
+            del self.pending[user_id]
+        return request
+
+    def remove_job(self, job_id: str) -> list[_Request]:
+        removed = []
+        for user_id in list(self.pending):
+            requests = self.pending[user_id]
+            removed.extend(request for request in requests if request.job_id == job_id)
+            remaining = deque(request for request in requests if request.job_id != job_id)
+            if remaining:
+                self.pending[user_id] = remaining
+            else:
+                del self.pending[user_id]
+        return removed
+
+    def acquire(self, job_id: str):
+        self.holders[job_id] = time.monotonic()
+        used = set(self.slot_indices.values())
+        self.slot_indices[job_id] = next(i for i in range(self.capacity) if i not in used)
+
+    def release(self, job_id: str):
+        acquired_at = self.holders.pop(job_id, None)
+        self.slot_indices.pop(job_id, None)
+        if acquired_at is None:
+            return
+        held = time.monotonic() - acquired_at
+        if self.avg_hold_seconds is None:
+            self.avg_hold_seconds = held
+        else:
+            self.avg_hold_seconds = (
+                HOLD_SMOOTHING * held + (1 - HOLD_SMOOTHING) * self.avg_hold_seconds
+            )
+
+    def retry_after(self) -> int:
+        hold = self.avg_hold_seconds or DEFAULT_HOLD_SECONDS
+        seconds = math.ceil(hold * (self.queued + 1) / self.capacity)
+        return max(1, min(seconds, MAX_RETRY_AFTER_SECONDS))
+
+
+class JobScheduler:
+    """重い処理の実行枠を資源(separation / ffmpeg / gemini)ごとに管理する。
+    APIプロセスが枠と待ち行列を保持し、ワーカープロセスからの要求はプロセス間キュー経由で受け取る"""
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.owner_pid: Optional[int] = None
+        self._pools = {
+            name: _Pool(name, capacity) for name, capacity in POOL_CAPACITIES.items()
+        }
+        # ワーカープロセスへの実行許可と、許可した枠の番号を渡す共有変数
+        self._grants: dict[
+            str, tuple[multiprocessing.Semaphore, multiprocessing.Value]
+        ] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # ワーカープロセス側で、APIプロセスから実行許可を受け取るためのセマフォ
+        self._worker_grant: Optional[multiprocessing.Semaphore] = None
+        self._worker_slot: Optional[multiprocessing.Value] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.owner_pid is not None
+
+    @property
+    def is_owner(self) -> bool:
+        return self.owner_pid == os.getpid()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.owner_pid = os.getpid()
+        set_default_budgets({name: pool.capacity for name, pool in self._pools.items()})
+        job_registry.add_listener(self._on_job_update)
+        self._thread = threading.Thread(
+            target=self._run, name="job-scheduler", daemon=True
+        )
+        self._thread.start()
+        capacities = ", ".join(
+            f"{name}={pool.capacity}" for name, pool in self._pools.items()
+        )
+        print(f"INFO: ジョブスケジューラを開始しました ({capacities})。")
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is None or not self.is_owner:
+            return
+        job_registry.remove_listener(self._on_job_update)
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self.owner_pid = None
+
+    # --- 受付 ---
+
+    def check_admission(self, user_id: str, pool_name: str):
+        """待ち行列が一杯ならSchedulerBusy(429)を送出する"""
+        with self._lock:
+            pool = self._pools[pool_name]
+            if len(pool.holders) < pool.capacity and not pool.pending:
+                return
+            if (
+                pool.queued >= MAX_QUEUED_PER_POOL
+                or pool.queued_for(user_id) >= MAX_QUEUED_PER_USER
+            ):
+                raise SchedulerBusy(pool_name, pool.retry_after())
+
+    def submit(
+        self,
+        job_id: str,
+        user_id: str,
+        pool_name: str,
+        on_grant: Callable[[], None],
+        on_drop: Optional[Callable[[], None]] = None,
+    ):
+        """枠が空き次第on_grantを呼ぶ。枠はジョブの終了時か release() で返却される"""
+        self._enqueue(pool_name, _Request(job_id, user_id, on_grant, on_drop))
+
+    def start_process(
+        self, job_id: str, user_id: str, pool_name: str, target, args: tuple
+    ):
+        """実行枠を得てからワーカープロセスを起動する。起動時に得た枠は同じ資源の
+        slot() でそのまま使われ、抜けた時点で返却される"""
+        grant = multiprocessing.Semaphore(0)
+        slot_index = multiprocessing.Value("i", -1, lock=False)
+        with self._lock:
+            self._grants[job_id] = (grant, slot_index)
+
+        def launch():
+            try:
+                with self._lock:
+                    pool = self._pools[pool_name]
+                    budget = (pool_name, pool.slot_indices[job_id], pool.capacity)
+                job_registry.start_process(
+                    job_id, _run_scheduled, (grant, slot_index, budget, target, args)
+                )
+            except Exception as e:
+                print(f"ERROR: [{job_id}] ワーカープロセスの起動に失敗しました: {e}")
+                job_registry.update(
+                    job_id, state="failed", error=f"ワーカープロセスの起動に失敗しました: {e}"
+                )
+
+        job_registry.update(job_id, persist=False, detail="実行待ちです。")
+        self.submit(job_id, user_id, pool_name, launch)
+
+    def release(self, job_id: str, pool_name: str):
+        if self.is_owner:
+            self._release(job_id, pool_name)
+        elif self.is_running:
+            self.queue.put(("release", job_id, None, pool_name))
+
+    @contextmanager
+    def slot(self, job_id: str, user_id: str, pool_name: str):
+        """ステージの実行中だけ資源の枠を確保する。同じジョブが既に持つ枠はそのまま使う"""
+        if self.is_owner:
+            granted = threading.Event()
+            self._enqueue(
+                pool_name,
+                _Request(job_id, user_id, granted.set, granted.set),
+            )
+            with span(f"wait_slot:{pool_name}"):
+                granted.wait()
+            if job_registry.is_cancelled(job_id):
+                raise JobCancelled(f"ジョブ {job_id} はキャンセルされました。")
+        elif self.is_running and self._worker_grant is not None:
+            self.queue.put(("acquire", job_id, user_id, pool_name))
+            with span(f"wait_slot:{pool_name}"):
+                self._worker_grant.acquire()
+            apply_budget(
+                pool_name, self._worker_slot.value, self._pools[pool_name].capacity
+            )
+        else:
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            self.release(job_id, pool_name)
+
+    @asynccontextmanager
+    async def async_slot(self, job_id: str, user_id: str, pool_name: str):
+        """APIプロセスのイベントループ上で、スレッドを占有せずに枠を待つ。
+        抜けた時点で、job_idの枠と待ち要求は全て解放される"""
+        loop = asyncio.get_running_loop()
+        granted = asyncio.Event()
+        notify = lambda: loop.call_soon_threadsafe(granted.set)
+        self.submit(job_id, user_id, pool_name, notify, notify)
+        try:
+            with span(f"wait_slot:{pool_name}"):
+                await granted.wait()
+            yield
+        finally:
+            self.release_job(job_id)
+
+    def collect_metrics(self) -> list[str]:
+        with self._lock:
+            pools = [
+                (name, pool.capacity, len(pool.holders), pool.queued)
+                for name, pool in self._pools.items()
+            ]
+        return (
+            gauge_lines(
+                "audily_scheduler_slots",
+                "Configured concurrent slots per resource pool.",
+                [({"pool": name}, capacity) for name, capacity, _, _ in pools],
+            )
+            + gauge_lines(
+                "audily_scheduler_slots_in_use",
+                "Slots currently held per resource pool.",
+                [({"pool": name}, in_use) for name, _, in_use, _ in pools],
+            )
+            + gauge_lines(
+                "audily_scheduler_queue_depth",
+                "Requests waiting for a slot per resource pool.",
+                [({"pool": name}, queued) for name, _, _, queued in pools],
+            )
+        )
+
+    # --- APIプロセス内部 ---
+
+    def _enqueue(self, pool_name: str, request: _Request):
+        with self._lock:
+            pool = self._pools[pool_name]
+            if request.job_id in pool.holders:
+                granted = [request]
+            else:
+                pool.enqueue(request)
+                granted = self._take_grants(pool)
+        self._notify(granted)
+
+    def _release(self, job_id: str, pool_name: str):
+        with self._lock:
+            pool = self._pools[pool_name]
+            pool.release(job_id)
+            granted = self._take_grants(pool)
+        self._notify(granted)
+
+    def _take_grants(self, pool: _Pool) -> list[_Request]:
+        granted = []
+        while len(pool.holders) < pool.capacity:
+            request = pool.pop_next()
+            if request is None:
+                break
+            pool.acquire(request.job_id)
+            granted.append(request)
+        return granted
+
+    def _notify(self, requests: list[_Request]):
+        # コールバックはジョブ管理の更新を伴うことがあるため、ロックの外で呼ぶ
+        for request in requests:
+            try:
+                request.on_grant()
+            except Exception as e:
+                print(f"ERROR: [{request.job_id}] 実行枠の割り当て通知に失敗しました: {e}")
+
+    def _grant_worker(self, job_id: str, pool_name: str) -> Callable[[], None]:
+        with self._lock:
+            worker = self._grants.get(job_id)
+        if worker is None:
+            return lambda: None
+        grant, slot_index = worker
+
+        def notify():
+            with self._lock:
+                slot_index.value = self._pools[pool_name].slot_indices.get(job_id, 0)
+            grant.release()
+
+        return notify
+
+    def _on_job_update(self, record: dict):
+        if record["state"] in TERMINAL_STATES:
+            self.release_job(record["job_id"])
+
+    def release_job(self, job_id: str):
+        """ジョブが持つ枠と待ち要求を全て解放する"""
+        dropped: list[_Request] = []
+        granted: list[_Request] = []
+        with self._lock:
+            self._grants.pop(job_id, None)
+            for pool in self._pools.values():
+                dropped.extend(pool.remove_job(job_id))
+                pool.release(job_id)
+                granted.extend(self._take_grants(pool))
+        for request in dropped:
+            if request.on_drop is not None:
+                request.on_drop()
+        self._notify(granted)
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if item == _STOP:
+                break
+            try:
+                action, job_id, user_id, pool_name = item
+                if action == "acquire":
+                    self._enqueue(
+                        pool_name,
+                        _Request(
+                            job_id, user_id, self._grant_worker(job_id, pool_name)
+                        ),
+                    )
+                else:
+                    self._release(job_id, pool_name)
+            except Exception as e:
+                print(f"ERROR: 実行枠の要求の処理に失敗しました: {e}")
+
+
+def _run_scheduled(grant, slot_index, budget: tuple, target, args: tuple):
+    job_scheduler._worker_grant = grant
+    job_scheduler._worker_slot = slot_index
+    # 起動時に得た枠のコアとスレッド数を、重いライブラリを読み込む前に設定する
+    apply_budget(*budget)
+    target(*args)
+
+
+job_scheduler = JobScheduler()
+metrics_hub.add_collector(job_scheduler.collect_metrics)
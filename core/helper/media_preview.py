@@ -0,0 +1,208 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+
+from fastapi import HTTPException
+
+from helper.ffmpeg_runner import (
+    probe_duration,
+    remember_duration,
+    run_ffmpeg_with_progress,
+)
+from helper.metrics import record_cache_lookup, track_stage
+from helper.thread_budget import ffmpeg_thread_args
+from helper.transcript_store import (
+    find_source_video,
+    is_valid_hash,
+    load_media_info,
+    save_media_info,
+    save_source_video,
+)
+
+# プレビューで切り出せる区間の最大の長さ (秒)
+PREVIEW_MAX_SECONDS = float(os.getenv("PREVIEW_MAX_SECONDS", "30"))
+
+
+class PreviewWindow:
+    """元ファイルのうち、プレビューとして処理する区間"""
+
+    def __init__(self, start: float, duration: float):
+        self.start = start
+        self.duration = duration
+
+    def cache_key(self, content_hash: str) -> str:
+        """区間ごとの文字起こしを保存するためのキー。元ファイルのハッシュと同じ形式にする"""
+        raw = f"{content_hash}:{self.start:.3f}:{self.duration:.3f}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def flight_params(self) -> dict:
+        return {"preview_start": self.start, "preview_duration": self.duration}
+
+
+def parse_preview_window(
+    start: Optional[float], duration: Optional[float]
+) -> Optional[PreviewWindow]:
+    """どちらも未指定ならNone (ファイル全体を処理する)"""
+    if start is None and duration is None:
+        return None
+    start = start or 0.0
+    duration = duration or PREVIEW_MAX_SECONDS
+    if start < 0 or duration <= 0:
+        raise HTTPException(
+            status_code=400, detail="プレビューの開始位置と長さが不正です。"
+        )
+    if duration > PREVIEW_MAX_SECONDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"プレビューの長さは{PREVIEW_MAX_SECONDS:g}秒以下にしてください。",
+        )
+    return PreviewWindow(start, duration)
+
+
+def resolve_stored_source(content_hash: str) -> tuple[Path, str]:
+    """プレビューなどで保存済みの元ファイルと、アップロード時のファイル名を返す"""
+    if not is_valid_hash(content_hash):
+        raise HTTPException(status_code=400, detail="無効なハッシュ値です。")
+    source_path = find_source_video(content_hash)
+    record_cache_lookup("source_upload", source_path is not None)
+    if source_path is None:
+        raise HTTPException(
+            status_code=404,
+            detail="保存済みの元ファイルが見つかりません。ファイルをアップロードしてください。",
+        )
+    info = load_media_info(content_hash) or {}
+    return source_path, info.get("original_filename", source_path.name)
+
+
+def link_stored_source(source_path: Path, destination: Path) -> Path:
+    """保存済みの元ファイルを、アップロードされたファイルの代わりにジョブの入力として置く。
+    ジョブは終了時に入力を削除するため、元ファイルそのものではなくリンクを渡す"""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source_path, destination)
+    except OSError:
+        shutil.copy2(source_path, destination)
+    return destination
+
+
+def stored_upload_path(
+    destination_dir: Path, original_filename: str, source_path: Path
+) -> Path:
+    """save_upload_fileと同じ命名規則で、保存済みの元ファイルを置く場所を決める"""
+    unique_stem = f"{uuid.uuid4()}_{Path(original_filename).stem}"
+    return destination_dir / f"{unique_stem}{source_path.suffix}"
+
+
+def prime_source(
+    content_hash: str, input_path: Path, original_filename: str
+) -> Optional[Path]:
+    """元ファイルと長さを保存し、同じファイルを再アップロードせずに処理できるようにする。
+    既に保存済みなら、調べ済みの長さを登録してffprobeを省く。
+    元ファイルはリンクで保存し、リンクできなければジョブの後に release_source で移動する"""
+    stored_path = save_source_video(content_hash, input_path)
+    info = load_media_info(content_hash)
+    record_cache_lookup("media_info", info is not None)
+    if info is not None and info.get("duration"):
+        remember_duration(input_path, info["duration"])
+        return stored_path
+    save_media_info(
+        content_hash,
+        {
+            "duration": probe_duration(input_path),
+            "original_filename": original_filename,
+        },
+    )
+    return stored_path
+
+
+def release_source(content_hash: Optional[str], input_path: Path):
+    """ジョブの入力を片付ける。prime_sourceで保存できなかった元ファイルは、
+    結果を返した後にここで成果物ストアへ移動し、それ以外は削除する"""
+    if not input_path.exists():
+        return
+    if content_hash is not None and find_source_video(content_hash) is None:
+        try:
+            save_source_video(content_hash, input_path, move=True)
+            return
+        except OSError as e:
+            print(f"警告: 元ファイルを保存できませんでした: {e}")
+    input_path.unlink()
+
+
+def reuse_media_info(content_hash: str, input_path: Path):
+    """保存済みの長さがあれば登録する。元ファイルは保存しない"""
+    info = load_media_info(content_hash)
+    record_cache_lookup("media_info", info is not None)
+    if info is not None and info.get("duration"):
+        remember_duration(input_path, info["duration"])
+
+
+def estimate_clip_bytes(input_path: Path, window: PreviewWindow) -> int:
+    """切り出す動画の大きさの見積もり。高画質・高速のエンコードで元ファイルより
+    ビットレートが上がるため、区間の割合の2倍とする"""
+    total_seconds = probe_duration(input_path)
+    if not total_seconds:
+        return 0
+    ratio = min(window.duration / total_seconds, 1.0)
+    return int(input_path.stat().st_size * ratio * 2)
+
+
+def cut_window(
+    input_path: Path,
+    output_path: Path,
+    window: PreviewWindow,
+    video: bool,
+    progress_callback: Optional[Callable[[float], None]] = None,
+):
+    """入力側のシーク (-iより前の-ss/-t) で、区間の部分だけをデコードして切り出す。
+    videoがFalseなら、分離モデルに渡す44.1kHz・ステレオのWAVにする"""
+    total_seconds = probe_duration(input_path)
+    if total_seconds is not None and window.start >= total_seconds:
+        raise ValueError(
+            f"プレビューの開始位置 ({window.start:g}秒) がファイルの長さ "
+            f"({total_seconds:g}秒) を超えています。"
+        )
+
+    if video:
+        # 後の字幕の焼き付けで再エンコードするため、ここでは速度を優先する
+        codec_args = [
+            "-c:v",
+            "libx264",
+            "-preset",
+            "ultrafast",
+            "-crf",
+            "18",
+            "-c:a",
+            "aac",
+        ]
+    else:
+        codec_args = ["-vn", "-ac", "2", "-ar", "44100", "-c:a", "pcm_s16le"]
+    command = [
+        "ffmpeg",
+        "-ss",
+        f"{window.start:.3f}",
+        "-t",
+        f"{window.duration:.3f}",
+        "-i",
+        str(input_path),
+        *codec_args,
+        *ffmpeg_thread_args(),
+        "-y",
+        str(output_path),
+    ]
+    print(f"プレビュー区間を切り出しています: {' '.join(command)}")
+
+    clip_seconds = window.duration
+    if total_seconds is not None:
+        clip_seconds = min(clip_seconds, total_seconds - window.start)
+    try:
+        with track_stage("ffmpeg_preview_cut"):
+            run_ffmpeg_with_progress(command, clip_seconds, progress_callback)
+    except FileNotFoundError:
+        raise RuntimeError("FFmpegがインストールされていないか、PATHが通っていません。")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"プレビュー区間の切り出しに失敗しました: {e.stderr}")
@@ -0,0 +1,328 @@
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Optional
+
+from helper.tracing import span
+
+# 数秒の変換から数十分の分離まで扱うため、上限は長めに取る
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_STOP = "__stop__"
+
+# 計測値にラベルとして付ける処理の種類 (operation_historyのoperation_typeと同じ値)
+current_operation: ContextVar[str] = ContextVar("current_operation", default="unknown")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Iterable[tuple[str, str]]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def _apply(self, key: tuple, amount: float):
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def inc(self, amount: float = 1.0, **labels):
+        metrics_hub.record(self.name, tuple(labels[name] for name in self.labelnames), amount)
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            labels = _format_labels(zip(self.labelnames, key))
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: tuple[str, ...],
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに [各バケットの件数..., 合計値, 件数]
+        self._values: dict[tuple, list[float]] = {}
+
+    def _apply(self, key: tuple, value: float):
+        series = self._values.setdefault(key, [0.0] * (len(self.buckets) + 2))
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def observe(self, value: float, **labels):
+        metrics_hub.record(self.name, tuple(labels[name] for name in self.labelnames), value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._values.items()):
+            base = list(zip(self.labelnames, key))
+            for upper, count in zip(self.buckets, series):
+                labels = _format_labels(base + [("le", _format_value(upper))])
+                lines.append(f"{self.name}_bucket{labels} {_format_value(count)}")
+            labels = _format_labels(base + [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_sum{_format_labels(base)} {repr(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(base)} {_format_value(series[-1])}")
+        return lines
+
+
+class MetricsHub:
+    """計測値の集約。APIプロセス(またはworker.py)が値を保持し、forkされた
+    ワーカープロセスからの記録はプロセス間キュー経由で受け取る"""
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.owner_pid: Optional[int] = None
+        self._metrics: dict[str, object] = {}
+        self._collectors: list[Callable[[], list[str]]] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self.owner_pid is not None
+
+    @property
+    def is_owner(self) -> bool:
+        return self.owner_pid == os.getpid()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], list[str]]):
+        """取得時に値を計算するゲージ (待ち行列の長さやメモリ使用量など) を登録する"""
+        self._collectors.append(collector)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.owner_pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        if self._thread is None or not self.is_owner:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+        self.owner_pid = None
+
+    def record(self, name: str, key: tuple, value: float):
+        if self.is_running and not self.is_owner:
+            self.queue.put((name, key, value))
+            return
+        self._apply(name, key, value)
+
+    def _apply(self, name: str, key: tuple, value: float):
+        with self._lock:
+            self._metrics[name]._apply(key, value)
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if item == _STOP:
+                break
+            try:
+                self._apply(*item)
+            except Exception as e:
+                print(f"ERROR: 計測値の集計に失敗しました: {e}")
+
+    def render(self) -> str:
+        lines: list[str] = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.extend(metric.render())
+        for collector in list(self._collectors):
+            try:
+                lines.extend(collector())
+            except Exception as e:
+                print(f"ERROR: 計測値の取得に失敗しました: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics_hub = MetricsHub()
+
+STAGE_DURATION = metrics_hub.register(
+    Histogram(
+        "audily_stage_duration_seconds",
+        "Duration of processing stages.",
+        ("operation_type", "stage"),
+    )
+)
+STAGE_FAILURES = metrics_hub.register(
+    Counter(
+        "audily_stage_failures_total",
+        "Processing stages that raised an exception.",
+        ("operation_type", "stage"),
+    )
+)
+BYTES_PROCESSED = metrics_hub.register(
+    Counter(
+        "audily_bytes_processed_total",
+        "Bytes received from uploads (in) and written as results (out).",
+        ("operation_type", "direction"),
+    )
+)
+CACHE_REQUESTS = metrics_hub.register(
+    Counter(
+        "audily_cache_requests_total",
+        "Cache lookups by result.",
+        ("cache", "result"),
+    )
+)
+
+
+@contextmanager
+def operation_context(operation_type: str):
+    """このブロック内の計測値に operation_type ラベルを付ける"""
+    token = current_operation.set(operation_type)
+    try:
+        yield
+    finally:
+        current_operation.reset(token)
+
+
+def with_operation(operation_type: str):
+    """ワーカー関数全体を operation_context で包むデコレーター"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with operation_context(operation_type):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def track_stage(stage: str, operation_type: Optional[str] = None):
+    """ステージの処理時間を集計し、ジョブのトレース中ならスパンとしても記録する"""
+    operation_type = operation_type or current_operation.get()
+    started = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    except BaseException:
+        STAGE_FAILURES.inc(operation_type=operation_type, stage=stage)
+        raise
+    finally:
+        STAGE_DURATION.observe(
+            time.perf_counter() - started, operation_type=operation_type, stage=stage
+        )
+
+
+def record_bytes(direction: str, size: int, operation_type: Optional[str] = None):
+    BYTES_PROCESSED.inc(
+        size,
+        operation_type=operation_type or current_operation.get(),
+        direction=direction,
+    )
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def gauge_lines(name: str, help_text: str, samples: Iterable[tuple[dict, float]]) -> list[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(labels.items())} {_format_value(value)}")
+    return lines
+
+
+def read_rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _collect_cache_hit_ratio() -> list[str]:
+    with metrics_hub._lock:
+        caches = {key[0] for key in CACHE_REQUESTS._values}
+        samples = []
+        for cache in sorted(caches):
+            hits = CACHE_REQUESTS.value(cache=cache, result="hit")
+            total = hits + CACHE_REQUESTS.value(cache=cache, result="miss")
+            samples.append(({"cache": cache}, hits / total if total else 0.0))
+    return gauge_lines("audily_cache_hit_ratio", "Cache hit ratio since start.", samples)
+
+
+def _collect_process_rss() -> list[str]:
+    rss = read_rss_bytes(os.getpid())
+    samples = [({}, rss)] if rss is not None else []
+    return gauge_lines(
+        "audily_process_resident_memory_bytes",
+        "Resident memory of this API or worker process.",
+        samples,
+    )
+
+
+metrics_hub.add_collector(_collect_cache_hit_ratio)
+metrics_hub.add_collector(_collect_process_rss)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics_hub.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """FastAPIを持たないworker.py用に、/metricsだけを返すHTTPサーバーを起動する"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"INFO: メトリクスを :{port}/metrics で公開しています。")
+    return server
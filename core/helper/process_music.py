@@ -1,14 +1,29 @@
 import os
 import uuid
 from pathlib import Path
+from typing import Callable, Optional
+
+from helper.ffmpeg_runner import probe_duration
+from helper.metrics import track_stage
+from helper.thread_budget import configure_tensorflow
+from helper.tracing import span
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
-from spleeter.separator import Separator
+
+SAMPLE_RATE = 44100
+# 進捗報告付きの分離では、この秒数ごとに区切って処理する
+CHUNK_SECONDS = 30.0
 
 
 class Music:
     def __init__(self, stems: str = "spleeter:5stems") -> None:
+        # TensorFlowの読み込みは重いため、モデルを作る時点まで遅らせる
+        from spleeter.audio.adapter import AudioAdapter
+        from spleeter.separator import Separator
+
+        configure_tensorflow()
         self.separator = Separator(stems)
+        self.audio_adapter = AudioAdapter.default()
         print("初期化が完了しました。")
 
         self.vocals = None
@@ -20,8 +35,11 @@ class Music:
         self.output_directory = None
 
     def divide(
-        self, input_file_path: str, output_base_dir: str = "./output-python"
-    ) -> None:
+        self,
+        input_file_path: str,
+        output_base_dir: str = "./output-python",
+        progress_callback: Optional[Callable[[float], None]] = None,
+    ) -> Path:
         input_path = Path(input_file_path)
         if not input_path.exists():
             raise FileNotFoundError(f"入力ファイルが見つかりません: {input_file_path}")
@@ -35,11 +53,18 @@ class Music:
 
         print(f"ファイルを分離しています... 出力先: {self.output_directory}")
 
-        self.separator.separate_to_file(
-            str(input_path),
-            output_base_dir,
-            filename_format=output_subdir_name + "/{instrument}.{codec}",
-        )
+        total_seconds = probe_duration(input_path) if progress_callback else None
+        with track_stage("separation"):
+            if total_seconds:
+                self._separate_in_chunks(
+                    input_path, self.output_directory, total_seconds, progress_callback
+                )
+            else:
+                self.separator.separate_to_file(
+                    str(input_path),
+                    output_base_dir,
+                    filename_format=output_subdir_name + "/{instrument}.{codec}",
+                )
 
         print("分離が完了しました。")
 
@@ -55,6 +80,46 @@ class Music:
             if not path.exists():
                 print(f"警告: {part_name} のファイルが見つかりませんでした: {path}")
 
+        return result_dir
+
+    def _separate_in_chunks(
+        self,
+        input_path: Path,
+        output_dir: Path,
+        total_seconds: float,
+        progress_callback: Callable[[float], None],
+    ):
+        import numpy as np
+
+        output_dir.mkdir(parents=True, exist_ok=True)
+        stem_chunks: dict[str, list] = {}
+
+        offset = 0.0
+        while offset < total_seconds:
+            with span("decode_chunk", offset=offset):
+                waveform, _ = self.audio_adapter.load(
+                    str(input_path),
+                    offset=offset,
+                    duration=CHUNK_SECONDS,
+                    sample_rate=SAMPLE_RATE,
+                )
+            with span("separate_chunk", offset=offset):
+                separated = self.separator.separate(waveform)
+            for instrument, data in separated.items():
+                stem_chunks.setdefault(instrument, []).append(data)
+            offset += CHUNK_SECONDS
+            progress_callback(min(offset / total_seconds * 100, 100.0))
+
+        for instrument, chunks in stem_chunks.items():
+            with span("save_stem", instrument=instrument):
+                self.audio_adapter.save(
+                    str(output_dir / f"{instrument}.wav"),
+                    np.concatenate(chunks),
+                    SAMPLE_RATE,
+                    "wav",
+                    "128k",
+                )
+
     def get_divided_paths(self) -> dict:
         return {
             "vocals": self.vocals,
@@ -0,0 +1,177 @@
+import importlib.util
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# 起動時にバックグラウンドで読み込んでおく機能 (空にすると初回利用時まで読み込まない)。
+# separationはワーカープロセスで読み込むため、指定してもAPIプロセスでは読み込まない
+WARMUP_CAPABILITIES = [
+    name.strip()
+    for name in os.getenv("WARMUP_CAPABILITIES", "gemini").split(",")
+    if name.strip()
+]
+
+import_seconds: dict[str, float] = {}
+
+
+@contextmanager
+def import_timer(module_name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        import_seconds[module_name] = round(time.perf_counter() - started, 3)
+
+
+class LazyResource:
+    """重いモデルやライブラリを初回利用時(またはウォームアップ時)に一度だけ読み込む"""
+
+    def __init__(
+        self,
+        name: str,
+        factory: Callable[[], object],
+        worker_only: bool = False,
+        module: Optional[str] = None,
+    ):
+        self.name = name
+        self.factory = factory
+        # Trueなら、ジョブのワーカープロセスの中でだけ読み込む。読み込んだプロセスからforkした
+        # 子プロセスでは使えないもの (TensorFlowのスレッドプールなど) はAPIプロセスに読み込まない
+        self.worker_only = worker_only
+        # worker_onlyの場合に、importできるかだけを確かめるモジュール
+        self.module = module
+        # ウォームアップの対象で、読み込みが終わるまでAPI全体を準備中とするか
+        self.required = False
+        self.state = "not_loaded"
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def get(self):
+        if self.state == "ready":
+            return self._value
+        with self._lock:
+            if self.state == "ready":
+                return self._value
+            self.state = "loading"
+            started = time.perf_counter()
+            print(f"INFO: '{self.name}' を読み込んでいます...")
+            try:
+                self._value = self.factory()
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                print(f"ERROR: '{self.name}' の読み込みに失敗しました: {e}")
+                raise
+            self.load_seconds = round(time.perf_counter() - started, 3)
+            self.state = "ready"
+            print(f"INFO: '{self.name}' の読み込みが完了しました ({self.load_seconds}秒)。")
+            return self._value
+
+    def warm_up_in_background(self):
+        def load():
+            try:
+                self.get()
+            except Exception:
+                pass
+
+        threading.Thread(target=load, name=f"warmup-{self.name}", daemon=True).start()
+
+    def wait_until_loaded(self):
+        """読み込み中なら終わるまで待つ。読み込み中のスレッドがimportのロックを持ったまま
+        forkすると、子プロセスが同じモジュールをimportしたときに止まってしまう"""
+        if self.state == "loading":
+            with self._lock:
+                pass
+
+    def describe(self) -> dict:
+        state, error = self.state, self.error
+        if self.worker_only and state == "not_loaded":
+            # このプロセスでは読み込まないため、ワーカーで読み込めるかだけを返す
+            if self.module is None or importlib.util.find_spec(self.module) is not None:
+                state = "loadable"
+            else:
+                state, error = "unavailable", f"{self.module} がインストールされていません。"
+        return {
+            "ready": self.is_ready,
+            "required": self.required,
+            "state": state,
+            "load_seconds": self.load_seconds,
+            "error": error,
+        }
+
+
+_resources: dict[str, LazyResource] = {}
+
+
+def register_resource(
+    name: str,
+    factory: Callable[[], object],
+    worker_only: bool = False,
+    module: Optional[str] = None,
+) -> LazyResource:
+    resource = LazyResource(name, factory, worker_only, module)
+    _resources[name] = resource
+    return resource
+
+
+def warm_up():
+    for name in WARMUP_CAPABILITIES:
+        resource = _resources.get(name)
+        if resource is None:
+            print(f"警告: 未登録の機能はウォームアップできません: {name}")
+            continue
+        if resource.worker_only:
+            print(f"INFO: '{name}' はジョブのワーカープロセスで読み込むため、ウォームアップしません。")
+            continue
+        resource.required = True
+        resource.warm_up_in_background()
+
+
+def wait_for_loading_resources():
+    """ワーカープロセスをforkする直前に呼ぶ"""
+    for resource in list(_resources.values()):
+        resource.wait_until_loaded()
+
+
+def _check_database() -> dict:
+    from helper.db_handler import get_connection
+
+    return {"ready": get_connection() is not None}
+
+
+def _check_ffmpeg() -> dict:
+    missing = [tool for tool in ("ffmpeg", "ffprobe") if shutil.which(tool) is None]
+    return {"ready": not missing, "missing": missing}
+
+
+def is_available(capability: dict) -> bool:
+    """読み込み済みか、ワーカーで読み込める (loadable) 機能ならTrue"""
+    return capability["ready"] or capability.get("state") == "loadable"
+
+
+def readiness_report() -> dict:
+    capabilities = {
+        "database": _check_database(),
+        "ffmpeg": _check_ffmpeg(),
+    }
+    for name, resource in _resources.items():
+        capabilities[name] = resource.describe()
+    # ウォームアップしない機能 (初回利用時やワーカーで読み込むもの) は全体の判定に含めない
+    return {
+        "ready": all(
+            capability["ready"]
+            for capability in capabilities.values()
+            if capability.get("required", True)
+        ),
+        "capabilities": capabilities,
+        "import_seconds": import_seconds,
+    }
@@ -1,11 +1,16 @@
 import shutil
 import uuid
 from pathlib import Path
+from typing import Optional
 
 from fastapi import HTTPException, UploadFile
 
+from helper.metrics import record_bytes, track_stage
 
-async def save_upload_file(file: UploadFile, destination_dir: Path) -> Path:
+
+async def save_upload_file(
+    file: UploadFile, destination_dir: Path, operation_type: Optional[str] = None
+) -> Path:
     unique_id = str(uuid.uuid4())
     unique_stem = f"{unique_id}_{Path(file.filename).stem}"
     file_extension = Path(file.filename).suffix
@@ -13,8 +18,10 @@ async def save_upload_file(file: UploadFile, destination_dir: Path) -> Path:
     saved_filepath = destination_dir / f"{unique_stem}{file_extension}"
 
     try:
-        with open(saved_filepath, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        with track_stage("upload_ingest", operation_type):
+            with open(saved_filepath, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+        record_bytes("in", saved_filepath.stat().st_size, operation_type)
         return saved_filepath
     except Exception as e:
         raise HTTPException(
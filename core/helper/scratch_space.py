@@ -0,0 +1,139 @@
+import fcntl
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+# 中間ファイルはメモリ上(tmpfs)に置き、予算を超える分だけディスクへ逃がす
+SCRATCH_RAM_DIR = Path(os.getenv("SCRATCH_RAM_DIR", "/dev/shm/audily_scratch"))
+SCRATCH_DISK_DIR = Path(os.getenv("SCRATCH_DISK_DIR", "./scratch"))
+SCRATCH_MEMORY_BUDGET_BYTES = int(
+    os.getenv("SCRATCH_MEMORY_BUDGET_BYTES", str(2 * 1024**3))
+)
+# tmpfs上には、空き容量のこの割合までしか確保しない
+SCRATCH_RAM_FREE_RATIO = 0.5
+
+RESERVATION_FILE = ".reservation.json"
+# 空き容量の確認と予約を、全プロセスで1件ずつ行うためのロックファイル
+BUDGET_LOCK_FILE = ".budget.lock"
+
+
+def estimate_wav_bytes(
+    duration_seconds: Optional[float],
+    sample_rate: int = 44100,
+    channels: int = 2,
+    count: int = 1,
+) -> int:
+    if not duration_seconds:
+        return 0
+    # 16bit PCMとして見積もる
+    return int(duration_seconds * sample_rate * channels * 2 * count)
+
+
+def _directory_size(directory: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _ram_usage_bytes() -> int:
+    """全プロセスのジョブが使用中(または予約済み)のメモリ上スクラッチ容量"""
+    if not SCRATCH_RAM_DIR.exists():
+        return 0
+    usage = 0
+    for job_dir in SCRATCH_RAM_DIR.iterdir():
+        if not job_dir.is_dir():
+            continue
+        reserved = 0
+        try:
+            with open(job_dir / RESERVATION_FILE, "r", encoding="utf-8") as f:
+                reserved = json.load(f)["bytes"]
+        except (OSError, json.JSONDecodeError, KeyError):
+            pass
+        usage += max(reserved, _directory_size(job_dir))
+    return usage
+
+
+@contextmanager
+def _budget_lock():
+    SCRATCH_RAM_DIR.mkdir(parents=True, exist_ok=True)
+    with open(SCRATCH_RAM_DIR / BUDGET_LOCK_FILE, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class ScratchSpace:
+    def __init__(self, job_id: Optional[str] = None):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.ram_dir = SCRATCH_RAM_DIR / self.job_id
+        self.disk_dir = SCRATCH_DISK_DIR / self.job_id
+        self.reserved_bytes = 0
+
+    def __enter__(self) -> "ScratchSpace":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+    def _ram_available(self, expected_bytes: int) -> bool:
+        try:
+            free_bytes = shutil.disk_usage(SCRATCH_RAM_DIR).free
+        except OSError:
+            return False
+        if expected_bytes > free_bytes * SCRATCH_RAM_FREE_RATIO:
+            return False
+        return _ram_usage_bytes() + expected_bytes <= SCRATCH_MEMORY_BUDGET_BYTES
+
+    def _reserve(self, expected_bytes: int):
+        self.reserved_bytes += expected_bytes
+        with open(self.ram_dir / RESERVATION_FILE, "w", encoding="utf-8") as f:
+            json.dump({"bytes": self.reserved_bytes}, f)
+
+    def _reserve_ram(self, expected_bytes: int) -> bool:
+        # 他のプロセスが確認から予約までの間に割り込まないよう、ロックを取って行う
+        try:
+            with _budget_lock():
+                if not self._ram_available(expected_bytes):
+                    return False
+                self.ram_dir.mkdir(parents=True, exist_ok=True)
+                self._reserve(expected_bytes)
+                return True
+        except OSError:
+            return False
+
+    def _base_dir(self, expected_bytes: int) -> Path:
+        # 大きさの分からないファイルは予算に計上できないため、ディスクに置く
+        if expected_bytes > 0 and self._reserve_ram(expected_bytes):
+            return self.ram_dir
+        if expected_bytes > 0:
+            print(
+                f"[{self.job_id}] メモリ上のスクラッチ領域が不足しているため、ディスクを使用します。"
+            )
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        return self.disk_dir
+
+    def allocate(self, name: str, expected_bytes: int) -> Path:
+        """expected_bytesは書き込む大きさの見積もり。メモリ上に置く場合はこの分を予約する"""
+        return self._base_dir(expected_bytes) / name
+
+    def allocate_dir(self, name: str, expected_bytes: int) -> Path:
+        directory = self._base_dir(expected_bytes) / name
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory
+
+    def cleanup(self):
+        for directory in (self.ram_dir, self.disk_dir):
+            if directory.exists():
+                shutil.rmtree(directory, ignore_errors=True)
+        self.reserved_bytes = 0
@@ -0,0 +1,11 @@
+import os
+from pathlib import Path
+
+# APIと全ワーカーから同じパスで見える場所を指定する。
+# 既定ではカレントディレクトリを使い、従来と同じ配置になる。
+# SQLiteのジョブキューは単一ホスト専用のため、DB (AUDILY_DB_PATH) はローカルディスクに置く
+SHARED_STORAGE_DIR = Path(os.getenv("SHARED_STORAGE_DIR", "."))
+
+
+def shared_path(name: str) -> Path:
+    return SHARED_STORAGE_DIR / name
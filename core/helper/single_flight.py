@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Optional, Union
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from helper.db_handler import log_operation, log_operations
+from helper.job_registry import TERMINAL_STATES, job_registry
+from helper.metrics import record_cache_lookup
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# 合流したリクエストの履歴に記録する、共有ジョブの終了状態
+FOLLOWER_STATUS_BY_STATE = {
+    "succeeded": "completed",
+    "cancelled": "cancelled",
+    "failed": "failed: SharedJobFailed",
+}
+
+
+def _hash_file_object(file_object) -> str:
+    sha256 = hashlib.sha256()
+    file_object.seek(0)
+    for chunk in iter(lambda: file_object.read(HASH_CHUNK_SIZE), b""):
+        sha256.update(chunk)
+    file_object.seek(0)
+    return sha256.hexdigest()
+
+
+async def hash_upload(file: UploadFile) -> str:
+    """アップロードの内容のSHA-256。保存前に計算し、読み取り位置は先頭に戻す"""
+    return await run_in_threadpool(_hash_file_object, file.file)
+
+
+def flight_key(operation_type: str, content_hash: str, **params) -> str:
+    raw = json.dumps(
+        [operation_type, content_hash, params], sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class FlightClaim:
+    """受付中でjob_idがまだ決まっていない間、キーを予約しておくための目印"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.job_id: Optional[str] = None
+        # registerかreleaseで立つ。同じキーのリクエストはそれまで待つ
+        self.settled = asyncio.Event()
+
+
+class SingleFlight:
+    """同じ入力・同じ設定で実行中のジョブがあれば、新しく実行せずにそのジョブを共有する。
+    キーは実行中の間だけ保持し、ジョブが終了した時点で合流したユーザーの履歴を記録する"""
+
+    def __init__(self):
+        # key -> job_id (受付中はFlightClaim)
+        self._jobs: dict[str, Union[str, FlightClaim]] = {}
+        self._keys: dict[str, str] = {}
+        # job_id -> 合流したリクエストの (user_id, source_filename)
+        self._followers: dict[str, list[tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        job_registry.add_listener(self._on_job_update)
+
+    def stop(self):
+        job_registry.remove_listener(self._on_job_update)
+
+    async def attach_or_claim(
+        self, key: str, user_id: str, operation_type: str, source_filename: str
+    ) -> tuple[Optional[str], Optional[FlightClaim]]:
+        """実行中の同一ジョブがあれば合流して (job_id, None) を返す。
+        無ければキーを予約して (None, claim) を返す。予約した側はジョブを作ったらregisterを、
+        それより前に受付をやめる場合はreleaseを必ず呼ぶ"""
+        while True:
+            with self._lock:
+                entry = self._jobs.get(key)
+                if entry is None:
+                    claim = FlightClaim(key)
+                    self._jobs[key] = claim
+                    break
+            if isinstance(entry, FlightClaim):
+                # 同時に届いた同一リクエストの受付が終わるまで待ち、その結果に合流する
+                await entry.settled.wait()
+                continue
+
+            job_id = entry
+            record = job_registry.get(job_id)
+            with self._lock:
+                if self._jobs.get(key) != job_id:
+                    # 確認している間にジョブが終了した
+                    continue
+                if record is None or record["state"] in TERMINAL_STATES:
+                    del self._jobs[key]
+                    self._keys.pop(job_id, None)
+                    continue
+                self._followers.setdefault(job_id, []).append(
+                    (user_id, source_filename)
+                )
+            record_cache_lookup("in_flight_job", True)
+            log_operation(user_id, operation_type, source_filename, "started")
+            print(
+                f"[{job_id}] 実行中の同一ジョブに、{user_id} のリクエストを合流させました。"
+            )
+            return job_id, None
+
+        record_cache_lookup("in_flight_job", False)
+        return None, claim
+
+    def register(self, claim: FlightClaim, job_id: str):
+        """予約したキーにjob_idを結び付ける。以降はジョブの終了でキーが外れる"""
+        with self._lock:
+            if self._jobs.get(claim.key) is claim:
+                self._jobs[claim.key] = job_id
+                self._keys[job_id] = claim.key
+            claim.job_id = job_id
+        claim.settled.set()
+
+    def release(self, claim: FlightClaim):
+        """registerする前に受付をやめたときの予約の解除。待っていたリクエストは予約を取り直す"""
+        with self._lock:
+            if self._jobs.get(claim.key) is claim:
+                del self._jobs[claim.key]
+        claim.settled.set()
+
+    def has_followers(self, job_id: str) -> bool:
+        with self._lock:
+            return bool(self._followers.get(job_id))
+
+    def _on_job_update(self, record: dict):
+        if record["state"] not in TERMINAL_STATES:
+            return
+        job_id = record["job_id"]
+        with self._lock:
+            key = self._keys.pop(job_id, None)
+            if key is not None and self._jobs.get(key) == job_id:
+                del self._jobs[key]
+            followers = self._followers.pop(job_id, [])
+        status = FOLLOWER_STATUS_BY_STATE[record["state"]]
+        log_operations(
+            [
+                (user_id, record["kind"], source_filename, status)
+                for user_id, source_filename in followers
+            ]
+        )
+
+
+single_flight = SingleFlight()
@@ -1,4 +1,77 @@
+import math
+import re
 from pathlib import Path
+from typing import Union
+
+SUBTITLE_FORMATS = ("srt", "vtt", "ass")
+
+_SECONDS_FIELD = re.compile(r"\d+(?:\.\d+)?", re.ASCII)
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,{font_name},20,&H00FFFFFF,&H000000FF,&H00000000,&H64000000,0,0,0,0,100,100,0,0,1,2,0,2,10,10,20,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+def parse_timestamp(value: Union[str, int, float]) -> float:
+    """HH:MM:SS.mmm・MM:SS.mmm・SS.mmm (小数点は "," も可) か秒数を、秒に変換する。
+    解釈できなければValueErrorを送出する"""
+    if isinstance(value, bool):
+        raise ValueError(f"タイムスタンプの形式が不正です: {value!r}")
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    elif isinstance(value, str):
+        *larger, last = value.strip().replace(",", ".").split(":")
+        if (
+            len(larger) > 2
+            or not _SECONDS_FIELD.fullmatch(last)
+            or not all(field.isascii() and field.isdigit() for field in larger)
+        ):
+            raise ValueError(f"タイムスタンプの形式が不正です: {value!r}")
+        # 分・秒の欄は60未満に限る (先頭の欄は上限なし)
+        if (larger and float(last) >= 60) or any(int(f) >= 60 for f in larger[1:]):
+            raise ValueError(f"タイムスタンプの形式が不正です: {value!r}")
+        seconds = float(last)
+        for position, field in enumerate(reversed(larger), 1):
+            seconds += int(field) * 60**position
+    else:
+        raise ValueError(f"タイムスタンプの形式が不正です: {value!r}")
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f"タイムスタンプの形式が不正です: {value!r}")
+    return seconds
+
+
+def estimate_subtitle_bytes(data: list) -> int:
+    """字幕ファイルの大きさの見積もり。1件ごとの番号・時刻・改行と、ASSのヘッダーを含める"""
+    return len(ASS_HEADER.encode("utf-8")) + sum(
+        len(str(item.get("text", "")).encode("utf-8")) + 96 for item in data
+    )
+
+
+def format_timestamp(seconds: float, decimal_separator: str = ".") -> str:
+    """秒を HH:MM:SS.mmm (SRTは decimal_separator="," で HH:MM:SS,mmm) にする"""
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    whole, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{whole:02d}{decimal_separator}{milliseconds:03d}"
+
+
+def format_ass_timestamp(seconds: float) -> str:
+    """秒を H:MM:SS.cc にする"""
+    centiseconds = round(seconds * 100)
+    hours, centiseconds = divmod(centiseconds, 360_000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    whole, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{whole:02d}.{centiseconds:02d}"
 
 
 class SubtitleGenerator:
@@ -6,8 +79,8 @@ class SubtitleGenerator:
     def create_srt_from_timestamped_data(data: list, output_path: Path):
         srt_content = ""
         for i, item in enumerate(data, 1):
-            start_time = item["start"].replace(".", ",")
-            end_time = item["end"].replace(".", ",")
+            start_time = format_timestamp(parse_timestamp(item["start"]), ",")
+            end_time = format_timestamp(parse_timestamp(item["end"]), ",")
             text = item["text"]
 
             srt_content += f"{i}\n"
@@ -17,3 +90,47 @@ class SubtitleGenerator:
         with open(output_path, "w", encoding="utf-8") as f:
             f.write(srt_content)
         print(f"正確なタイムスタンプでSRTファイルを生成しました: {output_path}")
+
+    @staticmethod
+    def create_vtt_from_timestamped_data(data: list, output_path: Path):
+        vtt_content = "WEBVTT\n\n"
+        for item in data:
+            start_time = format_timestamp(parse_timestamp(item["start"]))
+            end_time = format_timestamp(parse_timestamp(item["end"]))
+            vtt_content += f"{start_time} --> {end_time}\n"
+            vtt_content += f"{item['text']}\n\n"
+
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(vtt_content)
+        print(f"WebVTTファイルを生成しました: {output_path}")
+
+    @staticmethod
+    def create_ass_from_timestamped_data(
+        data: list, output_path: Path, font_name: str = "Noto Sans JP"
+    ):
+        ass_content = ASS_HEADER.format(font_name=font_name)
+        for item in data:
+            text = item["text"].replace("\n", "\\N")
+            start_time = format_ass_timestamp(parse_timestamp(item["start"]))
+            end_time = format_ass_timestamp(parse_timestamp(item["end"]))
+            ass_content += (
+                f"Dialogue: 0,{start_time},{end_time},"
+                f"Default,,0,0,0,,{text}\n"
+            )
+
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(ass_content)
+        print(f"ASSファイルを生成しました: {output_path}")
+
+    @staticmethod
+    def create_from_timestamped_data(
+        data: list, output_path: Path, subtitle_format: str = "srt"
+    ):
+        if subtitle_format == "srt":
+            SubtitleGenerator.create_srt_from_timestamped_data(data, output_path)
+        elif subtitle_format == "vtt":
+            SubtitleGenerator.create_vtt_from_timestamped_data(data, output_path)
+        elif subtitle_format == "ass":
+            SubtitleGenerator.create_ass_from_timestamped_data(data, output_path)
+        else:
+            raise ValueError(f"未対応の字幕形式です: {subtitle_format}")
@@ -0,0 +1,133 @@
+import math
+import os
+from pathlib import Path
+from typing import Optional
+
+# CPUを多く使い、コアを分け合う必要がある資源 (geminiはネットワーク待ちが主なので対象外)
+CPU_BOUND_POOLS = ("separation", "ffmpeg")
+# 0にすると、スレッド数だけ制限してコアの固定は行わない
+CPU_PINNING = os.getenv("CPU_PINNING", "1") != "0"
+
+_CGROUP_V2_CPU_MAX = Path("/sys/fs/cgroup/cpu.max")
+_CGROUP_V1_QUOTA = Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+_CGROUP_V1_PERIOD = Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """コンテナのCPU上限 (コア数換算)。制限が無ければNone"""
+    try:
+        if _CGROUP_V2_CPU_MAX.exists():
+            quota, period = _CGROUP_V2_CPU_MAX.read_text().split()
+            if quota == "max":
+                return None
+            return int(quota) / int(period)
+        if _CGROUP_V1_QUOTA.exists():
+            quota = int(_CGROUP_V1_QUOTA.read_text())
+            if quota <= 0:
+                return None
+            return quota / int(_CGROUP_V1_PERIOD.read_text())
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus() -> list[int]:
+    """このプロセスが使えるコア。cgroupのCPU上限があれば、その分だけに絞る"""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = cpus[: max(1, math.ceil(limit))]
+    return cpus
+
+
+# 起動時に使えたコア。ワーカーが自分をコアに固定した後も、割り当ての基準はこちらを使う
+ALLOWED_CPUS = available_cpus()
+
+
+def cpu_slice(index: int, capacity: int, cpus: Optional[list[int]] = None) -> list[int]:
+    """資源の枠数で使えるコアを等分し、index番目の枠に割り当てるコアを返す。
+    枠数がコア数より多い場合は、複数の枠で同じコアを共有する"""
+    cpus = cpus or ALLOWED_CPUS
+    size = max(1, len(cpus) // max(1, capacity))
+    start = (index * size) % len(cpus)
+    return [cpus[(start + i) % len(cpus)] for i in range(size)]
+
+
+class ThreadBudget:
+    def __init__(self, threads: int, cpus: Optional[list[int]] = None):
+        self.threads = max(1, threads)
+        # Noneならコアを固定しない
+        self.cpus = cpus
+
+    @property
+    def inter_op_threads(self) -> int:
+        return 1 if self.threads < 4 else 2
+
+
+# このプロセスで資源ごとに使うスレッド数
+_budgets: dict[str, ThreadBudget] = {}
+
+
+def set_default_budgets(capacities: dict[str, int]):
+    """枠を得る前の処理 (APIプロセス内の処理など) に使う、コアを固定しないスレッド数"""
+    cpu_count = len(ALLOWED_CPUS)
+    for pool_name in CPU_BOUND_POOLS:
+        if pool_name in capacities:
+            threads = max(1, cpu_count // max(1, capacities[pool_name]))
+            _budgets[pool_name] = ThreadBudget(threads)
+
+
+def apply_budget(pool_name: str, index: int, capacity: int):
+    """ワーカープロセスが資源の枠を得たときに呼ぶ。割り当てたコアにプロセスを固定し、
+    TensorFlow・ffmpeg・OpenMPのスレッド数をコア数に合わせる"""
+    if pool_name not in CPU_BOUND_POOLS:
+        return
+    cpus = cpu_slice(index, capacity)
+    budget = ThreadBudget(len(cpus), cpus if CPU_PINNING else None)
+    _budgets[pool_name] = budget
+
+    if budget.cpus is not None:
+        try:
+            # 以降に起動するスレッドとffmpegなどの子プロセスにも引き継がれる
+            os.sched_setaffinity(0, budget.cpus)
+        except (AttributeError, OSError) as e:
+            print(f"警告: CPUコアの割り当てに失敗しました: {e}")
+
+    if pool_name == "separation":
+        # TensorFlowやnumpyが読み込まれる前なら、この設定が使われる
+        for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[name] = str(budget.threads)
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(budget.threads)
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(budget.inter_op_threads)
+
+
+def get_budget(pool_name: str) -> Optional[ThreadBudget]:
+    return _budgets.get(pool_name)
+
+
+def ffmpeg_thread_args() -> list[str]:
+    """ffmpegの出力オプションに加える -threads 指定。制限が無ければ空"""
+    budget = get_budget("ffmpeg")
+    return ["-threads", str(budget.threads)] if budget else []
+
+
+def configure_tensorflow():
+    """TensorFlowの読み込み直後、最初の演算より前に呼ぶ"""
+    budget = get_budget("separation")
+    if budget is None:
+        return
+    import tensorflow as tf
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(budget.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(budget.inter_op_threads)
+        print(
+            f"INFO: TensorFlowのスレッド数を設定しました "
+            f"(intra={budget.threads}, inter={budget.inter_op_threads})。"
+        )
+    except RuntimeError as e:
+        # 既に演算を実行したプロセスでは変更できない
+        print(f"警告: TensorFlowのスレッド数を変更できませんでした: {e}")
@@ -0,0 +1,205 @@
+import cProfile
+import functools
+import inspect
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+
+from helper.shared_storage import shared_path
+
+# ジョブごとのトレース (Chrome trace形式) とプロファイル結果の置き場所
+TRACE_DIR = shared_path("job_traces")
+# 1ジョブで記録するスパン数の上限。超えた分は件数だけ記録して捨てる
+MAX_SPANS_PER_JOB = int(os.getenv("TRACE_MAX_SPANS", "5000"))
+
+_current_trace: ContextVar[Optional["JobTrace"]] = ContextVar(
+    "current_trace", default=None
+)
+
+
+def trace_path(job_id: str) -> Path:
+    return TRACE_DIR / f"{job_id}.json"
+
+
+def profile_path(job_id: str) -> Path:
+    return TRACE_DIR / f"{job_id}.prof"
+
+
+def _process_peak_rss_mb() -> float:
+    """プロセス起動時からのピークメモリ。ジョブやスパン単位の値ではない。
+    Linuxのru_maxrssはKB単位"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _current_rss_bytes() -> Optional[int]:
+    """現在の常駐メモリ。/proc が読めない環境ではNone"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _child_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class JobTrace:
+    """1ジョブ分のスパンを集め、終了時にChrome trace (Perfetto) 形式で保存する"""
+
+    def __init__(self, job_id: str, root_name: str, profile: bool = False):
+        self.job_id = job_id
+        self.root_name = root_name
+        self.pid = os.getpid()
+        self.events: list[dict] = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self.profiler = cProfile.Profile() if profile else None
+
+    def add_event(
+        self,
+        name: str,
+        started_at: float,
+        finished_at: float,
+        args: Optional[dict] = None,
+        category: str = "span",
+    ):
+        with self._lock:
+            if len(self.events) >= MAX_SPANS_PER_JOB:
+                self.dropped += 1
+                return
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": round(started_at * 1_000_000),
+                    "dur": round((finished_at - started_at) * 1_000_000),
+                    "pid": self.pid,
+                    "tid": threading.get_native_id(),
+                    "args": args or {},
+                }
+            )
+
+    def save(self):
+        TRACE_DIR.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            events = list(self.events)
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": f"{self.root_name} {self.job_id}"},
+            }
+        ]
+        data = {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "job_id": self.job_id,
+                "pid": self.pid,
+                # ワーカープロセス全体の値で、同じプロセスで実行された他のジョブの分も含みうる
+                "process_peak_rss_mb": _process_peak_rss_mb(),
+                "dropped_spans": self.dropped,
+                "profiled": self.profiler is not None,
+            },
+        }
+        path = trace_path(self.job_id)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        if self.profiler is not None:
+            # snakevizやpstatsで開ける形式で保存する
+            self.profiler.dump_stats(str(profile_path(self.job_id)))
+        print(f"[{self.job_id}] トレースを保存しました: {path}")
+
+
+@contextmanager
+def span(name: str, **args):
+    """処理区間の経過時間・CPU時間・メモリの増減を、実行中のジョブのトレースに記録する。
+    トレース中でなければ何もしない"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started_at = time.time()
+    thread_cpu = time.thread_time()
+    process_cpu = time.process_time()
+    child_cpu = _child_cpu_seconds()
+    rss_before = _current_rss_bytes()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = e.__class__.__name__
+        raise
+    finally:
+        # cpu_ms: このスレッド / process_cpu_ms: TensorFlowなどの内部スレッドを含む /
+        # child_cpu_ms: ffmpegなどの子プロセス (同じプロセスで並行する他のジョブの分も含みうる)
+        args["cpu_ms"] = round((time.thread_time() - thread_cpu) * 1000, 1)
+        args["process_cpu_ms"] = round((time.process_time() - process_cpu) * 1000, 1)
+        args["child_cpu_ms"] = round((_child_cpu_seconds() - child_cpu) * 1000, 1)
+        # rss_delta_mb: 区間の前後の常駐メモリの差 (同じプロセスの他のスレッドの分も含みうる)
+        rss_after = _current_rss_bytes()
+        if rss_after is not None:
+            args["rss_mb"] = round(rss_after / 1024 / 1024, 1)
+            if rss_before is not None:
+                args["rss_delta_mb"] = round((rss_after - rss_before) / 1024 / 1024, 1)
+        trace.add_event(name, started_at, time.time(), args)
+
+
+def add_event(name: str, started_at: float, finished_at: float, **args):
+    """開始・終了時刻が分かっている区間 (ジョブのステージなど) を記録する"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_event(name, started_at, finished_at, args, category="stage")
+
+
+@contextmanager
+def trace_job(job_id: str, root_name: str, profile: bool = False):
+    """このブロック内のスパンを job_id のトレースとして集め、終了時に保存する"""
+    if _current_trace.get() is not None:
+        # 既に同じジョブをトレース中 (ワーカー関数の入れ子) ならそのまま使う
+        with span(root_name):
+            yield
+        return
+
+    trace = JobTrace(job_id, root_name, profile)
+    token = _current_trace.set(trace)
+    if trace.profiler is not None:
+        trace.profiler.enable()
+    try:
+        with span(root_name):
+            yield
+    finally:
+        if trace.profiler is not None:
+            trace.profiler.disable()
+        _current_trace.reset(token)
+        try:
+            trace.save()
+        except OSError as e:
+            print(f"警告: [{job_id}] トレースの保存に失敗しました: {e}")
+
+
+def traced_job(function):
+    """job_id (と任意の profile) 引数を持つワーカー関数を trace_job で包むデコレーター"""
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        with trace_job(
+            arguments["job_id"], function.__name__, arguments.get("profile", False)
+        ):
+            return function(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+from helper.artifact_store import ARTIFACT_STORE_DIR, META_SUFFIX, get_artifact, retain_file
+from helper.shared_storage import shared_path
+
+TRANSCRIPT_STORE_DIR = shared_path("transcripts")
+# 元動画は大きいため、成果物ストアに置いて容量上限と有効期限の対象にする
+SOURCE_NAMESPACE = "sources"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def compute_file_hash(file_path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_valid_hash(content_hash: str) -> bool:
+    return len(content_hash) == 64 and all(c in "0123456789abcdef" for c in content_hash)
+
+
+def _entry_dir(content_hash: str) -> Path:
+    if not is_valid_hash(content_hash):
+        raise ValueError(f"無効なハッシュ値です: {content_hash}")
+    return TRANSCRIPT_STORE_DIR / content_hash
+
+
+def load_transcript(content_hash: str) -> Optional[list]:
+    transcript_path = _entry_dir(content_hash) / "transcript.json"
+    if not transcript_path.exists():
+        return None
+    try:
+        with open(transcript_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"警告: 保存済みの文字起こしを読み込めませんでした: {e}")
+        return None
+
+
+def save_transcript(content_hash: str, timestamped_data: list):
+    entry_dir = _entry_dir(content_hash)
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    transcript_path = entry_dir / "transcript.json"
+    tmp_path = transcript_path.with_name(f".transcript.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(timestamped_data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, transcript_path)
+    print(f"文字起こし結果を保存しました: {transcript_path}")
+
+
+def save_source_video(
+    content_hash: str, video_path: Path, move: bool = False
+) -> Optional[Path]:
+    """元動画を保存する。move=Falseでリンクできない (別のファイルシステム上にある) 場合は
+    保存せずにNoneを返す"""
+    _entry_dir(content_hash)
+    stored_path = find_source_video(content_hash)
+    if stored_path is not None:
+        return stored_path
+    try:
+        return retain_file(
+            video_path,
+            SOURCE_NAMESPACE,
+            f"{content_hash}{video_path.suffix}",
+            move=move,
+        )
+    except OSError:
+        if move:
+            raise
+        return None
+
+
+def find_source_video(content_hash: str) -> Optional[Path]:
+    """保存済みの元動画。見つかれば最終アクセス時刻を更新し、容量超過時に削除されにくくする"""
+    _entry_dir(content_hash)
+    for path in (ARTIFACT_STORE_DIR / SOURCE_NAMESPACE).glob(f"{content_hash}.*"):
+        if path.name.endswith(META_SUFFIX):
+            continue
+        artifact = get_artifact(SOURCE_NAMESPACE, path.name)
+        if artifact is not None:
+            return artifact[0]
+    return None
+
+
+def load_media_info(content_hash: str) -> Optional[dict]:
+    """元ファイルを保存したときに調べた長さ・ファイル名。無ければNone"""
+    info_path = _entry_dir(content_hash) / "media.json"
+    if not info_path.exists():
+        return None
+    try:
+        with open(info_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"警告: 保存済みのメディア情報を読み込めませんでした: {e}")
+        return None
+
+
+def save_media_info(content_hash: str, info: dict):
+    entry_dir = _entry_dir(content_hash)
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    info_path = entry_dir / "media.json"
+    tmp_path = info_path.with_name(f".media.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False)
+    os.replace(tmp_path, info_path)
@@ -1,11 +1,49 @@
-from fastapi import FastAPI
+import asyncio
+import time
+
+_startup_started = time.perf_counter()
+
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from helper.db_handler import setup_database
-from module.element_divide import router as element_divide_router
-from module.history import router as history_router
-from module.mp4tomp3 import router as mp4_to_mp3_router
-from module.recommend import router as analyze_music_router
-from module.zimaku.add_subtitle import router as add_subtitle_router
+from fastapi.responses import PlainTextResponse
+from helper.readiness import (
+    import_seconds,
+    import_timer,
+    is_available,
+    readiness_report,
+    warm_up,
+)
+
+with import_timer("helper"):
+    from helper.artifact_store import run_janitor
+    from helper.db_handler import close_all_connections, setup_database
+    from helper.history_writer import history_writer
+    from helper.job_events import job_event_hub
+    from helper.job_queue import JOB_EXECUTION_MODE, job_queue
+    from helper.job_registry import job_registry
+    from helper.job_scheduler import job_scheduler
+    from helper.metrics import CONTENT_TYPE, metrics_hub
+    from helper.scratch_space import SCRATCH_DISK_DIR, SCRATCH_RAM_DIR
+    from helper.single_flight import single_flight
+    from helper.tracing import TRACE_DIR
+    from helper.transcript_store import TRANSCRIPT_STORE_DIR
+with import_timer("module.element_divide"):
+    from module import element_divide
+    from module.element_divide import router as element_divide_router
+with import_timer("module.history"):
+    from module.history import router as history_router
+with import_timer("module.jobs"):
+    from module.jobs import router as jobs_router
+with import_timer("module.mp4tomp3"):
+    from module.mp4tomp3 import router as mp4_to_mp3_router
+with import_timer("module.recommend"):
+    from module import recommend
+    from module.recommend import router as analyze_music_router
+with import_timer("module.zimaku.add_subtitle"):
+    from module.zimaku import add_subtitle
+    from module.zimaku.add_subtitle import router as add_subtitle_router
 
 app = FastAPI(
     title="Audily Core API",
@@ -23,6 +61,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # ブラウザのクライアントから履歴の次ページのカーソルを読めるようにする
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -38,10 +78,81 @@ app.include_router(mp4_to_mp3_router, prefix="/api", tags=["File Conversion"])
 
 app.include_router(history_router, prefix="/api", tags=["History"])
 
+app.include_router(jobs_router, prefix="/api", tags=["Jobs"])
+
+
+# 一定時間更新の無いものは放置された作業ファイルとして削除する
+JANITOR_ORPHAN_DIRS = [
+    SCRATCH_RAM_DIR,
+    SCRATCH_DISK_DIR,
+    element_divide.UPLOAD_DIR,
+    recommend.UPLOAD_DIR,
+    add_subtitle.UPLOAD_DIR,
+    add_subtitle.RESULT_DIR,
+]
+# 結果として参照されるものは成果物と同じ有効期限で削除する
+JANITOR_RETAINED_DIRS = [
+    recommend.ANALYSIS_RESULTS_DIR,
+    add_subtitle.JOB_SOURCE_DIR,
+    TRANSCRIPT_STORE_DIR,
+    TRACE_DIR,
+]
+
 
 @app.on_event("startup")
 async def startup_event():
+    # forkされるワーカープロセスより先に集計を始め、計測値をこのプロセスへ送らせる
+    metrics_hub.start()
+    if JOB_EXECUTION_MODE == "queue":
+        job_queue.validate()
     setup_database()
+    job_queue.setup()
+    history_writer.start()
+    job_registry.start()
+    job_scheduler.start()
+    single_flight.start()
+    job_event_hub.start()
+    app.state.janitor_task = asyncio.create_task(
+        run_janitor(JANITOR_ORPHAN_DIRS, JANITOR_RETAINED_DIRS)
+    )
+    # モデルの読み込みはバックグラウンドで行い、起動完了を待たせない
+    warm_up()
+    import_seconds["total_startup"] = round(time.perf_counter() - _startup_started, 3)
+    print(f"INFO: 起動処理が完了しました ({import_seconds['total_startup']}秒)。")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.janitor_task.cancel()
+    job_event_hub.stop()
+    single_flight.stop()
+    job_scheduler.stop()
+    job_registry.stop()
+    history_writer.stop()
+    metrics_hub.stop()
+    close_all_connections()
+
+
+@app.get("/ready")
+def read_readiness(response: Response, capability: Optional[str] = None):
+    """capabilityを指定すると、その機能だけの準備状況で200/503を返す"""
+    report = readiness_report()
+    if capability:
+        capability_report = report["capabilities"].get(capability)
+        if capability_report is None:
+            raise HTTPException(status_code=404, detail="未知の機能です。")
+        ready = is_available(capability_report)
+    else:
+        ready = report["ready"]
+    if not ready:
+        response.status_code = 503
+    return report
+
+
+@app.get("/metrics")
+def read_metrics():
+    """Prometheus形式で、ステージごとの処理時間・待ち行列・メモリ使用量などを返す"""
+    return PlainTextResponse(metrics_hub.render(), media_type=CONTENT_TYPE)
 
 
 @app.get("/")
@@ -1,132 +1,373 @@
-import io
-import shutil
+import asyncio
 import sys
 import tempfile
+import uuid
 import zipfile
 from pathlib import Path
+from typing import Optional
 
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse
-from starlette.background import BackgroundTask
+from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
+from helper.artifact_store import get_artifact, store_artifact
 from helper.db_handler import log_operation
+from helper.download_processed import create_ranged_file_response
+from helper.ffmpeg_runner import probe_duration
+from helper.job_progress import JobProgress
+from helper.job_dispatch import cancel_dispatched_job, check_admission, dispatch_job
+from helper.job_events import MAX_LONG_POLL_SECONDS, wait_for_job_status
+from helper.job_registry import JobCancelled, job_registry
+from helper.job_scheduler import job_scheduler
+from helper.media_preview import (
+    PreviewWindow,
+    cut_window,
+    link_stored_source,
+    parse_preview_window,
+    prime_source,
+    release_source,
+    resolve_stored_source,
+    reuse_media_info,
+    stored_upload_path,
+)
+from helper.metrics import track_stage, with_operation
 from helper.process_music import Music
+from helper.readiness import register_resource
+from helper.save_upload import save_upload_file
+from helper.scratch_space import ScratchSpace, estimate_wav_bytes
+from helper.shared_storage import shared_path
+from helper.single_flight import flight_key, hash_upload, single_flight
+from helper.tracing import traced_job
 
 router = APIRouter()
 
-SPLEETER_TEMP_DIR = Path("./spleeter_temp_processing")
-RESULT_ZIPS_DIR = Path("./result_zips")
-SPLEETER_TEMP_DIR.mkdir(exist_ok=True)
-RESULT_ZIPS_DIR.mkdir(exist_ok=True)
+STEM_COUNT = 5
 
+SEPARATION_STAGES = [
+    ("separation", "Spleeterによる音源分離"),
+    ("zip", "ZIPファイルの作成"),
+]
+PREVIEW_SEPARATION_STAGES = [
+    ("cut", "プレビュー区間の切り出し (FFmpeg)")
+] + SEPARATION_STAGES
 
-try:
-    music_processor = Music(stems="spleeter:5stems")
-except Exception as e:
-    print(f"致命的なエラー: Spleeterモデルの初期化に失敗しました。 {e}")
-    music_processor = None
+# ワーカープロセスに渡す入力ファイルの置き場所
+UPLOAD_DIR = shared_path("temp_uploads_separation")
 
 
-def cleanup_file(file_path: Path):
-    """バックグラウンドでファイルを削除する"""
-    if file_path.exists():
-        file_path.unlink()
-        print(f"クリーンアップ: {file_path} を削除しました。")
+# Spleeterモデルは分離を実行するワーカープロセスの中で読み込む。
+# APIプロセスで読み込むと、以降にforkするワーカーがTensorFlowのスレッドを引き継いでしまう
+separation_model = register_resource(
+    "separation",
+    lambda: Music(stems="spleeter:5stems"),
+    worker_only=True,
+    module="spleeter",
+)
 
 
-@router.post("/element_divide")
-async def separate_and_get_download_url(
-    file: UploadFile = File(...), user_id: str = Form(...)
-):
-    if not music_processor:
-        raise HTTPException(
-            status_code=503, detail="音楽分離サービスが利用できません。"
-        )
-
-    log_operation(
-        user_id=user_id,
-        operation_type="source_separation",
-        source_filename=file.filename,
-        status="started",
+@with_operation("source_separation")
+@traced_job
+def separation_job(
+    job_id: str,
+    user_id: str,
+    input_filepath: Path,
+    scratch: ScratchSpace,
+    original_filename: str,
+    profile: bool = False,
+    content_hash: Optional[str] = None,
+    preview_start: Optional[float] = None,
+    preview_duration: Optional[float] = None,
+) -> str:
+    preview = (
+        PreviewWindow(preview_start, preview_duration)
+        if preview_duration is not None
+        else None
+    )
+    progress = JobProgress(
+        job_id,
+        "source_separation",
+        PREVIEW_SEPARATION_STAGES if preview else SEPARATION_STAGES,
     )
-
-    # 一時ディレクトリではなく、永続的なディレクトリにSpleeterの出力を保存
-    job_id = f"{user_id}_{Path(file.filename).stem}_{Path(tempfile.mktemp()).name}"
-    processing_dir = SPLEETER_TEMP_DIR / job_id
-    processing_dir.mkdir()
-
-    input_filepath = processing_dir / file.filename
-
     try:
-        with open(input_filepath, "wb") as buffer:
-            buffer.write(await file.read())
+        if preview:
+            # 元ファイル全体と長さを保存し、続く本処理で再アップロードを不要にする
+            prime_source(content_hash, input_filepath, original_filename)
 
-        await file.close()
+            # 区間だけをデコードする。字幕のプレビューと同じく、ffmpegの実行枠を取って同時実行数を守る
+            progress.start_stage("cut")
+            clip_filepath = scratch.allocate(
+                "preview.wav", estimate_wav_bytes(preview.duration)
+            )
+            with job_scheduler.slot(job_id, user_id, "ffmpeg"):
+                cut_window(
+                    input_filepath,
+                    clip_filepath,
+                    preview,
+                    video=False,
+                    progress_callback=progress.update,
+                )
+            input_filepath = clip_filepath
+        elif content_hash:
+            reuse_media_info(content_hash, input_filepath)
 
-        print(f"分離処理を開始: {input_filepath}")
-        music_processor.divide(
-            input_file_path=str(input_filepath), output_base_dir=str(processing_dir)
+        progress.start_stage("separation")
+        stems_bytes = estimate_wav_bytes(
+            probe_duration(input_filepath), count=STEM_COUNT
         )
+        stems_dir = scratch.allocate_dir("stems", stems_bytes)
+
+        print(f"分離処理を開始: {input_filepath}")
+        # 同時実行数は分離用の実行枠で制限する。モデルの読み込みも、枠のコアとスレッド数で行う
+        with job_scheduler.slot(job_id, user_id, "separation"):
+            music_processor = separation_model.get()
+            output_subdir = music_processor.divide(
+                input_file_path=str(input_filepath),
+                output_base_dir=str(stems_dir),
+                progress_callback=progress.update,
+            )
 
-        output_subdir = music_processor.output_directory
         if not output_subdir or not output_subdir.exists():
             raise HTTPException(
                 status_code=404, detail="分離されたファイルが見つかりません。"
             )
         print(f"分離処理が完了。出力先: {output_subdir}")
 
-        original_stem = Path(file.filename).stem
-        zip_filename = f"{original_stem}_separated.zip"
-        zip_filepath = RESULT_ZIPS_DIR / zip_filename
+        progress.start_stage("zip")
+        original_stem = Path(original_filename).stem
+        suffix = "preview" if preview else "separated"
+        zip_filename = f"{uuid.uuid4().hex[:8]}_{original_stem}_{suffix}.zip"
+        zip_filepath = scratch.allocate(zip_filename, stems_bytes)
 
-        with zipfile.ZipFile(zip_filepath, "w", zipfile.ZIP_DEFLATED) as zip_f:
+        with track_stage("zip"), zipfile.ZipFile(
+            zip_filepath, "w", zipfile.ZIP_DEFLATED
+        ) as zip_f:
             for separated_file in output_subdir.glob("*.wav"):
                 zip_f.write(separated_file, arcname=separated_file.name)
 
         print(f"ZIPファイルを生成しました: {zip_filepath}")
+        store_artifact(zip_filepath, "separation", zip_filename, "application/zip")
 
-        log_operation(
-            user_id=user_id,
-            operation_type="source_separation",
-            source_filename=file.filename,
-            status="completed",
-        )
+        progress.complete(result_location=f"separation/{zip_filename}")
+        return zip_filename
 
-        return {"message": "Processing complete!", "download_filename": zip_filename}
+    except JobCancelled:
+        raise
+    except Exception as e:
+        progress.fail(f"処理中にエラーが発生しました: {e}")
+        raise
 
+
+def separation_worker(
+    job_id: str,
+    user_id: str,
+    input_filepath: Path,
+    original_filename: str,
+    profile: bool = False,
+    content_hash: Optional[str] = None,
+    preview_start: Optional[float] = None,
+    preview_duration: Optional[float] = None,
+):
+    """ワーカープロセス (localモードではAPIからfork、queueモードではworker.py) で実行される分離処理。
+    結果は成果物ストアに置き、APIはジョブの完了を待って応答する"""
+    scratch = ScratchSpace(job_id)
+    try:
+        separation_job(
+            job_id,
+            user_id,
+            input_filepath,
+            scratch,
+            original_filename,
+            profile,
+            content_hash,
+            preview_start,
+            preview_duration,
+        )
+        log_operation(user_id, "source_separation", original_filename, "completed")
+    except JobCancelled:
+        pass
     except Exception as e:
         log_operation(
-            user_id=user_id,
-            operation_type="source_separation",
-            source_filename=file.filename,
-            status=f"failed: {e.__class__.__name__}",
+            user_id,
+            "source_separation",
+            original_filename,
+            f"failed: {e.__class__.__name__}",
         )
-        if isinstance(e, HTTPException):
-            raise e
+    finally:
+        scratch.cleanup()
+        # プレビューでは元ファイルを保持し、続く本処理で再アップロードを不要にする
+        release_source(
+            content_hash if preview_duration is not None else None, input_filepath
+        )
+
+
+async def separate_on_worker(
+    file: Optional[UploadFile],
+    source_path: Optional[Path],
+    original_filename: str,
+    user_id: str,
+    job_id: str,
+    profile: bool,
+    content_hash: str,
+    preview: Optional[PreviewWindow],
+) -> dict:
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        if file is not None:
+            input_filepath = await save_upload_file(
+                file, UPLOAD_DIR, "source_separation"
+            )
         else:
-            raise HTTPException(
-                status_code=500, detail=f"処理中に予期せぬエラーが発生しました: {e}"
+            input_filepath = await run_in_threadpool(
+                link_stored_source,
+                source_path,
+                stored_upload_path(UPLOAD_DIR, original_filename, source_path),
             )
-    finally:
-        if processing_dir.exists():
-            shutil.rmtree(processing_dir)
+    except BaseException as e:
+        # ジョブを終わらせ、合流したリクエストが待ち続けないようにする
+        job_registry.update(
+            job_id, state="failed", error=f"入力ファイルの保存に失敗しました: {e!r}"
+        )
+        raise
+    dispatch_job(
+        job_id,
+        user_id,
+        "source_separation",
+        "separation",
+        separation_worker,
+        (
+            job_id,
+            user_id,
+            input_filepath,
+            original_filename,
+            profile,
+            content_hash,
+            preview.start if preview else None,
+            preview.duration if preview else None,
+        ),
+    )
+    try:
+        return await wait_for_separation_result(job_id, content_hash)
+    except asyncio.CancelledError:
+        # 依頼元が切断した場合、合流したリクエストが無ければワーカーを止める。
+        # 後始末はワーカー自身が行い、実行枠はジョブの終了を受けて返却される
+        if single_flight.has_followers(job_id):
+            print(f"[{job_id}] 依頼元は切断しましたが、合流したリクエストのため処理を続けます。")
+        else:
+            cancel_dispatched_job(job_id)
+        raise
+
+
+async def wait_for_separation_result(
+    job_id: str, content_hash: Optional[str] = None
+) -> dict:
+    """他のプロセスや他のリクエストが実行する分離ジョブの終了を待ち、同じ形式で応答する"""
+    status = await wait_for_job_status(job_id)
+    while status is not None and status["status"] == "processing":
+        status = await wait_for_job_status(
+            job_id, status["updated_at"], MAX_LONG_POLL_SECONDS
+        )
+
+    if status is None or status["state"] == "failed":
+        detail = status["detail"] if status else "ジョブが見つかりません。"
+        raise HTTPException(
+            status_code=500, detail=f"処理中に予期せぬエラーが発生しました: {detail}"
+        )
+    if status["state"] == "cancelled":
+        raise HTTPException(status_code=409, detail="処理はキャンセルされました。")
+
+    return {
+        "message": "Processing complete!",
+        "download_filename": status["result_location"].split("/", 1)[1],
+        "job_id": job_id,
+        "content_hash": content_hash,
+    }
+
+
+@router.post("/element_divide")
+async def separate_and_get_download_url(
+    user_id: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    content_hash: Optional[str] = Form(None),
+    job_id: Optional[str] = Form(None),
+    profile: bool = Form(False),
+    preview_start: Optional[float] = Form(None),
+    preview_duration: Optional[float] = Form(None),
+):
+    preview = parse_preview_window(preview_start, preview_duration)
+
+    # プレビューで保存済みの曲は、content_hashを指定すれば再アップロード不要
+    source_path = None
+    if file is not None:
+        content_hash = await hash_upload(file)
+        original_filename = file.filename
+    elif content_hash:
+        source_path, original_filename = resolve_stored_source(content_hash)
+    else:
+        raise HTTPException(
+            status_code=400, detail="fileまたはcontent_hashを指定してください。"
+        )
+
+    # 同じ曲・同じ区間の分離が実行中なら、新しく分離せずにその結果を待つ
+    key = flight_key(
+        "source_separation",
+        content_hash,
+        stems=STEM_COUNT,
+        **(preview.flight_params() if preview else {}),
+    )
+    shared_job_id, claim = await single_flight.attach_or_claim(
+        key, user_id, "source_separation", original_filename
+    )
+    if shared_job_id is not None:
+        if file is not None:
+            await file.close()
+        return await wait_for_separation_result(shared_job_id, content_hash)
+
+    try:
+        check_admission(user_id, "source_separation", "separation")
+
+        # job_idをクライアントが指定すれば、処理中でもキャンセルできる
+        if job_id is None:
+            job_id = f"{user_id}_{Path(original_filename).stem}_{Path(tempfile.mktemp()).name}"
+        elif ".." in job_id or "/" in job_id:
+            raise HTTPException(status_code=400, detail="無効なJob IDです。")
+        elif job_registry.get(job_id) is not None:
+            raise HTTPException(status_code=409, detail="このJob IDは使用済みです。")
+
+        job_registry.create(job_id, "source_separation", user_id, original_filename)
+    except BaseException:
+        single_flight.release(claim)
+        raise
+    single_flight.register(claim, job_id)
+    log_operation(
+        user_id=user_id,
+        operation_type="source_separation",
+        source_filename=original_filename,
+        status="started",
+    )
+
+    return await separate_on_worker(
+        file,
+        source_path,
+        original_filename,
+        user_id,
+        job_id,
+        profile,
+        content_hash,
+        preview,
+    )
 
 
 @router.get("/download-zip/{filename}")
-async def download_separated_zip(filename: str):
-    """生成されたZIPファイルをダウンロードさせるエンドポイント"""
+async def download_separated_zip(filename: str, request: Request):
+    """生成されたZIPファイルをダウンロードさせるエンドポイント (Range対応・有効期限まで再取得可)"""
     if ".." in filename or "/" in filename:
         raise HTTPException(status_code=400, detail="無効なファイル名です。")
 
-    file_path = RESULT_ZIPS_DIR / filename
-    if not file_path.exists():
+    artifact = get_artifact("separation", filename)
+    if not artifact:
         raise HTTPException(status_code=404, detail="ファイルが見つかりません。")
 
-    # ダウンロード後にファイルを削除するタスクを登録
-    return FileResponse(
-        file_path,
-        media_type="application/zip",
-        filename=filename,
-        background=BackgroundTask(cleanup_file, file_path=file_path),
+    file_path, meta = artifact
+    return create_ranged_file_response(
+        request, file_path, meta["media_type"], filename
     )
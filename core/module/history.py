@@ -1,24 +1,67 @@
 import sys
+from datetime import datetime
 from pathlib import Path
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Response
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-from helper.db_handler import get_history_by_user_id
+from helper.db_handler import (
+    HISTORY_PAGE_MAX_LIMIT,
+    get_history_page,
+    get_history_summary,
+)
 
 router = APIRouter()
 
 
 @router.get("/history/{user_id}")
-async def get_user_history(user_id: str):
+async def get_user_history(
+    user_id: str,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    operation_type: Optional[str] = None,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
     if ".." in user_id or "/" in user_id:
         raise HTTPException(status_code=400, detail="無効なUser IDです。")
 
     try:
-        history = get_history_by_user_id(user_id)
-        return history
+        history, next_cursor = get_history_page(
+            user_id,
+            limit=limit,
+            cursor=cursor,
+            operation_type=operation_type,
+            status=status,
+            since=since,
+            until=until,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"履歴の取得中にエラーが発生しました: {e}"
         )
+
+    # 既存のクライアントが配列を前提にしているため、次ページのカーソルはヘッダーで返す。
+    # limitを指定しない場合は全件を返すので、カーソルは付かない
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return history
+
+
+@router.get("/history/{user_id}/summary")
+async def get_user_history_summary(user_id: str):
+    if ".." in user_id or "/" in user_id:
+        raise HTTPException(status_code=400, detail="無効なUser IDです。")
+
+    try:
+        return get_history_summary(user_id)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"履歴の集計中にエラーが発生しました: {e}"
+        )
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, StreamingResponse
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from helper.db_handler import log_operation
+from helper.job_dispatch import cancel_dispatched_job
+from helper.job_events import MAX_LONG_POLL_SECONDS, job_event_hub, wait_for_job_status
+from helper.job_progress import get_job_status
+from helper.job_registry import job_registry
+from helper.tracing import profile_path, trace_path
+
+router = APIRouter()
+
+# 更新が無い間も接続を維持するための送信間隔
+KEEPALIVE_SECONDS = 15.0
+MAX_SUBSCRIBED_JOBS = 50
+
+
+def _parse_job_ids(job_ids: str) -> list[str]:
+    parsed = [job_id for job_id in job_ids.split(",") if job_id]
+    if not parsed or len(parsed) > MAX_SUBSCRIBED_JOBS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"job_idsには1〜{MAX_SUBSCRIBED_JOBS}件のJob IDを指定してください。",
+        )
+    if any(".." in job_id or "/" in job_id for job_id in parsed):
+        raise HTTPException(status_code=400, detail="無効なJob IDです。")
+    return parsed
+
+
+def _is_finished(status: Optional[dict]) -> bool:
+    return status is None or status["status"] != "processing"
+
+
+@router.get("/jobs/events")
+async def stream_job_events(job_ids: str):
+    """Server-Sent Events: 指定したジョブの状態が変わるたびに通知する"""
+    subscribed = _parse_job_ids(job_ids)
+
+    async def event_stream():
+        subscription = job_event_hub.subscribe(subscribed)
+        try:
+            # 購読開始時点の状態をまず送る
+            latest = {job_id: get_job_status(job_id) for job_id in subscribed}
+            for job_id, status in latest.items():
+                payload = status or {"job_id": job_id, "status": "not_found"}
+                yield f"event: job\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            while not all(_is_finished(status) for status in latest.values()):
+                updates = await subscription.next_updates(KEEPALIVE_SECONDS)
+                if not updates:
+                    yield ": keepalive\n\n"
+                    continue
+                for payload in updates:
+                    latest[payload["job_id"]] = payload
+                    yield f"event: job\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        finally:
+            job_event_hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/jobs/subscribe")
+async def subscribe_job_events(websocket: WebSocket):
+    """WebSocket: {"subscribe": [...]} / {"unsubscribe": [...]} で購読するジョブを切り替える"""
+    await websocket.accept()
+    subscription = job_event_hub.subscribe([])
+
+    async def receive_commands():
+        while True:
+            message = await websocket.receive_json()
+            job_ids = [
+                job_id
+                for job_id in message.get("subscribe", [])
+                if ".." not in job_id and "/" not in job_id
+            ]
+            if len(subscription.job_ids) + len(job_ids) > MAX_SUBSCRIBED_JOBS:
+                await websocket.send_json(
+                    {"error": f"購読できるジョブは{MAX_SUBSCRIBED_JOBS}件までです。"}
+                )
+                continue
+            job_event_hub.add_jobs(subscription, job_ids)
+            job_event_hub.remove_jobs(subscription, message.get("unsubscribe", []))
+            for job_id in job_ids:
+                status = get_job_status(job_id)
+                await websocket.send_json(
+                    status or {"job_id": job_id, "status": "not_found"}
+                )
+
+    async def send_updates():
+        while True:
+            updates = await subscription.next_updates(KEEPALIVE_SECONDS)
+            if not updates:
+                await websocket.send_json({"type": "keepalive"})
+            for payload in updates:
+                await websocket.send_json(payload)
+
+    tasks = [
+        asyncio.create_task(receive_commands()),
+        asyncio.create_task(send_updates()),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            exception = task.exception()
+            if exception and not isinstance(exception, WebSocketDisconnect):
+                print(f"ERROR: ジョブ購読の処理中にエラーが発生しました: {exception}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        job_event_hub.unsubscribe(subscription)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    since: Optional[float] = None,
+    wait: float = Query(0, ge=0, le=MAX_LONG_POLL_SECONDS),
+):
+    if ".." in job_id or "/" in job_id:
+        raise HTTPException(status_code=400, detail="無効なJob IDです。")
+
+    status = await wait_for_job_status(job_id, since, wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    return status
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    if ".." in job_id or "/" in job_id:
+        raise HTTPException(status_code=400, detail="無効なJob IDです。")
+
+    record = job_registry.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    if not cancel_dispatched_job(job_id):
+        raise HTTPException(
+            status_code=409, detail=f"このジョブは既に終了しています ({record['state']})。"
+        )
+
+    log_operation(record["user_id"], record["kind"], record["source_filename"], "cancelled")
+    return {"message": "ジョブをキャンセルしました。", "job_id": job_id}
+
+
+@router.get("/jobs/{job_id}/trace")
+async def download_job_trace(job_id: str):
+    """ジョブのタイムライン (Chrome trace形式)。chrome://tracing や ui.perfetto.dev で開ける"""
+    if ".." in job_id or "/" in job_id:
+        raise HTTPException(status_code=400, detail="無効なJob IDです。")
+
+    path = trace_path(job_id)
+    if not path.exists():
+        raise HTTPException(
+            status_code=404, detail="トレースが見つかりません (ジョブの終了後に作成されます)。"
+        )
+    return FileResponse(
+        path=path, media_type="application/json", filename=f"{job_id}.trace.json"
+    )
+
+
+@router.get("/jobs/{job_id}/profile")
+async def download_job_profile(job_id: str):
+    """profile=trueで受け付けたジョブのcProfile結果 (pstats形式)"""
+    if ".." in job_id or "/" in job_id:
+        raise HTTPException(status_code=400, detail="無効なJob IDです。")
+
+    path = profile_path(job_id)
+    if not path.exists():
+        raise HTTPException(status_code=404, detail="プロファイル結果が見つかりません。")
+    return FileResponse(
+        path=path, media_type="application/octet-stream", filename=f"{job_id}.prof"
+    )
@@ -1,23 +1,50 @@
+import asyncio
+import os
+import shutil
 import subprocess
 import sys
-import tempfile
+import zipfile
 from pathlib import Path
+from typing import List
 
 from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 from starlette.background import BackgroundTask
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
-from helper.db_handler import log_operation
+from helper.db_handler import log_operation, log_operations
+from helper.job_scheduler import POOL_CAPACITIES, job_scheduler
+from helper.metrics import record_bytes, track_stage
+from helper.scratch_space import ScratchSpace
+from helper.thread_budget import ffmpeg_thread_args
 
 router = APIRouter()
 
+BATCH_VIDEO_SUFFIXES = {".mp4", ".m4v", ".mov", ".mkv", ".webm"}
+# ZIP爆弾でスクラッチ領域を埋められないよう、展開前にヘッダーの値で制限する (1リクエスト内の全ZIPの合計)
+BATCH_MAX_ARCHIVE_MEMBERS = int(os.getenv("BATCH_MAX_ARCHIVE_MEMBERS", "100"))
+BATCH_MAX_EXTRACTED_BYTES = int(
+    os.getenv("BATCH_MAX_EXTRACTED_BYTES", str(4 * 1024**3))
+)
 
 def convert_mp4_to_mp3(input_path: Path, output_path: Path):
-    command = ["ffmpeg", "-i", str(input_path), "-vn", "-q:a", "0", str(output_path)]
+    command = [
+        "ffmpeg",
+        "-i",
+        str(input_path),
+        "-vn",
+        "-q:a",
+        "0",
+        *ffmpeg_thread_args(),
+        str(output_path),
+    ]
     print(f"FFmpegコマンドを実行: {' '.join(command)}")
     try:
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        with track_stage("ffmpeg_encode", "mp4_to_mp3"):
+            result = subprocess.run(
+                command, check=True, capture_output=True, text=True
+            )
         print("FFmpegの変換が正常に完了しました.")
     except FileNotFoundError:
         raise RuntimeError("FFmpegがインストールされていないか、PATHが通っていません.")
@@ -26,16 +53,20 @@ def convert_mp4_to_mp3(input_path: Path, output_path: Path):
         raise RuntimeError(f"MP4からMP3への変換に失敗しました: {e.stderr}")
 
 
-def cleanup_files_and_log(
-    files_to_delete: list[Path], user_id: str, original_filename: str, status: str
+async def convert_in_ffmpeg_slot(
+    slot_id: str, user_id: str, input_path: Path, output_path: Path
 ):
-    for file_path in files_to_delete:
-        if file_path.exists():
-            try:
-                file_path.unlink()
-                print(f"クリーンアップ: {file_path} を削除しました.")
-            except OSError as e:
-                print(f"クリーンアップエラー: {file_path} の削除に失敗しました - {e}")
+    """他のジョブと同じffmpegの実行枠を取ってから変換する。
+    -threadsは枠ごとのスレッド数 (コア数 / ffmpegの枠数) になる"""
+    async with job_scheduler.async_slot(slot_id, user_id, "ffmpeg"):
+        await run_in_threadpool(convert_mp4_to_mp3, input_path, output_path)
+
+
+def cleanup_scratch_and_log(
+    scratch: ScratchSpace, user_id: str, original_filename: str, status: str
+):
+    scratch.cleanup()
+    print(f"クリーンアップ: {scratch.job_id} の一時ファイルを削除しました.")
 
     log_operation(
         user_id=user_id,
@@ -50,17 +81,20 @@ async def handle_mp4_to_mp3_conversion(
     file: UploadFile = File(...),
     user_id: str = Form(...),
 ):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_input_file:
-        try:
+    job_scheduler.check_admission(user_id, "ffmpeg")
+    scratch = ScratchSpace()
+    try:
+        with track_stage("upload_ingest", "mp4_to_mp3"):
             content = await file.read()
-            temp_input_file.write(content)
-            temp_input_filepath = Path(temp_input_file.name)
-        except Exception as e:
-            raise HTTPException(
-                status_code=500, detail=f"一時ファイルの保存に失敗: {e}"
-            )
-        finally:
-            await file.close()
+            temp_input_filepath = scratch.allocate("input.mp4", len(content))
+            with open(temp_input_filepath, "wb") as temp_input_file:
+                temp_input_file.write(content)
+        record_bytes("in", len(content), "mp4_to_mp3")
+    except Exception as e:
+        scratch.cleanup()
+        raise HTTPException(status_code=500, detail=f"一時ファイルの保存に失敗: {e}")
+    finally:
+        await file.close()
 
     log_operation(
         user_id=user_id,
@@ -69,21 +103,23 @@ async def handle_mp4_to_mp3_conversion(
         status="started",
     )
 
-    output_filename = f"{temp_input_filepath.stem}.mp3"
-    output_filepath = temp_input_filepath.with_name(output_filename)
+    output_filename = f"{scratch.job_id}.mp3"
+    # 出力MP3は入力動画より小さいため、入力サイズで見積もる
+    output_filepath = scratch.allocate(output_filename, len(content))
 
     try:
-        convert_mp4_to_mp3(temp_input_filepath, output_filepath)
-
-        files_for_cleanup = [temp_input_filepath, output_filepath]
+        await convert_in_ffmpeg_slot(
+            scratch.job_id, user_id, temp_input_filepath, output_filepath
+        )
+        record_bytes("out", output_filepath.stat().st_size, "mp4_to_mp3")
 
         return FileResponse(
             path=output_filepath,
             media_type="audio/mpeg",
             filename=output_filename,
             background=BackgroundTask(
-                cleanup_files_and_log,
-                files_to_delete=files_for_cleanup,
+                cleanup_scratch_and_log,
+                scratch=scratch,
                 user_id=user_id,
                 original_filename=file.filename,
                 status="completed",
@@ -96,6 +132,191 @@ async def handle_mp4_to_mp3_conversion(
             source_filename=file.filename,
             status=f"failed: {e}",
         )
-        if temp_input_filepath.exists():
-            temp_input_filepath.unlink()
+        scratch.cleanup()
         raise HTTPException(status_code=500, detail=str(e))
+
+
+def _save_batch_upload(file_object, saved_path: Path):
+    with open(saved_path, "wb") as buffer:
+        shutil.copyfileobj(file_object, buffer)
+
+
+def _extract_videos_from_archive(
+    archive_path: Path,
+    scratch: ScratchSpace,
+    directory_name: str,
+    max_members: int,
+    max_bytes: int,
+) -> tuple[list[Path], int]:
+    """展開した動画のパスと、展開後の合計サイズを返す。展開先はヘッダーの合計サイズで
+    スクラッチ領域に確保し、メモリ上の予算を超える場合はディスクに展開する"""
+    extracted = []
+    with zipfile.ZipFile(archive_path) as archive:
+        members = [
+            member
+            for member in archive.infolist()
+            if not member.is_dir()
+            and Path(member.filename).suffix.lower() in BATCH_VIDEO_SUFFIXES
+        ]
+        # 展開されるデータはヘッダーのfile_sizeで打ち切られるため、この合計が上限になる
+        extracted_bytes = sum(member.file_size for member in members)
+        if len(members) > max_members:
+            raise HTTPException(
+                status_code=413,
+                detail=f"ZIPから展開できる動画は、1回のリクエストで{BATCH_MAX_ARCHIVE_MEMBERS}件までです。",
+            )
+        if extracted_bytes > max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"ZIPの展開後の合計サイズが上限 ({BATCH_MAX_EXTRACTED_BYTES} bytes) を超えています。",
+            )
+
+        destination_dir = scratch.allocate_dir(directory_name, extracted_bytes)
+        for member in members:
+            member_path = Path(member.filename)
+            # アーカイブ内のディレクトリ構成は捨て、名前の衝突は連番で回避する
+            target = destination_dir / f"{len(extracted):04d}_{member_path.name}"
+            with archive.open(member) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            extracted.append(target)
+    return extracted, extracted_bytes
+
+
+def _write_result_archive(
+    archive_path: Path, output_paths: list[Path], errors: list[str]
+):
+    # MP3は圧縮済みのため再圧縮はしない
+    with track_stage("zip", "mp4_to_mp3"), zipfile.ZipFile(
+        archive_path, "w", zipfile.ZIP_STORED
+    ) as archive:
+        for output_path in output_paths:
+            if output_path.exists():
+                archive.write(output_path, arcname=output_path.name)
+        if errors:
+            archive.writestr("errors.txt", "\n".join(errors))
+
+
+def _original_name(input_path: Path) -> str:
+    return input_path.name.split("_", 1)[1]
+
+
+@router.post("/mp4-to-mp3/batch")
+async def handle_batch_mp4_to_mp3_conversion(
+    files: List[UploadFile] = File(...),
+    user_id: str = Form(...),
+):
+    job_scheduler.check_admission(user_id, "ffmpeg")
+    scratch = ScratchSpace()
+    upload_bytes = sum(file.size or 0 for file in files)
+    input_dir = scratch.allocate_dir("input", upload_bytes)
+
+    try:
+        input_paths: list[Path] = []
+        extracted_members = 0
+        extracted_bytes = 0
+        for file in files:
+            saved_path = input_dir / f"{len(input_paths):04d}_{Path(file.filename).name}"
+            try:
+                # 大きなファイルの書き込みでイベントループを止めない
+                await run_in_threadpool(_save_batch_upload, file.file, saved_path)
+            finally:
+                await file.close()
+
+            if saved_path.suffix.lower() == ".zip":
+                try:
+                    extracted, archive_bytes = await run_in_threadpool(
+                        _extract_videos_from_archive,
+                        saved_path,
+                        scratch,
+                        f"extracted_{len(input_paths):04d}",
+                        BATCH_MAX_ARCHIVE_MEMBERS - extracted_members,
+                        BATCH_MAX_EXTRACTED_BYTES - extracted_bytes,
+                    )
+                    input_paths.extend(extracted)
+                    extracted_members += len(extracted)
+                    extracted_bytes += archive_bytes
+                except zipfile.BadZipFile:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"ZIPファイルを展開できません: {file.filename}",
+                    )
+                finally:
+                    saved_path.unlink()
+            else:
+                input_paths.append(saved_path)
+
+        if not input_paths:
+            raise HTTPException(
+                status_code=400, detail="変換対象の動画ファイルがありません."
+            )
+
+        # 出力MP3は入力動画より小さいため、入力の合計サイズで見積もる
+        input_bytes = sum(path.stat().st_size for path in input_paths)
+        output_dir = scratch.allocate_dir("output", input_bytes)
+        output_paths = [
+            output_dir / f"{Path(_original_name(path)).stem}.mp3"
+            for path in input_paths
+        ]
+        # 出力名が重複する場合は連番付きの名前にする
+        seen_names: set[str] = set()
+        for i, output_path in enumerate(output_paths):
+            if output_path.name in seen_names:
+                output_paths[i] = output_path.with_name(
+                    f"{output_path.stem}_{i}{output_path.suffix}"
+                )
+            seen_names.add(output_paths[i].name)
+
+        # ffmpegの枠を待つのは一度にその枠数までとし、1件のバッチで待ち行列を埋めない
+        results: list = [None] * len(input_paths)
+        next_index = iter(range(len(input_paths)))
+
+        async def convert_next():
+            for i in next_index:
+                try:
+                    await convert_in_ffmpeg_slot(
+                        f"{scratch.job_id}_{i}", user_id, input_paths[i], output_paths[i]
+                    )
+                except Exception as e:
+                    results[i] = e
+
+        await asyncio.gather(
+            *[
+                convert_next()
+                for _ in range(min(POOL_CAPACITIES["ffmpeg"], len(input_paths)))
+            ]
+        )
+
+        history_records = []
+        errors = []
+        for input_path, result in zip(input_paths, results):
+            original_filename = _original_name(input_path)
+            if isinstance(result, BaseException):
+                errors.append(f"{original_filename}: {result}")
+                status = f"failed: {result.__class__.__name__}"
+            else:
+                status = "completed"
+            history_records.append((user_id, "mp4_to_mp3", original_filename, status))
+        log_operations(history_records)
+
+        if len(errors) == len(input_paths):
+            raise HTTPException(
+                status_code=500,
+                detail="全てのファイルの変換に失敗しました.\n" + "\n".join(errors),
+            )
+
+        archive_path = scratch.allocate("converted_mp3.zip", input_bytes)
+        await run_in_threadpool(
+            _write_result_archive, archive_path, output_paths, errors
+        )
+        record_bytes("in", input_bytes, "mp4_to_mp3")
+        record_bytes("out", archive_path.stat().st_size, "mp4_to_mp3")
+
+        return FileResponse(
+            path=archive_path,
+            media_type="application/zip",
+            filename=archive_path.name,
+            background=BackgroundTask(scratch.cleanup),
+        )
+    except Exception:
+        scratch.cleanup()
+        raise
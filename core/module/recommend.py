@@ -1,69 +1,96 @@
-import multiprocessing
-import shutil
 import sys
 from pathlib import Path
+from typing import Optional
 
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi import APIRouter, File, Form, HTTPException, Query, UploadFile
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from helper.db_handler import log_operation
+from helper.ffmpeg_runner import probe_duration
 from helper.gemini import GeminiProcessor
+from helper.job_events import MAX_LONG_POLL_SECONDS, wait_for_job_status
+from helper.job_progress import JobProgress
+from helper.job_dispatch import check_admission, dispatch_job
+from helper.job_registry import JobCancelled, job_registry
+from helper.job_scheduler import job_scheduler
+from helper.metrics import with_operation
 from helper.process_music import Music
 from helper.save_upload import save_upload_file
+from helper.scratch_space import ScratchSpace, estimate_wav_bytes
+from helper.shared_storage import shared_path
+from helper.single_flight import flight_key, hash_upload, single_flight
+from helper.tracing import traced_job
 
 router = APIRouter()
 
-UPLOAD_DIR = Path("./temp_uploads_analyze")
-SPLEETER_OUTPUT_DIR = Path("./spleeter_output")
-ANALYSIS_RESULTS_DIR = Path("./analysis_results")
+UPLOAD_DIR = shared_path("temp_uploads_analyze")
+ANALYSIS_RESULTS_DIR = shared_path("analysis_results")
+
+ANALYSIS_STAGES = [
+    ("init", "モデルの初期化"),
+    ("separation", "Spleeterによるボーカル分離"),
+    ("gemini", "Geminiによる分析"),
+]
 
 
 @router.on_event("startup")
 async def startup_event():
-    UPLOAD_DIR.mkdir(exist_ok=True)
-    SPLEETER_OUTPUT_DIR.mkdir(exist_ok=True)
-    ANALYSIS_RESULTS_DIR.mkdir(exist_ok=True)
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    ANALYSIS_RESULTS_DIR.mkdir(parents=True, exist_ok=True)
     print("分析機能用のディレクトリ準備が完了しました。")
 
 
+@with_operation("music_analysis")
+@traced_job
 def analysis_process_worker(
     temp_filepath: Path,
     job_id: str,
     user_prompt: str,
     user_id: str,
     original_filename: str,
+    profile: bool = False,
 ):
     analysis_result_path = ANALYSIS_RESULTS_DIR / f"{job_id}.txt"
-    spleeter_job_output_dir = None
+    scratch = ScratchSpace(job_id)
+    progress = JobProgress(job_id, "music_analysis", ANALYSIS_STAGES)
     try:
-        print(f"[{job_id}] 新規プロセスでモデルを初期化しています...")
-        local_music_processor = Music(stems="spleeter:5stems")
-        local_gemini_processor = GeminiProcessor(model_name="gemini-2.5-flash")
-        print(f"[{job_id}] モデルの初期化が完了。")
-
-        print(f"[{job_id}] Spleeterによるボーカル分離を開始...")
-        local_music_processor.divide(
-            input_file_path=str(temp_filepath), output_base_dir=str(SPLEETER_OUTPUT_DIR)
-        )
-        spleeter_job_output_dir = local_music_processor.output_directory
-        vocals_path = spleeter_job_output_dir / "vocals.wav"
+        # TensorFlowの読み込みから分離までを、分離用の実行枠の中で行う
+        with job_scheduler.slot(job_id, user_id, "separation"):
+            progress.start_stage("init")
+            print(f"[{job_id}] 新規プロセスでモデルを初期化しています...")
+            local_music_processor = Music(stems="spleeter:5stems")
+            local_gemini_processor = GeminiProcessor(model_name="gemini-2.5-flash")
+            print(f"[{job_id}] モデルの初期化が完了。")
+
+            progress.start_stage("separation")
+            stems_dir = scratch.allocate_dir(
+                "stems", estimate_wav_bytes(probe_duration(temp_filepath), count=5)
+            )
+            local_music_processor.divide(
+                input_file_path=str(temp_filepath),
+                output_base_dir=str(stems_dir),
+                progress_callback=progress.update,
+            )
+        vocals_path = local_music_processor.output_directory / "vocals.wav"
         print(f"[{job_id}] Spleeter処理が完了。ボーカルファイルパス: {vocals_path}")
 
         if not vocals_path.exists():
             raise FileNotFoundError("ボーカルファイルの抽出に失敗しました。")
 
-        print(f"[{job_id}] Geminiによる分析を開始...")
+        progress.start_stage("gemini")
         final_prompt = f"以下の音声ファイルを分析し、ユーザーの要望に答えてください。\n\nユーザーの要望: '{user_prompt}'"
         print(f"[{job_id}] Geminiにファイルをアップロードしています...")
-        analysis_text = local_gemini_processor.generate_response(
-            user_prompt=final_prompt, file_path=str(vocals_path)
-        )
+        with job_scheduler.slot(job_id, user_id, "gemini"):
+            analysis_text = local_gemini_processor.generate_response(
+                user_prompt=final_prompt, file_path=str(vocals_path)
+            )
         print(f"[{job_id}] Geminiの分析テキスト生成が完了。")
 
         with open(analysis_result_path, "w", encoding="utf-8") as f:
             f.write(analysis_text)
         print(f"[{job_id}] 分析結果を保存しました。")
+        progress.complete(result_location=str(analysis_result_path))
 
         # ★★★ 成功時にDBに記録 ★★★
         log_operation(
@@ -73,11 +100,15 @@ def analysis_process_worker(
             status="completed",
         )
 
+    except JobCancelled:
+        # ジョブの状態と履歴は、停止させた側が記録する
+        print(f"[{job_id}] キャンセルされたため、処理を中止しました。")
     except Exception as e:
         error_message = f"処理中にエラーが発生しました。\n詳細: {str(e)}"
         with open(analysis_result_path, "w", encoding="utf-8") as f:
             f.write(error_message)
         print(f"[{job_id}] エラーが発生したため、エラー内容をファイルに記録しました。")
+        progress.fail(error_message)
 
         log_operation(
             user_id=user_id,
@@ -89,8 +120,7 @@ def analysis_process_worker(
     finally:
         if temp_filepath.exists():
             temp_filepath.unlink()
-        if spleeter_job_output_dir and spleeter_job_output_dir.exists():
-            shutil.rmtree(spleeter_job_output_dir)
+        scratch.cleanup()
         print(f"[{job_id}] プロセスがクリーンアップを完了し、終了します。")
 
 
@@ -99,11 +129,31 @@ async def start_music_analysis(
     file: UploadFile = File(...),
     prompt: str = Form("この曲の歌詞、歌い方、雰囲気を総合的に分析してください。"),
     user_id: str = Form(...),
+    profile: bool = Form(False),
 ):
-    try:
-        saved_filepath = await save_upload_file(file, UPLOAD_DIR)
-        job_id = saved_filepath.stem
+    # 同じ曲・同じ指示の分析が実行中なら、その結果を共有する
+    key = flight_key("music_analysis", await hash_upload(file), prompt=prompt)
+    shared_job_id, claim = await single_flight.attach_or_claim(
+        key, user_id, "music_analysis", file.filename
+    )
+    if shared_job_id is not None:
+        await file.close()
+        return {
+            "message": "同じ内容の分析を実行中のため、その結果を共有します。",
+            "job_id": shared_job_id,
+        }
 
+    try:
+        # 待ち行列が一杯なら、アップロードを保存する前に429を返す
+        check_admission(user_id, "music_analysis", "separation")
+        saved_filepath = await save_upload_file(file, UPLOAD_DIR, "music_analysis")
+    except BaseException:
+        # クライアントの切断も含め、ジョブを作らずに終わる場合は予約を解除する
+        single_flight.release(claim)
+        raise
+
+    job_id = saved_filepath.stem
+    try:
         log_operation(
             user_id=user_id,
             operation_type="music_analysis",
@@ -111,31 +161,43 @@ async def start_music_analysis(
             status="started",
         )
 
-        process = multiprocessing.Process(
-            target=analysis_process_worker,
-            args=(saved_filepath, job_id, prompt, user_id, file.filename),
+        job_registry.create(job_id, "music_analysis", user_id, file.filename)
+        single_flight.register(claim, job_id)
+        dispatch_job(
+            job_id,
+            user_id,
+            "music_analysis",
+            "separation",
+            analysis_process_worker,
+            (saved_filepath, job_id, prompt, user_id, file.filename, profile),
         )
-        process.start()
 
         return {
             "message": "分析リクエストを受け付けました。処理には数分かかることがあります。",
             "job_id": job_id,
         }
     except Exception as e:
+        # registerの後なら、キーはジョブの失敗を受けて外れる
+        single_flight.release(claim)
+        if job_registry.get(job_id) is not None:
+            job_registry.update(job_id, state="failed", error=str(e))
         raise HTTPException(
             status_code=500, detail=f"リクエストの受付中にエラーが発生しました: {e}"
         )
 
 
 @router.get("/analysis-status/{job_id}")
-async def get_analysis_status(job_id: str):
+async def get_analysis_status(
+    job_id: str,
+    since: Optional[float] = None,
+    wait: float = Query(0, ge=0, le=MAX_LONG_POLL_SECONDS),
+):
     if ".." in job_id or "/" in job_id:
         raise HTTPException(status_code=400, detail="無効なJob IDです。")
-    result_file = ANALYSIS_RESULTS_DIR / f"{job_id}.txt"
-    if result_file.exists():
-        return {"status": "complete"}
-    else:
-        return {"status": "processing"}
+    status = await wait_for_job_status(job_id, since, wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    return status
 
 
 @router.get("/analysis-result/{job_id}")
@@ -1,116 +1,301 @@
-import multiprocessing
+import json
+import re
 import subprocess
 import sys
+import uuid
 from pathlib import Path
+from typing import Optional
 
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi import APIRouter, File, Form, HTTPException, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
-from starlette.background import BackgroundTask
 
 sys.path.append(str(Path(__file__).resolve().parent.parent.parent))
 
+from helper.artifact_store import get_artifact, store_artifact
 from helper.audio_extractor import AudioExtractor
 from helper.db_handler import log_operation
+from helper.download_processed import create_ranged_file_response
+from helper.ffmpeg_runner import probe_duration, run_ffmpeg_with_progress
+from helper.job_events import MAX_LONG_POLL_SECONDS, wait_for_job_status
+from helper.job_progress import JobProgress
+from helper.job_dispatch import check_admission, dispatch_job
+from helper.job_registry import JobCancelled, job_registry
+from helper.job_scheduler import job_scheduler
+from helper.media_preview import (
+    PreviewWindow,
+    cut_window,
+    estimate_clip_bytes,
+    link_stored_source,
+    parse_preview_window,
+    prime_source,
+    release_source,
+    resolve_stored_source,
+    stored_upload_path,
+)
+from helper.metrics import record_cache_lookup, track_stage, with_operation
 from helper.save_upload import save_upload_file
-from helper.subtitle_generator import SubtitleGenerator
+from helper.scratch_space import ScratchSpace, estimate_wav_bytes
+from helper.shared_storage import shared_path
+from helper.single_flight import flight_key, hash_upload, single_flight
+from helper.subtitle_generator import (
+    SUBTITLE_FORMATS,
+    SubtitleGenerator,
+    estimate_subtitle_bytes,
+    parse_timestamp,
+)
+from helper.thread_budget import ffmpeg_thread_args
+from helper.tracing import traced_job
+from helper.transcript_store import (
+    TRANSCRIPT_STORE_DIR,
+    compute_file_hash,
+    find_source_video,
+    is_valid_hash,
+    load_transcript,
+    save_source_video,
+    save_transcript,
+)
 
 from .transcription import Transcriber
 
 router = APIRouter()
 
-UPLOAD_DIR = Path("./temp_uploads_subtitle")
-PROCESSING_DIR = Path("./processing_subtitle")
-RESULT_DIR = Path("./result_subtitle")
+UPLOAD_DIR = shared_path("temp_uploads_subtitle")
+# ジョブごとの元動画のハッシュ。job_id指定の再レンダリングで使うため、成果物と同じ期間だけ残す
+JOB_SOURCE_DIR = shared_path("subtitle_job_sources")
+RESULT_DIR = shared_path("result_subtitle")
 FONT_FILE_PATH = (
     Path(__file__).resolve().parent.parent.parent
     / "fonts/NotoSansJP-VariableFont_wght.ttf"
 )
 
+SUBTITLE_STAGES = [
+    ("extract", "音声の抽出"),
+    ("transcribe", "タイムスタンプ付き文字起こし (Gemini API)"),
+    ("srt", "字幕ファイル (SRT形式) の生成"),
+    ("burn", "動画への字幕の焼き付け (FFmpeg)"),
+]
+
+PREVIEW_SUBTITLE_STAGES = [("cut", "プレビュー区間の切り出し (FFmpeg)")] + SUBTITLE_STAGES
+
+RERENDER_STAGES = [
+    ("srt", "字幕ファイルの生成"),
+    ("burn", "動画への字幕の合成 (FFmpeg)"),
+]
+RENDER_MODES = ("burn", "soft")
+# ffmpegのフィルタ文字列に埋め込むため、区切り文字やクォートを含む名前は受け付けない
+FONT_NAME_PATTERN = re.compile(r"^[\w \-]{1,64}$")
+
 
 @router.on_event("startup")
 async def startup_event():
-    UPLOAD_DIR.mkdir(exist_ok=True)
-    PROCESSING_DIR.mkdir(exist_ok=True)
-    RESULT_DIR.mkdir(exist_ok=True)
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    JOB_SOURCE_DIR.mkdir(parents=True, exist_ok=True)
+    RESULT_DIR.mkdir(parents=True, exist_ok=True)
     print("字幕生成機能用のディレクトリ準備が完了しました。")
 
 
-def subtitle_worker(
-    input_video_path: Path, job_id: str, user_id: str, original_filename: str
+def render_subtitled_video(
+    input_video_path: Path,
+    subtitle_path: Path,
+    output_video_path: Path,
+    render_mode: str = "burn",
+    font_name: Optional[str] = None,
+    progress_callback=None,
 ):
-    job_dir = PROCESSING_DIR / job_id
-    job_dir.mkdir(exist_ok=True)
-
-    final_video_path = RESULT_DIR / f"{job_id}.mp4"
-    status_file = job_dir / "status.txt"
-
-    def update_status(message: str):
-        print(f"[{job_id}] {message}")
-        with open(status_file, "w", encoding="utf-8") as f:
-            f.write(f"processing: {message}")
-
-    try:
-        abs_input_video_path = input_video_path.resolve()
-        abs_job_dir = job_dir.resolve()
-        abs_audio_path = abs_job_dir / "extracted_audio.wav"
-        abs_srt_path = abs_job_dir / "subtitle.srt"
-        abs_final_video_path = final_video_path.resolve()
+    if render_mode == "soft":
+        # 字幕を別トラックとして多重化するだけなので再エンコードは不要
+        command = [
+            "ffmpeg",
+            "-i",
+            str(input_video_path),
+            "-i",
+            str(subtitle_path),
+            "-map",
+            "0",
+            "-map",
+            "1",
+            "-c",
+            "copy",
+            "-c:s",
+            "mov_text",
+            str(output_video_path),
+        ]
+    else:
         abs_font_file_path = FONT_FILE_PATH.resolve()
-
-        update_status("音声の抽出を開始しています...")
-        AudioExtractor.extract_audio(abs_input_video_path, abs_audio_path)
-
-        update_status("タイムスタンプ付き文字起こしを開始しています (Gemini API)...")
-        transcriber = Transcriber()
-        timestamped_data = transcriber.transcribe_audio_with_timestamps(
-            str(abs_audio_path)
-        )
-
-        update_status("字幕ファイル (SRT形式) を生成を開始しています...")
-        SubtitleGenerator.create_srt_from_timestamped_data(
-            timestamped_data, abs_srt_path
-        )
-
-        update_status("動画に字幕を焼き付けています (FFmpeg)...")
-
         if not abs_font_file_path.exists():
             raise FileNotFoundError(
                 f"フォントファイルが見つかりません: {abs_font_file_path}"
             )
 
-        video_filter_value = f"subtitles='{abs_srt_path.as_posix()}':force_style='FontFile={abs_font_file_path.as_posix()}'"
+        force_style = f"FontFile={abs_font_file_path.as_posix()}"
+        if font_name:
+            if not FONT_NAME_PATTERN.fullmatch(font_name):
+                raise ValueError(f"無効なフォント名です: {font_name!r}")
+            force_style += f",FontName={font_name}"
+        video_filter_value = (
+            f"subtitles='{subtitle_path.as_posix()}':force_style='{force_style}'"
+        )
         command = [
             "ffmpeg",
             "-i",
-            str(abs_input_video_path),
+            str(input_video_path),
             "-vf",
             video_filter_value,
             "-c:a",
             "copy",
-            str(abs_final_video_path),
+            *ffmpeg_thread_args(),
+            str(output_video_path),
         ]
-        print(f"実行するFFmpegコマンド: {' '.join(command)}")
+    print(f"実行するFFmpegコマンド: {' '.join(command)}")
 
-        try:
-            result = subprocess.run(
-                command, check=True, capture_output=True, text=True, encoding="utf-8"
+    try:
+        with track_stage("ffmpeg_encode"):
+            result = run_ffmpeg_with_progress(
+                command, probe_duration(input_video_path), progress_callback
+            )
+        print("FFmpeg output:", result.stdout)
+    except subprocess.CalledProcessError as e:
+        error_detail = f"コマンド: {' '.join(e.cmd)}\n終了コード: {e.returncode}\nエラー出力:\n{e.stderr}"
+        raise RuntimeError(f"FFmpeg処理中にエラーが発生しました。\n{error_detail}")
+
+
+def write_job_source(job_id: str, content_hash: str, original_filename: str):
+    JOB_SOURCE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(JOB_SOURCE_DIR / f"{job_id}.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {"content_hash": content_hash, "original_filename": original_filename},
+            f,
+            ensure_ascii=False,
+        )
+
+
+def read_job_source(job_id: str) -> Optional[dict]:
+    source_file = JOB_SOURCE_DIR / f"{job_id}.json"
+    if not source_file.exists():
+        return None
+    with open(source_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@with_operation("add_subtitle")
+@traced_job
+def subtitle_worker(
+    input_video_path: Path,
+    job_id: str,
+    user_id: str,
+    original_filename: str,
+    profile: bool = False,
+    content_hash: Optional[str] = None,
+    preview_start: Optional[float] = None,
+    preview_duration: Optional[float] = None,
+):
+    preview = (
+        PreviewWindow(preview_start, preview_duration)
+        if preview_duration is not None
+        else None
+    )
+    final_video_path = RESULT_DIR / f"{job_id}.mp4"
+    progress = JobProgress(
+        job_id,
+        "add_subtitle",
+        PREVIEW_SUBTITLE_STAGES if preview else SUBTITLE_STAGES,
+    )
+    scratch = ScratchSpace(job_id)
+    source_hash = None
+
+    try:
+        abs_input_video_path = input_video_path.resolve()
+        abs_final_video_path = final_video_path.resolve()
+
+        # 受付時に計算済みならそれを使う
+        content_hash = content_hash or compute_file_hash(abs_input_video_path)
+        # プレビューでも元動画全体と長さを保存し、続く本処理で再アップロードを不要にする
+        prime_source(content_hash, abs_input_video_path, original_filename)
+        source_hash = content_hash
+
+        if preview:
+            progress.start_stage("cut")
+            abs_clip_path = scratch.allocate(
+                "preview.mp4", estimate_clip_bytes(abs_input_video_path, preview)
+            ).resolve()
+            with job_scheduler.slot(job_id, user_id, "ffmpeg"):
+                cut_window(
+                    abs_input_video_path,
+                    abs_clip_path,
+                    preview,
+                    video=True,
+                    progress_callback=progress.update,
+                )
+            # 区間ごとに文字起こしを保存し、切り出した動画は再レンダリングの元動画にする。
+            # 切り出した動画は短いため、スクラッチ領域からそのまま移動する
+            content_hash = preview.cache_key(content_hash)
+            abs_input_video_path = save_source_video(
+                content_hash, abs_clip_path, move=True
+            ).resolve()
+        write_job_source(job_id, content_hash, original_filename)
+
+        timestamped_data = load_transcript(content_hash)
+        record_cache_lookup("transcript", timestamped_data is not None)
+        if timestamped_data is not None:
+            progress.skip_stage("extract")
+            progress.skip_stage(
+                "transcribe", "保存済みの文字起こし結果を再利用します。"
+            )
+        else:
+            progress.start_stage("extract")
+            # 16kHz・モノラルで抽出する
+            abs_audio_path = scratch.allocate(
+                "extracted_audio.wav",
+                estimate_wav_bytes(
+                    probe_duration(abs_input_video_path), sample_rate=16000, channels=1
+                ),
+            ).resolve()
+            with job_scheduler.slot(job_id, user_id, "ffmpeg"):
+                AudioExtractor.extract_audio(
+                    abs_input_video_path,
+                    abs_audio_path,
+                    progress_callback=progress.update,
+                )
+
+            progress.start_stage("transcribe")
+            with job_scheduler.slot(job_id, user_id, "gemini"):
+                transcriber = Transcriber()
+                timestamped_data = transcriber.transcribe_audio_with_timestamps(
+                    str(abs_audio_path)
+                )
+            save_transcript(content_hash, timestamped_data)
+
+        progress.start_stage("srt")
+        abs_srt_path = scratch.allocate(
+            "subtitle.srt", estimate_subtitle_bytes(timestamped_data)
+        ).resolve()
+        SubtitleGenerator.create_srt_from_timestamped_data(
+            timestamped_data, abs_srt_path
+        )
+
+        progress.start_stage("burn")
+        with job_scheduler.slot(job_id, user_id, "ffmpeg"):
+            render_subtitled_video(
+                abs_input_video_path,
+                abs_srt_path,
+                abs_final_video_path,
+                progress_callback=progress.update,
             )
-            print("FFmpeg output:", result.stdout)
-        except subprocess.CalledProcessError as e:
-            error_detail = f"コマンド: {' '.join(e.cmd)}\n終了コード: {e.returncode}\nエラー出力:\n{e.stderr}"
-            raise RuntimeError(f"FFmpeg処理中にエラーが発生しました。\n{error_detail}")
+        store_artifact(abs_final_video_path, "subtitle", f"{job_id}.mp4", "video/mp4")
 
-        with open(status_file, "w", encoding="utf-8") as f:
-            f.write("complete")
+        progress.complete(result_location=f"subtitle/{job_id}.mp4")
         print(f"[{job_id}] 全ての処理が正常に完了しました。")
 
         log_operation(user_id, "add_subtitle", original_filename, "completed")
 
+    except JobCancelled:
+        # ジョブの状態と履歴は、停止させた側が記録する
+        print(f"[{job_id}] キャンセルされたため、処理を中止しました。")
     except Exception as e:
         error_message = f"エラーが発生しました: {str(e)}"
         print(f"[{job_id}] {error_message}")
-        with open(status_file, "w", encoding="utf-8") as f:
-            f.write(f"error: {error_message}")
+        progress.fail(error_message)
         log_operation(
             user_id,
             "add_subtitle",
@@ -118,71 +303,335 @@ def subtitle_worker(
             f"failed: {e.__class__.__name__}",
         )
 
+    finally:
+        scratch.cleanup()
+        # 元動画は成果物ストアに保持しているため、アップロードは不要になる
+        release_source(source_hash, input_video_path)
+
+
+@with_operation("subtitle_rerender")
+@traced_job
+def subtitle_render_worker(
+    source_video_path: Path,
+    job_id: str,
+    user_id: str,
+    original_filename: str,
+    timestamped_data: list,
+    render_mode: str,
+    subtitle_format: str,
+    font_name: Optional[str],
+):
+    final_video_path = RESULT_DIR / f"{job_id}.mp4"
+    progress = JobProgress(job_id, "subtitle_rerender", RERENDER_STAGES)
+    scratch = ScratchSpace(job_id)
+
+    try:
+        abs_subtitle_path = scratch.allocate(
+            f"subtitle.{subtitle_format}", estimate_subtitle_bytes(timestamped_data)
+        ).resolve()
+
+        progress.start_stage("srt")
+        SubtitleGenerator.create_from_timestamped_data(
+            timestamped_data, abs_subtitle_path, subtitle_format
+        )
+
+        progress.start_stage("burn")
+        with job_scheduler.slot(job_id, user_id, "ffmpeg"):
+            render_subtitled_video(
+                source_video_path.resolve(),
+                abs_subtitle_path,
+                final_video_path.resolve(),
+                render_mode=render_mode,
+                font_name=font_name,
+                progress_callback=progress.update,
+            )
+        store_artifact(final_video_path, "subtitle", f"{job_id}.mp4", "video/mp4")
+
+        progress.complete(result_location=f"subtitle/{job_id}.mp4")
+        print(f"[{job_id}] 字幕の再レンダリングが完了しました。")
+        log_operation(user_id, "subtitle_rerender", original_filename, "completed")
+
+    except JobCancelled:
+        # ジョブの状態と履歴は、停止させた側が記録する
+        print(f"[{job_id}] キャンセルされたため、処理を中止しました。")
+    except Exception as e:
+        error_message = f"エラーが発生しました: {str(e)}"
+        print(f"[{job_id}] {error_message}")
+        progress.fail(error_message)
+        log_operation(
+            user_id,
+            "subtitle_rerender",
+            original_filename,
+            f"failed: {e.__class__.__name__}",
+        )
+
+    finally:
+        scratch.cleanup()
+
 
 @router.post("/add-subtitle")
 async def start_subtitle_process(
-    file: UploadFile = File(...), user_id: str = Form(...)
+    user_id: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    content_hash: Optional[str] = Form(None),
+    profile: bool = Form(False),
+    preview_start: Optional[float] = Form(None),
+    preview_duration: Optional[float] = Form(None),
 ):
-    saved_filepath = await save_upload_file(file, UPLOAD_DIR)
-    job_id = saved_filepath.stem
+    preview = parse_preview_window(preview_start, preview_duration)
+
+    # プレビューなどで保存済みの動画は、content_hashを指定すれば再アップロード不要
+    if file is not None:
+        content_hash = await hash_upload(file)
+        original_filename = file.filename
+    elif content_hash:
+        source_path, original_filename = resolve_stored_source(content_hash)
+    else:
+        raise HTTPException(
+            status_code=400, detail="fileまたはcontent_hashを指定してください。"
+        )
 
-    log_operation(user_id, "add_subtitle", file.filename, "started")
+    # 同じ動画・同じ区間の字幕生成が実行中なら、その結果を共有する
+    key = flight_key(
+        "add_subtitle", content_hash, **(preview.flight_params() if preview else {})
+    )
+    shared_job_id, claim = await single_flight.attach_or_claim(
+        key, user_id, "add_subtitle", original_filename
+    )
+    if shared_job_id is not None:
+        if file is not None:
+            await file.close()
+        return {
+            "message": "同じ動画の字幕生成を実行中のため、その結果を共有します。",
+            "job_id": shared_job_id,
+            "content_hash": content_hash,
+        }
 
-    process = multiprocessing.Process(
-        target=subtitle_worker,
-        args=(saved_filepath, job_id, user_id, file.filename),
+    try:
+        check_admission(user_id, "add_subtitle", "ffmpeg")
+        if file is not None:
+            saved_filepath = await save_upload_file(file, UPLOAD_DIR, "add_subtitle")
+        else:
+            saved_filepath = await run_in_threadpool(
+                link_stored_source,
+                source_path,
+                stored_upload_path(UPLOAD_DIR, original_filename, source_path),
+            )
+        job_id = saved_filepath.stem
+
+        log_operation(user_id, "add_subtitle", original_filename, "started")
+        job_registry.create(job_id, "add_subtitle", user_id, original_filename)
+    except BaseException:
+        # クライアントの切断も含め、ジョブを作らずに終わる場合は予約を解除する
+        single_flight.release(claim)
+        raise
+    single_flight.register(claim, job_id)
+    dispatch_job(
+        job_id,
+        user_id,
+        "add_subtitle",
+        "ffmpeg",
+        subtitle_worker,
+        (
+            saved_filepath,
+            job_id,
+            user_id,
+            original_filename,
+            profile,
+            content_hash,
+            preview.start if preview else None,
+            preview.duration if preview else None,
+        ),
     )
-    process.start()
 
-    return {"message": "字幕生成リクエストを受け付けました。", "job_id": job_id}
+    return {
+        "message": (
+            "字幕生成のプレビューを受け付けました。"
+            if preview
+            else "字幕生成リクエストを受け付けました。"
+        ),
+        "job_id": job_id,
+        "content_hash": content_hash,
+    }
+
+
+def _resolve_content_hash(job_id: Optional[str], content_hash: Optional[str]) -> str:
+    if content_hash:
+        if not is_valid_hash(content_hash):
+            raise HTTPException(status_code=400, detail="無効なハッシュ値です。")
+        return content_hash
+    if not job_id:
+        raise HTTPException(
+            status_code=400, detail="job_idまたはcontent_hashを指定してください。"
+        )
+    source = read_job_source(job_id)
+    if not source:
+        raise HTTPException(
+            status_code=404, detail="指定されたジョブの文字起こし結果が見つかりません。"
+        )
+    return source["content_hash"]
 
 
-@router.get("/subtitle-status/{job_id}")
-async def get_subtitle_status(job_id: str):
-    if ".." in job_id or "/" in job_id:
+def _parse_transcript(transcript: str) -> list:
+    try:
+        data = json.loads(transcript)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"字幕データの形式が不正です: {e}")
+    if not isinstance(data, list) or not all(
+        isinstance(item, dict) and {"start", "end", "text"} <= item.keys()
+        for item in data
+    ):
+        raise HTTPException(
+            status_code=400,
+            detail="字幕データは start, end, text を持つオブジェクトのリストである必要があります。",
+        )
+    for index, item in enumerate(data, 1):
+        try:
+            start, end = parse_timestamp(item["start"]), parse_timestamp(item["end"])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"{index}件目の字幕: {e}")
+        if end < start:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{index}件目の字幕: 終了時刻が開始時刻より前です。",
+            )
+        if not isinstance(item["text"], str):
+            raise HTTPException(
+                status_code=400, detail=f"{index}件目の字幕: textは文字列である必要があります。"
+            )
+    return data
+
+
+@router.post("/add-subtitle/rerender")
+async def start_subtitle_rerender(
+    user_id: str = Form(...),
+    job_id: Optional[str] = Form(None),
+    content_hash: Optional[str] = Form(None),
+    transcript: Optional[str] = Form(None),
+    render_mode: str = Form("burn"),
+    subtitle_format: str = Form("srt"),
+    font_name: Optional[str] = Form(None),
+):
+    # job_idはcontent_hashと一緒に指定された場合もファイル名に使うため、最初に確かめる
+    if job_id is not None and (".." in job_id or "/" in job_id):
         raise HTTPException(status_code=400, detail="無効なJob IDです。")
+    if render_mode not in RENDER_MODES:
+        raise HTTPException(status_code=400, detail="render_modeはburnかsoftです。")
+    if subtitle_format not in SUBTITLE_FORMATS:
+        raise HTTPException(status_code=400, detail="未対応の字幕形式です。")
+    if font_name is not None and not FONT_NAME_PATTERN.fullmatch(font_name):
+        raise HTTPException(
+            status_code=400,
+            detail="フォント名には文字・数字・空白・ハイフン・アンダースコアのみ使用できます (64文字以内)。",
+        )
+
+    check_admission(user_id, "subtitle_rerender", "ffmpeg")
+    content_hash = _resolve_content_hash(job_id, content_hash)
+    source_video_path = find_source_video(content_hash)
+    if not source_video_path:
+        raise HTTPException(status_code=404, detail="元の動画が見つかりません。")
+
+    if transcript is not None:
+        # 編集された字幕はこのジョブでだけ使う。同じ動画の文字起こし結果は他のユーザーと
+        # 共有しているため、保存済みのものは上書きしない
+        timestamped_data = _parse_transcript(transcript)
+    else:
+        timestamped_data = load_transcript(content_hash)
+        if timestamped_data is None:
+            raise HTTPException(
+                status_code=404, detail="保存済みの文字起こし結果が見つかりません。"
+            )
+
+    source = read_job_source(job_id) if job_id else None
+    original_filename = (
+        source["original_filename"] if source else source_video_path.name
+    )
+    new_job_id = f"{uuid.uuid4()}_{Path(original_filename).stem}"
+
+    log_operation(user_id, "subtitle_rerender", original_filename, "started")
+
+    job_registry.create(new_job_id, "subtitle_rerender", user_id, original_filename)
+    dispatch_job(
+        new_job_id,
+        user_id,
+        "subtitle_rerender",
+        "ffmpeg",
+        subtitle_render_worker,
+        (
+            source_video_path,
+            new_job_id,
+            user_id,
+            original_filename,
+            timestamped_data,
+            render_mode,
+            subtitle_format,
+            font_name,
+        ),
+    )
+
+    return {
+        "message": "字幕の再レンダリングを受け付けました。",
+        "job_id": new_job_id,
+        "content_hash": content_hash,
+    }
+
 
-    status_file = PROCESSING_DIR / job_id / "status.txt"
-    if not status_file.exists():
-        return {"status": "processing", "detail": "処理を開始しています..."}
+@router.get("/subtitle-file/{content_hash}")
+async def download_subtitle_file(content_hash: str, format: str = "srt"):
+    if not is_valid_hash(content_hash):
+        raise HTTPException(status_code=400, detail="無効なハッシュ値です。")
+    if format not in SUBTITLE_FORMATS:
+        raise HTTPException(status_code=400, detail="未対応の字幕形式です。")
 
-    with open(status_file, "r", encoding="utf-8") as f:
-        status_text = f.read().strip()
+    timestamped_data = load_transcript(content_hash)
+    if timestamped_data is None:
+        raise HTTPException(
+            status_code=404, detail="保存済みの文字起こし結果が見つかりません。"
+        )
 
-    status, *detail_parts = status_text.split(": ", 1)
-    detail = detail_parts[0] if detail_parts else ""
+    subtitle_path = TRANSCRIPT_STORE_DIR / content_hash / f"subtitle.{format}"
+    try:
+        SubtitleGenerator.create_from_timestamped_data(
+            timestamped_data, subtitle_path, format
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=500, detail=f"保存済みの文字起こし結果を変換できません: {e}"
+        )
+    return FileResponse(
+        subtitle_path,
+        media_type="text/plain; charset=utf-8",
+        filename=f"{content_hash[:12]}.{format}",
+    )
 
-    return {"status": status, "detail": detail}
 
+@router.get("/subtitle-status/{job_id}")
+async def get_subtitle_status(
+    job_id: str,
+    since: Optional[float] = None,
+    wait: float = Query(0, ge=0, le=MAX_LONG_POLL_SECONDS),
+):
+    if ".." in job_id or "/" in job_id:
+        raise HTTPException(status_code=400, detail="無効なJob IDです。")
 
-def cleanup_files(files_to_delete: list[Path]):
-    for file_path in files_to_delete:
-        if file_path.exists():
-            try:
-                file_path.unlink()
-                print(f"クリーンアップ: {file_path} を削除しました。")
-            except OSError as e:
-                print(f"クリーンアップエラー: {file_path} の削除に失敗しました - {e}")
+    status = await wait_for_job_status(job_id, since, wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    return status
 
 
 @router.get("/download-subtitled-video/{job_id}")
-async def download_subtitled_video(job_id: str):
+async def download_subtitled_video(job_id: str, request: Request):
     if ".." in job_id or "/" in job_id:
         raise HTTPException(status_code=400, detail="無効なJob IDです。")
 
-    result_file = RESULT_DIR / f"{job_id}.mp4"
-    original_file = UPLOAD_DIR / f"{job_id}.mp4"
-
-    if not result_file.exists():
+    artifact = get_artifact("subtitle", f"{job_id}.mp4")
+    if not artifact:
         raise HTTPException(
             status_code=404, detail="結果ファイルが見つからないか、まだ処理中です。"
         )
 
-    files_for_cleanup = [result_file, original_file]
-
-    return FileResponse(
-        result_file,
-        media_type="video/mp4",
-        filename=f"subtitled_{job_id}.mp4",
-        background=BackgroundTask(cleanup_files, files_to_delete=files_for_cleanup),
+    file_path, meta = artifact
+    return create_ranged_file_response(
+        request, file_path, meta["media_type"], f"subtitled_{job_id}.mp4"
     )
@@ -0,0 +1,34 @@
+"""テストは core ディレクトリを基準に helper / module を読み込む。
+共有ストレージ・DB・スクラッチ領域は、読み込み前に一時ディレクトリへ向ける"""
+
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+CORE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(CORE_DIR))
+
+_work_dir = Path(tempfile.mkdtemp(prefix="audily-test-"))
+os.environ.setdefault("SHARED_STORAGE_DIR", str(_work_dir))
+os.environ.setdefault("AUDILY_DB_PATH", str(_work_dir / "audily.db"))
+os.environ.setdefault("SCRATCH_RAM_DIR", str(_work_dir / "scratch_ram"))
+os.environ.setdefault("SCRATCH_DISK_DIR", str(_work_dir / "scratch_disk"))
+
+
+@pytest.fixture
+def history_db(tmp_path, monkeypatch):
+    """テストごとに空のDBを作り、setup_databaseを済ませたdb_handlerを返す"""
+    from helper import db_handler
+
+    db_path = tmp_path / "audily.db"
+    db_path.touch()
+    monkeypatch.setattr(db_handler, "DB_PATH", db_path)
+    monkeypatch.setattr(db_handler, "_db_path_checked", False)
+    monkeypatch.setattr(db_handler, "_local", threading.local())
+    db_handler.setup_database()
+    yield db_handler
+    db_handler.close_all_connections()
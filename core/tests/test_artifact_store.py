@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+
+import pytest
+
+from helper import artifact_store, transcript_store
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """成果物ストアを一時ディレクトリに置き、時刻を進められるようにする"""
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(artifact_store, "ARTIFACT_STORE_DIR", tmp_path / "artifacts")
+    monkeypatch.setattr(artifact_store, "time", SimpleNamespace(time=lambda: clock.now))
+    monkeypatch.setattr(transcript_store, "ARTIFACT_STORE_DIR", tmp_path / "artifacts")
+    return clock
+
+
+def make_file(directory, name: str, size: int):
+    path = directory / name
+    path.write_bytes(b"x" * size)
+    return path
+
+
+def test_store_and_get(store, tmp_path):
+    stored = artifact_store.store_artifact(
+        make_file(tmp_path, "result.zip", 10), "separation", "result.zip", "application/zip"
+    )
+    path, meta = artifact_store.get_artifact("separation", "result.zip")
+    assert path == stored
+    assert meta["size"] == 10
+    assert meta["media_type"] == "application/zip"
+    assert not (tmp_path / "result.zip").exists()
+
+
+@pytest.mark.parametrize("name", ["", "../escape", "a/b", "a\\b"])
+def test_rejects_unsafe_names(store, tmp_path, name):
+    with pytest.raises(ValueError):
+        artifact_store.store_artifact(make_file(tmp_path, "f", 1), "separation", name)
+    assert artifact_store.get_artifact("separation", name) is None
+
+
+def test_expired_artifact_is_removed(store, tmp_path):
+    stored = artifact_store.store_artifact(
+        make_file(tmp_path, "a.mp4", 10), "subtitle", "a.mp4", ttl_seconds=60
+    )
+    store.now += 61
+    assert artifact_store.get_artifact("subtitle", "a.mp4") is None
+    assert not stored.exists()
+
+
+def test_sweep_removes_only_expired(store, tmp_path):
+    artifact_store.store_artifact(
+        make_file(tmp_path, "old.mp4", 10), "subtitle", "old.mp4", ttl_seconds=60
+    )
+    artifact_store.store_artifact(
+        make_file(tmp_path, "new.mp4", 10), "subtitle", "new.mp4", ttl_seconds=600
+    )
+    store.now += 120
+    assert artifact_store.sweep_expired_artifacts() == 1
+    assert artifact_store.get_artifact("subtitle", "old.mp4") is None
+    assert artifact_store.get_artifact("subtitle", "new.mp4") is not None
+
+
+def test_quota_evicts_least_recently_used(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_store, "ARTIFACT_QUOTA_BYTES", 25)
+    for name in ("a", "b"):
+        artifact_store.store_artifact(make_file(tmp_path, name, 10), "separation", name)
+        store.now += 1
+    # aを参照し直すと、最も古いのはbになる
+    assert artifact_store.get_artifact("separation", "a") is not None
+    store.now += 1
+
+    artifact_store.store_artifact(make_file(tmp_path, "c", 10), "separation", "c")
+    assert artifact_store.get_artifact("separation", "a") is not None
+    assert artifact_store.get_artifact("separation", "b") is None
+    assert artifact_store.get_artifact("separation", "c") is not None
+
+
+def test_quota_keeps_artifact_just_stored(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_store, "ARTIFACT_QUOTA_BYTES", 5)
+    artifact_store.store_artifact(make_file(tmp_path, "big", 10), "separation", "big")
+    assert artifact_store.get_artifact("separation", "big") is not None
+
+
+def test_stored_sources_share_the_quota(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_store, "ARTIFACT_QUOTA_BYTES", 25)
+    content_hash = "a" * 64
+    upload = make_file(tmp_path, "upload.mp4", 10)
+
+    stored = transcript_store.save_source_video(content_hash, upload)
+    assert stored is not None and upload.exists()
+    assert transcript_store.find_source_video(content_hash) == stored
+
+    for name in ("b", "c"):
+        store.now += 1
+        artifact_store.store_artifact(make_file(tmp_path, name, 10), "separation", name)
+    assert transcript_store.find_source_video(content_hash) is None
+
+
+def test_move_source_video(store, tmp_path):
+    content_hash = "b" * 64
+    clip = make_file(tmp_path, "preview.mp4", 10)
+    stored = transcript_store.save_source_video(content_hash, clip, move=True)
+    assert stored.name == f"{content_hash}.mp4"
+    assert not clip.exists()
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from helper import db_handler
+
+BASE_TIME = datetime(2025, 1, 1, 12, 0, 0, tzinfo=db_handler.JST)
+
+
+def insert_rows(rows: list[tuple]):
+    db_handler.write_operation_rows(rows)
+
+
+def test_cursor_round_trip():
+    cursor = db_handler.encode_history_cursor("2025-01-01T12:00:00+09:00", 42)
+    assert db_handler.decode_history_cursor(cursor) == ("2025-01-01T12:00:00+09:00", 42)
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "bnVsbA==", "WzFd"])
+def test_decode_rejects_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        db_handler.decode_history_cursor(cursor)
+
+
+def test_pages_cover_all_rows_once_in_order(history_db):
+    # 同じ時刻の行を含め、ページの境目で重複も欠落もしないこと
+    insert_rows(
+        [
+            ("u1", "mp4_to_mp3", f"{i}.mp4", "completed", BASE_TIME + timedelta(seconds=i // 2))
+            for i in range(7)
+        ]
+        + [("u2", "mp4_to_mp3", "other.mp4", "completed", BASE_TIME)]
+    )
+
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = history_db.get_history_page("u1", limit=3, cursor=cursor)
+        assert len(page) <= 3
+        seen.extend(page)
+        if cursor is None:
+            break
+
+    assert len(seen) == 7
+    assert len({row["id"] for row in seen}) == 7
+    keys = [(row["created_at"], row["id"]) for row in seen]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_last_full_page_has_no_cursor(history_db):
+    insert_rows(
+        [("u1", "mp4_to_mp3", f"{i}.mp4", "completed", BASE_TIME) for i in range(3)]
+    )
+    page, cursor = history_db.get_history_page("u1", limit=3)
+    assert len(page) == 3
+    assert cursor is None
+
+
+def test_status_filter_includes_failure_details(history_db):
+    insert_rows(
+        [
+            ("u1", "add_subtitle", "a.mp4", "failed: RuntimeError", BASE_TIME),
+            ("u1", "add_subtitle", "b.mp4", "completed", BASE_TIME),
+        ]
+    )
+    page, _ = history_db.get_history_page("u1", status="failed")
+    assert [row["source_filename"] for row in page] == ["a.mp4"]
+
+
+def test_summary_follows_updates_and_deletes(history_db):
+    insert_rows(
+        [
+            ("u1", "add_subtitle", "a.mp4", "started", BASE_TIME),
+            ("u1", "add_subtitle", "b.mp4", "failed: RuntimeError", BASE_TIME),
+        ]
+    )
+    conn = history_db.get_connection()
+    conn.execute(
+        "UPDATE operation_history SET status = 'completed' WHERE source_filename = 'a.mp4'"
+    )
+    conn.execute("DELETE FROM operation_history WHERE source_filename = 'b.mp4'")
+    conn.commit()
+
+    assert history_db.get_history_summary("u1") == {
+        "total": 1,
+        "by_operation": {"add_subtitle": {"total": 1, "completed": 1}},
+    }
@@ -0,0 +1,126 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from helper import job_queue as job_queue_module
+from helper.job_queue import SQLiteJobQueue, create_job_queue, decode_payload
+
+
+def noop_target(*args):
+    pass
+
+
+@pytest.fixture
+def queue(history_db, monkeypatch):
+    """空のDB上のキュー。clock.nowを進めて貸出期限を切らせる"""
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(job_queue_module, "time", SimpleNamespace(time=lambda: clock.now))
+    job_queue = SQLiteJobQueue()
+    job_queue.setup()
+    job_queue.clock = clock
+    return job_queue
+
+
+def enqueue(queue, job_id: str, user_id: str = "u1", kind: str = "add_subtitle"):
+    assert queue.enqueue(job_id, kind, user_id, "ffmpeg", noop_target, (job_id,))
+    queue.clock.now += 1
+
+
+def test_payload_round_trip(queue):
+    queue.enqueue("j1", "add_subtitle", "u1", "ffmpeg", noop_target, (Path("/a/b.mp4"), 3))
+    leased = queue.lease("w1", ["add_subtitle"])
+    pool, target, args = decode_payload(leased["payload"])
+    assert pool == "ffmpeg"
+    assert target == f"{__name__}:noop_target"
+    assert args == (Path("/a/b.mp4"), 3)
+    assert leased["attempts"] == 1
+
+
+def test_lease_filters_by_kind_and_skips_leased(queue):
+    enqueue(queue, "j1", kind="music_analysis")
+    enqueue(queue, "j2")
+    assert queue.lease("w1", ["add_subtitle"])["job_id"] == "j2"
+    assert queue.lease("w1", ["add_subtitle"]) is None
+    assert queue.count_pending("music_analysis") == 1
+
+
+def test_lease_prefers_users_with_fewer_running_jobs(queue):
+    enqueue(queue, "a1", user_id="a")
+    enqueue(queue, "a2", user_id="a")
+    enqueue(queue, "b1", user_id="b")
+    assert queue.lease("w1", ["add_subtitle"])["job_id"] == "a1"
+    # a2の方が古いが、aは既に1件実行中のためbを先に貸し出す
+    assert queue.lease("w1", ["add_subtitle"])["job_id"] == "b1"
+    assert queue.lease("w1", ["add_subtitle"])["job_id"] == "a2"
+
+
+def test_heartbeat_keeps_lease_alive(queue):
+    enqueue(queue, "j1")
+    queue.lease("w1", ["add_subtitle"])
+    queue.clock.now += job_queue_module.LEASE_SECONDS - 1
+    assert queue.heartbeat("j1", "w1")
+    queue.clock.now += job_queue_module.LEASE_SECONDS - 1
+    assert queue.requeue_expired() == ([], [])
+    assert queue.get_state("j1") == "leased"
+
+
+def test_expired_lease_is_requeued_to_another_worker(queue):
+    enqueue(queue, "j1")
+    queue.lease("w1", ["add_subtitle"])
+    queue.clock.now += job_queue_module.LEASE_SECONDS + 1
+
+    assert queue.requeue_expired() == (["j1"], [])
+    assert queue.get_state("j1") == "pending"
+    # 失効した貸出のワーカーは、ハートビートも完了も受け付けられない
+    assert not queue.heartbeat("j1", "w1")
+
+    leased = queue.lease("w2", ["add_subtitle"])
+    assert leased["job_id"] == "j1"
+    assert leased["attempts"] == 2
+    queue.complete("j1", "w1")
+    assert queue.get_state("j1") == "leased"
+    queue.complete("j1", "w2")
+    assert queue.get_state("j1") == "done"
+
+
+def test_gives_up_after_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(job_queue_module, "MAX_ATTEMPTS", 2)
+    enqueue(queue, "j1")
+    for attempt in range(2):
+        queue.lease(f"w{attempt}", ["add_subtitle"])
+        queue.clock.now += job_queue_module.LEASE_SECONDS + 1
+        requeued, failed = queue.requeue_expired()
+    assert (requeued, failed) == ([], ["j1"])
+    assert queue.get_state("j1") == "failed"
+    assert queue.lease("w9", ["add_subtitle"]) is None
+
+
+def test_cancel_stops_heartbeat(queue):
+    enqueue(queue, "j1")
+    enqueue(queue, "j2")
+    queue.lease("w1", ["add_subtitle"])
+    queue.cancel("j1")
+    queue.cancel("j2")
+    assert not queue.heartbeat("j1", "w1")
+    assert queue.get_state("j1") == "cancelled"
+    assert queue.lease("w1", ["add_subtitle"]) is None
+
+
+def test_purge_finished(queue):
+    enqueue(queue, "j1")
+    enqueue(queue, "j2")
+    queue.cancel("j1")
+    queue.clock.now += 100
+    queue.purge_finished(50)
+    assert queue.get_state("j1") is None
+    assert queue.get_state("j2") == "pending"
+
+
+def test_create_job_queue():
+    assert isinstance(create_job_queue("sqlite"), SQLiteJobQueue)
+    assert isinstance(
+        create_job_queue("helper.job_queue:SQLiteJobQueue"), SQLiteJobQueue
+    )
+    with pytest.raises(ValueError):
+        create_job_queue("redis")
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from helper import job_scheduler as job_scheduler_module  # noqa: E402
+from helper.job_scheduler import JobScheduler, SchedulerBusy  # noqa: E402
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """ffmpegの枠が1つ・geminiの枠が2つで、このプロセスを所有者とするスケジューラ (受付スレッドは起動しない)"""
+    monkeypatch.setattr(
+        job_scheduler_module, "POOL_CAPACITIES", {"ffmpeg": 1, "gemini": 2}
+    )
+    scheduler = JobScheduler()
+    scheduler.owner_pid = os.getpid()
+    return scheduler
+
+
+def submit(scheduler, job_id: str, user_id: str, granted: list, pool: str = "ffmpeg"):
+    scheduler.submit(job_id, user_id, pool, lambda: granted.append(job_id))
+
+
+def test_round_robin_between_users(scheduler):
+    granted = []
+    submit(scheduler, "busy", "z", granted)
+    for job_id in ["a1", "a2", "a3", "b1", "c1"]:
+        submit(scheduler, job_id, job_id[0], granted)
+
+    for holder in ["busy", "a1", "b1", "c1", "a2"]:
+        scheduler.release(holder, "ffmpeg")
+    # 先に多く投入したユーザーがいても、各ユーザーの要求を交互に割り当てる
+    assert granted == ["busy", "a1", "b1", "c1", "a2", "a3"]
+
+
+def test_same_job_reuses_held_slot(scheduler):
+    granted = []
+    submit(scheduler, "j1", "a", granted)
+    submit(scheduler, "j1", "a", granted)
+    submit(scheduler, "j2", "b", granted)
+    assert granted == ["j1", "j1"]
+
+
+def test_release_job_drops_pending_requests(scheduler):
+    granted, dropped = [], []
+    submit(scheduler, "j1", "a", granted)
+    scheduler.submit(
+        "j2", "b", "ffmpeg", lambda: granted.append("j2"), lambda: dropped.append("j2")
+    )
+    scheduler.release_job("j2")
+    scheduler.release_job("j1")
+    assert granted == ["j1"]
+    assert dropped == ["j2"]
+
+
+def test_admission_rejects_user_over_queue_limit(scheduler, monkeypatch):
+    monkeypatch.setattr(job_scheduler_module, "MAX_QUEUED_PER_USER", 2)
+    granted = []
+    scheduler.check_admission("a", "ffmpeg")
+    submit(scheduler, "busy", "z", granted)
+    submit(scheduler, "a1", "a", granted)
+    submit(scheduler, "a2", "a", granted)
+
+    with pytest.raises(SchedulerBusy) as excinfo:
+        scheduler.check_admission("a", "ffmpeg")
+    assert excinfo.value.status_code == 429
+    assert int(excinfo.value.headers["Retry-After"]) >= 1
+    # 他のユーザーと、他の資源はまだ受け付ける
+    scheduler.check_admission("b", "ffmpeg")
+    scheduler.check_admission("a", "gemini")
+
+
+def test_admission_rejects_everyone_when_pool_queue_is_full(scheduler, monkeypatch):
+    monkeypatch.setattr(job_scheduler_module, "MAX_QUEUED_PER_POOL", 3)
+    granted = []
+    submit(scheduler, "busy", "z", granted)
+    for index in range(3):
+        submit(scheduler, f"j{index}", f"user{index}", granted)
+    with pytest.raises(SchedulerBusy):
+        scheduler.check_admission("new-user", "ffmpeg")
+
+
+def test_retry_after_uses_observed_hold_time(scheduler):
+    pool = scheduler._pools["ffmpeg"]
+    pool.avg_hold_seconds = 10.0
+    granted = []
+    submit(scheduler, "busy", "z", granted)
+    submit(scheduler, "j1", "a", granted)
+    # 待ち1件 + 新しい要求1件 を、枠1つで順に処理する
+    assert pool.retry_after() == 20
+
+
+def test_async_slot_limits_concurrency_and_cleans_up_on_cancel(scheduler):
+    running = []
+    peak = []
+
+    async def convert(job_id: str):
+        async with scheduler.async_slot(job_id, "a", "gemini"):
+            running.append(job_id)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(job_id)
+
+    async def main():
+        await asyncio.gather(*[convert(f"j{index}") for index in range(5)])
+        waiters = [asyncio.create_task(convert(f"k{index}")) for index in range(3)]
+        await asyncio.sleep(0)
+        waiters[2].cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    asyncio.run(main())
+    assert max(peak) == 2
+    pool = scheduler._pools["gemini"]
+    assert pool.holders == {}
+    assert pool.queued == 0
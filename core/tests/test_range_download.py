@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("fastapi")
+
+from helper.download_processed import _iter_file_range, _parse_range_header  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=10-", (10, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=500-5000", (500, 999)),
+        (" bytes = 1-2", (1, 2)),
+    ],
+)
+def test_parse_range(header, expected):
+    assert _parse_range_header(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["items=0-1", "bytes=0-1,5-6"])
+def test_unsupported_range_is_ignored(header):
+    assert _parse_range_header(header, 1000) is None
+
+
+@pytest.mark.parametrize(
+    "header", ["bytes=1000-", "bytes=5-1", "bytes=-0", "bytes=a-b", "bytes=-"]
+)
+def test_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        _parse_range_header(header, 1000)
+
+
+def test_iter_file_range(tmp_path, monkeypatch):
+    monkeypatch.setattr("helper.download_processed.RANGE_CHUNK_SIZE", 3)
+    path = tmp_path / "data.bin"
+    path.write_bytes(bytes(range(20)))
+    assert b"".join(_iter_file_range(path, 5, 12)) == bytes(range(5, 13))
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("fastapi")
+
+from helper import single_flight as single_flight_module  # noqa: E402
+from helper.single_flight import SingleFlight, flight_key  # noqa: E402
+
+
+class FakeRegistry:
+    def __init__(self):
+        self.records: dict[str, dict] = {}
+
+    def get(self, job_id: str):
+        return self.records.get(job_id)
+
+    def set_state(self, job_id: str, state: str, kind: str = "source_separation"):
+        self.records[job_id] = {"job_id": job_id, "state": state, "kind": kind}
+        return self.records[job_id]
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = FakeRegistry()
+    monkeypatch.setattr(single_flight_module, "job_registry", registry)
+    return registry
+
+
+@pytest.fixture
+def history(monkeypatch):
+    """log_operation / log_operations で記録された (user_id, operation_type, filename, status)"""
+    rows = []
+    monkeypatch.setattr(
+        single_flight_module, "log_operation", lambda *row: rows.append(row)
+    )
+    monkeypatch.setattr(single_flight_module, "log_operations", rows.extend)
+    return rows
+
+
+def attach(flight: SingleFlight, user_id: str, key: str = "key"):
+    return flight.attach_or_claim(key, user_id, "source_separation", f"{user_id}.wav")
+
+
+def test_flight_key_depends_on_params_not_their_order():
+    key = flight_key("source_separation", "a" * 64, stems=5, preview_start=0.0)
+    assert key == flight_key("source_separation", "a" * 64, preview_start=0.0, stems=5)
+    assert key != flight_key("source_separation", "a" * 64, stems=4, preview_start=0.0)
+    assert key != flight_key("add_subtitle", "a" * 64, stems=5, preview_start=0.0)
+
+
+def test_second_request_attaches_to_running_job(registry, history):
+    flight = SingleFlight()
+
+    async def main():
+        job_id, claim = await attach(flight, "u1")
+        assert job_id is None
+        flight.register(claim, "job-1")
+        registry.set_state("job-1", "running")
+        return await attach(flight, "u2")
+
+    assert asyncio.run(main()) == ("job-1", None)
+    assert flight.has_followers("job-1")
+    assert history == [("u2", "source_separation", "u2.wav", "started")]
+
+
+def test_concurrent_request_waits_for_claim_to_register(registry, history):
+    flight = SingleFlight()
+
+    async def main():
+        _, claim = await attach(flight, "u1")
+        waiter = asyncio.create_task(attach(flight, "u2"))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        registry.set_state("job-1", "queued")
+        flight.register(claim, "job-1")
+        return await waiter
+
+    assert asyncio.run(main()) == ("job-1", None)
+
+
+def test_released_claim_lets_waiter_claim_again(registry, history):
+    flight = SingleFlight()
+
+    async def main():
+        _, claim = await attach(flight, "u1")
+        waiter = asyncio.create_task(attach(flight, "u2"))
+        await asyncio.sleep(0)
+        flight.release(claim)
+        return await waiter
+
+    job_id, claim = asyncio.run(main())
+    assert job_id is None
+    assert claim is not None
+
+
+def test_finished_job_is_not_shared(registry, history):
+    flight = SingleFlight()
+
+    async def main():
+        _, claim = await attach(flight, "u1")
+        flight.register(claim, "job-1")
+        registry.set_state("job-1", "failed")
+        return await attach(flight, "u2")
+
+    job_id, claim = asyncio.run(main())
+    assert job_id is None
+    assert claim is not None
+
+
+def test_job_end_records_followers_and_frees_key(registry, history):
+    flight = SingleFlight()
+
+    async def main():
+        _, claim = await attach(flight, "u1")
+        flight.register(claim, "job-1")
+        registry.set_state("job-1", "running")
+        await attach(flight, "u2")
+        await attach(flight, "u3")
+        flight._on_job_update(registry.set_state("job-1", "succeeded"))
+        return await attach(flight, "u4")
+
+    job_id, claim = asyncio.run(main())
+    assert job_id is None and claim is not None
+    assert not flight.has_followers("job-1")
+    assert history[-2:] == [
+        ("u2", "source_separation", "u2.wav", "completed"),
+        ("u3", "source_separation", "u3.wav", "completed"),
+    ]
@@ -0,0 +1,104 @@
+import pytest
+
+from helper.subtitle_generator import (
+    SubtitleGenerator,
+    format_ass_timestamp,
+    format_timestamp,
+    parse_timestamp,
+)
+
+TRANSCRIPT = [
+    {"start": "00:00:01,500", "end": "00:00:03.250", "text": "こんにちは"},
+    {"start": "01:02.5", "end": 65, "text": "一行目\n二行目"},
+]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("00:00:01,500", 1.5),
+        ("00:00:01.500", 1.5),
+        ("01:02.5", 62.5),
+        ("7.25", 7.25),
+        ("1:00:00", 3600.0),
+        ("90:00", 5400.0),
+        (3, 3.0),
+        (2.5, 2.5),
+    ],
+)
+def test_parse_timestamp(value, expected):
+    assert parse_timestamp(value) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "",
+        "abc",
+        "1:2:3:4",
+        "00:60:00",
+        "00:00:60",
+        "-1",
+        " 1: 2",
+        "１:00",
+        True,
+        None,
+        -0.5,
+        float("inf"),
+    ],
+)
+def test_parse_timestamp_rejects_malformed(value):
+    with pytest.raises(ValueError):
+        parse_timestamp(value)
+
+
+def test_format_timestamp():
+    assert format_timestamp(3723.0456) == "01:02:03.046"
+    assert format_timestamp(1.5, ",") == "00:00:01,500"
+    # 丸めで1000ミリ秒になっても繰り上がること
+    assert format_timestamp(59.9996) == "00:01:00.000"
+
+
+def test_format_ass_timestamp():
+    assert format_ass_timestamp(3723.456) == "1:02:03.46"
+    assert format_ass_timestamp(59.999) == "0:01:00.00"
+
+
+def test_srt_output(tmp_path):
+    path = tmp_path / "subtitle.srt"
+    SubtitleGenerator.create_from_timestamped_data(TRANSCRIPT, path, "srt")
+    assert path.read_text(encoding="utf-8") == (
+        "1\n00:00:01,500 --> 00:00:03,250\nこんにちは\n\n"
+        "2\n00:01:02,500 --> 00:01:05,000\n一行目\n二行目\n\n"
+    )
+
+
+def test_vtt_output(tmp_path):
+    path = tmp_path / "subtitle.vtt"
+    SubtitleGenerator.create_from_timestamped_data(TRANSCRIPT, path, "vtt")
+    assert path.read_text(encoding="utf-8") == (
+        "WEBVTT\n\n"
+        "00:00:01.500 --> 00:00:03.250\nこんにちは\n\n"
+        "00:01:02.500 --> 00:01:05.000\n一行目\n二行目\n\n"
+    )
+
+
+def test_ass_output(tmp_path):
+    path = tmp_path / "subtitle.ass"
+    SubtitleGenerator.create_from_timestamped_data(TRANSCRIPT, path, "ass")
+    dialogue = [
+        line
+        for line in path.read_text(encoding="utf-8").splitlines()
+        if line.startswith("Dialogue:")
+    ]
+    assert dialogue == [
+        "Dialogue: 0,0:00:01.50,0:00:03.25,Default,,0,0,0,,こんにちは",
+        "Dialogue: 0,0:01:02.50,0:01:05.00,Default,,0,0,0,,一行目\\N二行目",
+    ]
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        SubtitleGenerator.create_from_timestamped_data(
+            TRANSCRIPT, tmp_path / "subtitle.txt", "txt"
+        )
@@ -0,0 +1,176 @@
+"""ジョブキューからジョブを取り出して実行するワーカー。
+
+APIを JOB_EXECUTION_MODE=queue で起動し、同じDB (AUDILY_DB_PATH) と
+共有ストレージ (SHARED_STORAGE_DIR) を参照できるプロセスとして、必要な数だけ起動する。
+既定のSQLiteのジョブキューは単一ホスト専用のため、ワーカーはAPIと同じホストで動かす
+(DBがNFSなどの上にある場合は起動しない)。別のホストでワーカーを動かすには、
+JOB_QUEUE_BACKENDでホスト間で共有できるキューの実装 (helper.job_queue.JobQueue) を指定し、
+ジョブの状態を記録するDBと共有ストレージもホスト間で共有できる必要がある。
+
+    python worker.py --kinds music_analysis,add_subtitle --concurrency 2
+"""
+
+import argparse
+import importlib
+import os
+import socket
+import time
+
+from helper.db_handler import close_all_connections, setup_database
+from helper.history_writer import history_writer
+from helper.job_queue import (
+    HEARTBEAT_INTERVAL_SECONDS,
+    decode_payload,
+    job_queue,
+)
+from helper.job_registry import TERMINAL_STATES, job_registry
+from helper.job_scheduler import job_scheduler
+from helper.metrics import metrics_hub, start_metrics_server
+
+POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1.0"))
+# 0にするとメトリクスのHTTPサーバーを起動しない
+METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+# 終了したキューの行を残しておく時間
+FINISHED_QUEUE_RETENTION_SECONDS = 24 * 60 * 60
+PURGE_INTERVAL_SECONDS = 60 * 60
+
+JOB_KINDS = ("music_analysis", "add_subtitle", "subtitle_rerender", "source_separation")
+
+
+def resolve_target(name: str):
+    module_name, function_name = name.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class Worker:
+    def __init__(self, kinds: list[str], concurrency: int):
+        self.kinds = kinds
+        self.concurrency = max(1, concurrency)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # 実行中のジョブと、最後にハートビートを送った時刻
+        self.active: dict[str, float] = {}
+        self._last_purge = 0.0
+
+    def run(self):
+        metrics_hub.start()
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        job_queue.validate()
+        setup_database()
+        job_queue.setup()
+        # 他のワーカーで実行中のジョブがあるため、起動時の一括失敗処理は行わない
+        job_registry.start(recover_interrupted=False)
+        job_scheduler.start()
+        history_writer.start()
+        print(
+            f"INFO: ワーカー {self.worker_id} を開始しました (種類: {', '.join(self.kinds)}, 並列数: {self.concurrency})。"
+        )
+        try:
+            while True:
+                self._recover_expired_leases()
+                self._check_active_jobs()
+                self._lease_jobs()
+                self._purge_finished()
+                time.sleep(POLL_INTERVAL_SECONDS)
+        except KeyboardInterrupt:
+            print("INFO: ワーカーを停止します。")
+        finally:
+            for job_id in list(self.active):
+                # 停止するワーカーのジョブは、貸出期限の切れた時点で他のワーカーが再実行する
+                job_registry.terminate(job_id)
+            history_writer.stop()
+            job_scheduler.stop()
+            job_registry.stop()
+            metrics_hub.stop()
+            close_all_connections()
+
+    def _recover_expired_leases(self):
+        requeued, failed = job_queue.requeue_expired()
+        for job_id in requeued:
+            print(f"[{job_id}] 応答の無いワーカーから回収し、再実行を待ちます。")
+            job_registry.update(
+                job_id,
+                state="queued",
+                detail="ワーカーが応答しなくなったため、再実行を待っています。",
+            )
+        for job_id in failed:
+            job_registry.update(
+                job_id,
+                state="failed",
+                error="ワーカーが応答しなくなり、再試行の上限に達しました。",
+            )
+
+    def _check_active_jobs(self):
+        now = time.monotonic()
+        for job_id, last_heartbeat in list(self.active.items()):
+            record = job_registry.get(job_id)
+            if record is None or record["state"] in TERMINAL_STATES:
+                job_queue.complete(job_id, self.worker_id)
+                del self.active[job_id]
+                continue
+            if now - last_heartbeat < HEARTBEAT_INTERVAL_SECONDS:
+                continue
+            if job_queue.heartbeat(job_id, self.worker_id):
+                self.active[job_id] = now
+            else:
+                self._abandon(job_id)
+
+    def _abandon(self, job_id: str):
+        """キャンセルされたか、貸出が失効して他のワーカーに渡ったジョブを手放す"""
+        del self.active[job_id]
+        job_registry.terminate(job_id)
+        if job_queue.get_state(job_id) == "cancelled":
+            job_registry.update(job_id, state="cancelled", detail="キャンセルされました。")
+        else:
+            print(f"[{job_id}] 貸出が失効したため、このワーカーでの実行を中止しました。")
+            job_scheduler.release_job(job_id)
+
+    def _lease_jobs(self):
+        while len(self.active) < self.concurrency:
+            leased = job_queue.lease(self.worker_id, self.kinds)
+            if leased is None:
+                return
+            job_id = leased["job_id"]
+            self.active[job_id] = time.monotonic()
+            try:
+                pool, target_name, args = decode_payload(leased["payload"])
+                target = resolve_target(target_name)
+            except (ValueError, KeyError, ImportError, AttributeError) as e:
+                job_registry.update(
+                    job_id, state="failed", error=f"ジョブの内容を解釈できません: {e}"
+                )
+                continue
+
+            print(f"[{job_id}] ジョブを取得しました ({leased['kind']}, {leased['attempts']}回目)。")
+            job_registry.update(
+                job_id, detail=f"ワーカー {self.worker_id} で実行を待っています。"
+            )
+            job_scheduler.start_process(job_id, leased["user_id"], pool, target, args)
+
+    def _purge_finished(self):
+        if time.monotonic() - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = time.monotonic()
+        job_queue.purge_finished(FINISHED_QUEUE_RETENTION_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audilyのジョブワーカー")
+    parser.add_argument(
+        "--kinds",
+        default=",".join(JOB_KINDS),
+        help="実行するジョブの種類 (カンマ区切り)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("WORKER_CONCURRENCY", "2")),
+        help="同時に取得するジョブの数",
+    )
+    args = parser.parse_args()
+    kinds = [kind for kind in args.kinds.split(",") if kind]
+    Worker(kinds, args.concurrency).run()
+
+
+if __name__ == "__main__":
+    main()